@@ -19,16 +19,21 @@
 from __future__ import print_function
 from __future__ import absolute_import
 import sys
+import time
+import multiprocessing
 from collections import defaultdict
 from contextlib import contextmanager
+from datetime import datetime, timedelta
 from itertools import groupby
 
 from paste.deploy.converters import asbool
 from tg import tmpl_context as c, app_globals as g
 from pymongo.errors import DuplicateKeyError, InvalidDocument, OperationFailure
 
-from ming.orm import mapper, session, Mapper
+import ming
+from ming.orm import mapper, session, Mapper, ThreadLocalORMSession
 from ming.orm.declarative import MappedClass
+from ming.utils import LazyProperty
 
 from allura.tasks.index_tasks import add_artifacts
 from allura.lib.exceptions import CompoundError
@@ -86,11 +91,16 @@ class ReindexCommand(base.Command):
         help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                       'Allura root) to .ini file defining ming configuration.')
+    parser.add_option('--processes', dest='processes', type=int, default=1,
+                      help='Reindex this many projects at a time, in separate processes')
+    parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                      help='Save progress in mongo under this name, so a reindex that was interrupted can be '
+                           'resumed by running it again with the same --checkpoint.  Projects are processed in _id '
+                           'order, so use the same project filters when resuming')
 
     def command(self):
         from allura import model as M
         self.basic_setup()
-        graph = build_model_inheritance_graph()
         if self.options.project:
             q_project = dict(shortname=self.options.project)
         elif self.options.project_regex:
@@ -106,48 +116,128 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
-        for projects in utils.chunked_find(M.Project, q_project):
+        if self.options.checkpoint:
+            last_project_id = self._load_checkpoint()
+            if last_project_id:
+                base.log.info('Resuming reindex %r after project %s', self.options.checkpoint, last_project_id)
+                q_project['_id'] = {'$gt': last_project_id}
+        self.progress = ReindexProgress(M.Project.query.find(q_project).count())
+
+        projects = (p for chunk in utils.chunked_find(M.Project, q_project) for p in chunk)
+        if self.options.processes > 1:
+            self._reindex_parallel(p._id for p in projects)
+        else:
             for p in projects:
-                c.project = p
-                base.log.info('Reindex project %s', p.shortname)
-                # Clear index for this project
-                if self.options.solr and not self.options.skip_solr_delete:
-                    g.solr.delete(q='project_id_s:%s' % p._id)
-                if self.options.refs:
-                    M.ArtifactReference.query.remove(
-                        {'artifact_reference.project_id': p._id})
-                    M.Shortlink.query.remove({'project_id': p._id})
-                app_config_ids = [ac._id for ac in p.app_configs]
-                # Traverse the inheritance graph, finding all artifacts that
-                # belong to this project
-                for _, a_cls in dfs(M.Artifact, graph):
-                    base.log.info('  %s', a_cls)
-                    ref_ids = []
-                    # Create artifact references and shortlinks
-                    for a in a_cls.query.find(dict(app_config_id={'$in': app_config_ids})):
-                        if self.options.verbose:
-                            base.log.info('      %s', a.shorthand_id())
-                        if self.options.refs:
-                            try:
-                                M.ArtifactReference.from_artifact(a)
-                                M.Shortlink.from_artifact(a)
-                            except Exception:
-                                base.log.exception(
-                                    'Making ArtifactReference/Shortlink from %s', a)
-                                continue
-                        ref_ids.append(a.index_id())
-                    M.main_orm_session.flush()
-                    M.artifact_orm_session.clear()
-                    try:
-                        self._chunked_add_artifacts(ref_ids)
-                    except CompoundError as err:
-                        base.log.exception(
-                            'Error indexing artifacts:\n%r', err)
-                        base.log.error('%s', err.format_error())
-                    M.main_orm_session.flush()
-                    M.main_orm_session.clear()
+                num_artifacts = self._reindex_project(p)
+                self._project_done(p._id, num_artifacts)
+        if self.options.checkpoint:
+            self._checkpoint_collection().delete_one({'_id': self.options.checkpoint})
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
 
+    def _reindex_project(self, p):
+        """Reindex all the artifacts in project ``p``, and return how many there were"""
+        from allura import model as M
+        c.project = p
+        base.log.info('Reindex project %s', p.shortname)
+        num_artifacts = 0
+        # Clear index for this project
+        if self.options.solr and not self.options.skip_solr_delete:
+            g.solr.delete(q='project_id_s:%s' % p._id)
+        if not self.options.refs:
+            # artifact references are already there, no need to load the artifacts themselves
+            ref_ids = []
+            for refs in utils.chunked_find(M.ArtifactReference, {'artifact_reference.project_id': p._id}):
+                ref_ids.extend(ref._id for ref in refs)
+                M.main_orm_session.clear()
+            self._index_ref_ids(ref_ids)
+            return len(ref_ids)
+        M.ArtifactReference.query.remove(
+            {'artifact_reference.project_id': p._id})
+        M.Shortlink.query.remove({'project_id': p._id})
+        app_config_ids = [ac._id for ac in p.app_configs]
+        # Traverse the inheritance graph, finding all artifacts that
+        # belong to this project
+        for _, a_cls in dfs(M.Artifact, self.graph):
+            base.log.info('  %s', a_cls)
+            ref_ids = []
+            # Create artifact references and shortlinks
+            for a in a_cls.query.find(dict(app_config_id={'$in': app_config_ids})):
+                if self.options.verbose:
+                    base.log.info('      %s', a.shorthand_id())
+                try:
+                    M.ArtifactReference.from_artifact(a)
+                    M.Shortlink.from_artifact(a)
+                except Exception:
+                    base.log.exception(
+                        'Making ArtifactReference/Shortlink from %s', a)
+                    continue
+                ref_ids.append(a.index_id())
+            M.main_orm_session.flush()
+            M.artifact_orm_session.clear()
+            self._index_ref_ids(ref_ids)
+            num_artifacts += len(ref_ids)
+        return num_artifacts
+
+    def _index_ref_ids(self, ref_ids):
+        from allura import model as M
+        try:
+            self._chunked_add_artifacts(ref_ids)
+        except CompoundError as err:
+            base.log.exception(
+                'Error indexing artifacts:\n%r', err)
+            base.log.error('%s', err.format_error())
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+
+    @LazyProperty
+    def graph(self):
+        return build_model_inheritance_graph()
+
+    def _reindex_parallel(self, project_ids):
+        """Reindex projects in a pool of ``--processes`` worker processes.
+
+        Projects can finish in any order, the checkpoint only moves past a
+        project once it and all the projects before it are done.
+        """
+        pending = []  # project ids in the order they were handed out
+        done = set()
+        pool = multiprocessing.Pool(self.options.processes, _reindex_worker_init, (self,))
+        try:
+            def dispatched():
+                for project_id in project_ids:
+                    pending.append(project_id)
+                    yield project_id
+            for project_id, num_artifacts in pool.imap_unordered(_reindex_worker, dispatched()):
+                done.add(project_id)
+                watermark = None
+                while pending and pending[0] in done:
+                    watermark = pending.pop(0)
+                    done.remove(watermark)
+                self._project_done(watermark, num_artifacts)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _project_done(self, checkpoint_project_id, num_artifacts):
+        self.progress.update(num_artifacts)
+        base.log.info('Reindex progress: %s', self.progress)
+        if self.options.checkpoint and checkpoint_project_id:
+            self._checkpoint_collection().update_one(
+                {'_id': self.options.checkpoint},
+                {'$set': {'project_id': checkpoint_project_id, 'mod_date': datetime.utcnow()}},
+                upsert=True)
+
+    def _checkpoint_collection(self):
+        from allura import model as M
+        return M.main_doc_session.db.reindex_checkpoint
+
+    def _load_checkpoint(self):
+        checkpoint = self._checkpoint_collection().find_one({'_id': self.options.checkpoint})
+        return checkpoint and checkpoint['project_id']
+
     @property
     def add_artifact_kwargs(self):
         if self.options.solr_hosts:
@@ -203,6 +293,48 @@ def noop_cm(*args):
         return contextmanager(noop_cm)
 
 
+class ReindexProgress(object):
+
+    """Keeps track of reindexed projects and artifacts, for log messages"""
+
+    def __init__(self, total_projects):
+        self.total_projects = total_projects
+        self.projects = 0
+        self.artifacts = 0
+        self.start = time.time()
+
+    def update(self, num_artifacts):
+        self.projects += 1
+        self.artifacts += num_artifacts
+
+    def __str__(self):
+        elapsed = time.time() - self.start
+        rate = self.artifacts / elapsed if elapsed else 0
+        remaining = max(self.total_projects - self.projects, 0)
+        eta = timedelta(seconds=int(elapsed / self.projects * remaining)) if self.projects else '?'
+        return '%d/%d projects, %d artifacts, %.1f artifacts/sec, ETA %s' % (
+            self.projects, self.total_projects, self.artifacts, rate, eta)
+
+
+_reindex_command = None
+
+
+def _reindex_worker_init(command):
+    global _reindex_command
+    _reindex_command = command
+    # mongo connections can't be shared with the parent process
+    ming.configure(**command.config)
+    ThreadLocalORMSession.close_all()
+
+
+def _reindex_worker(project_id):
+    from allura import model as M
+    project = M.Project.query.get(_id=project_id)
+    num_artifacts = _reindex_command._reindex_project(project) if project else 0
+    ThreadLocalORMSession.close_all()
+    return project_id, num_artifacts
+
+
 class EnsureIndexCommand(base.Command):
     min_args = 1
     max_args = 1
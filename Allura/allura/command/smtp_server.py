@@ -17,8 +17,8 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
-import smtpd
-import asyncore
+import asyncio
+import socket
 
 import faulthandler
 import tg
@@ -26,7 +26,7 @@
 
 import allura.tasks
 from allura.command import base
-from allura.lib import helpers as h
+from allura.lib import mail_util
 
 from paste.deploy.converters import asint
 
@@ -44,21 +44,254 @@ class SMTPServerCommand(base.Command):
     def command(self):
         faulthandler.enable()
         self.basic_setup()
-        MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
-                    asint(tg.config.get('forgemail.port', 8825))),
-                   None)
-        asyncore.loop()
+        server = MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
+                             asint(tg.config.get('forgemail.port', 8825))),
+                            data_size_limit=asint(tg.config.get('forgemail.max_message_size', 20 * 1024 * 1024)),
+                            max_sessions=asint(tg.config.get('forgemail.max_sessions', 100)),
+                            max_recipients=asint(tg.config.get('forgemail.max_recipients', 100)))
+        asyncio.run(server.serve())
 
 
-class MailServer(smtpd.SMTPServer):
+class MailServer(object):
+    '''
+    Receives email over SMTP, handling many sessions at once with asyncio.
 
-    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+    Each message is spooled (see :func:`allura.lib.mail_util.spool_message`)
+    and a route_email task is posted with a reference to it.  Messages over
+    data_size_limit bytes are refused as they're received, without being
+    spooled.
+    '''
+
+    def __init__(self, localaddr, data_size_limit=20 * 1024 * 1024, max_sessions=100, max_recipients=100,
+                 timeout=300):
+        self.localaddr = localaddr
+        self.data_size_limit = data_size_limit
+        self.max_sessions = max_sessions
+        self.max_recipients = max_recipients
+        self.timeout = timeout
+        self.hostname = socket.getfqdn()
+        self.sessions = 0
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, *self.localaddr)
+        base.log.info('Listening for email on %s:%s', *self.localaddr)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        if self.sessions >= self.max_sessions:
+            base.log.warning('Refusing connection from %s, %d sessions already', peer, self.sessions)
+            writer.write(b'421 Too many connections, try again later\r\n')
+            writer.close()
+            return
+        self.sessions += 1
+        try:
+            await SMTPSession(self, reader, writer, peer).run()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+            base.log.info('Session with %s ended: %r', peer, e)
+        except Exception:
+            base.log.exception('Error in session with %s', peer)
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def deliver(self, peer, mailfrom, rcpttos, data):
+        ''':returns: the SMTP reply to a message'''
+        try:
+            # spooling is blocking i/o, so it's done in a thread to keep other sessions going
+            spool = await asyncio.get_event_loop().run_in_executor(None, mail_util.spool_message, data)
+        except Exception:
+            base.log.exception('Error spooling msg')
+            return '451 Requested action aborted: error in processing'
+        return self.process_message(peer, mailfrom, rcpttos, spool=spool)
+
+    def process_message(self, peer, mailfrom, rcpttos, data=None, spool=None):
+        '''
+        Post a route_email task for a message, spooling it first if it's given as data.
+
+        :returns: the SMTP reply
+        '''
         try:
             base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
-            base.log.info(' (%d bytes)', len(data))
+            if spool is None:
+                base.log.info(' (%d bytes)', len(data))
+                spool = mail_util.spool_message(data)
             allura.tasks.mail_tasks.route_email.post(
-                peer=peer, mailfrom=mailfrom, rcpttos=rcpttos,
-                data=h.really_unicode(data))
+                peer=peer, mailfrom=mailfrom, rcpttos=rcpttos, spool=spool)
             base.log.info('Msg passed along')
+            return '250 OK'
         except Exception:
             base.log.exception('Error handling msg')
+            return '451 Requested action aborted: error in processing'
+
+
+def _parse_path(arg, keyword):
+    '''
+    :returns: the address and the (uppercased) parameters of a ``MAIL FROM:`` or
+        ``RCPT TO:`` argument, or None for the address if it's malformed
+    '''
+    if not arg.upper().startswith(keyword):
+        return None, {}
+    arg = arg[len(keyword):].strip()
+    if arg.startswith('<'):
+        end = arg.find('>')
+        if end < 0:
+            return None, {}
+        address, params = arg[1:end], arg[end + 1:].split()
+    else:
+        params = arg.split()
+        if not params:
+            return None, {}
+        address, params = params[0], params[1:]
+    return address, dict((p.split('=', 1)[0].upper(), p.split('=', 1)[1] if '=' in p else True) for p in params)
+
+
+class SMTPSession(object):
+    '''One connection to the :class:`MailServer`'''
+
+    def __init__(self, server, reader, writer, peer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = peer
+        self.helo = None
+        self.mailfrom = None
+        self.rcpttos = []
+
+    async def push(self, reply):
+        self.writer.write(reply.encode('ascii') + b'\r\n')
+        await self.writer.drain()
+
+    async def readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.server.timeout)
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        return line
+
+    async def run(self):
+        await self.push('220 %s Allura SMTP server' % self.server.hostname)
+        while True:
+            try:
+                line = await self.readline()
+            except ValueError:  # longer than the reader's limit
+                await self.push('500 Error: line too long')
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            command, _, arg = line.partition(' ')
+            method = getattr(self, 'smtp_' + command.upper(), None)
+            if method is None:
+                await self.push('500 Error: command "%s" not recognized' % command[:20])
+                continue
+            if not await method(arg.strip()):
+                return
+
+    def reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+
+    # each smtp_* method handles a command, and returns whether the session continues
+
+    async def smtp_HELO(self, arg):
+        if not arg:
+            await self.push('501 Syntax: HELO hostname')
+            return True
+        self.helo = arg
+        self.reset()
+        await self.push('250 %s' % self.server.hostname)
+        return True
+
+    async def smtp_EHLO(self, arg):
+        if not arg:
+            await self.push('501 Syntax: EHLO hostname')
+            return True
+        self.helo = arg
+        self.reset()
+        await self.push('250-%s' % self.server.hostname)
+        await self.push('250-SIZE %d' % self.server.data_size_limit)
+        await self.push('250 8BITMIME')
+        return True
+
+    async def smtp_NOOP(self, arg):
+        await self.push('250 OK')
+        return True
+
+    async def smtp_RSET(self, arg):
+        self.reset()
+        await self.push('250 OK')
+        return True
+
+    async def smtp_VRFY(self, arg):
+        await self.push('252 Cannot VRFY user, but will accept message and attempt delivery')
+        return True
+
+    async def smtp_QUIT(self, arg):
+        await self.push('221 Bye')
+        return False
+
+    async def smtp_MAIL(self, arg):
+        if not self.helo:
+            await self.push('503 Error: send HELO first')
+            return True
+        if self.mailfrom is not None:
+            await self.push('503 Error: nested MAIL command')
+            return True
+        address, params = _parse_path(arg, 'FROM:')
+        if address is None:
+            await self.push('501 Syntax: MAIL FROM:<address>')
+            return True
+        size = params.get('SIZE')
+        if size is not True and size is not None:
+            if not size.isdigit():
+                await self.push('501 Syntax: MAIL FROM:<address> SIZE=<size>')
+                return True
+            if int(size) > self.server.data_size_limit:
+                await self.push('552 Error: message size exceeds fixed maximum message size')
+                return True
+        self.mailfrom = address
+        await self.push('250 OK')
+        return True
+
+    async def smtp_RCPT(self, arg):
+        if self.mailfrom is None:
+            await self.push('503 Error: need MAIL command')
+            return True
+        address, params = _parse_path(arg, 'TO:')
+        if not address:
+            await self.push('501 Syntax: RCPT TO:<address>')
+            return True
+        if len(self.rcpttos) >= self.server.max_recipients:
+            await self.push('452 Error: too many recipients')
+            return True
+        self.rcpttos.append(address)
+        await self.push('250 OK')
+        return True
+
+    async def smtp_DATA(self, arg):
+        if not self.rcpttos:
+            await self.push('503 Error: need RCPT command')
+            return True
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        lines = []
+        size = 0
+        while True:
+            try:
+                line = await self.readline()
+            except ValueError:  # longer than the reader's limit
+                await self.push('500 Error: line too long')
+                return False
+            if line in (b'.\r\n', b'.\n'):
+                break
+            size += len(line)
+            if size > self.server.data_size_limit:
+                lines = None  # too big, but read the rest of it, to stay in step with the client
+            elif lines is not None:
+                line = line.rstrip(b'\r\n')
+                lines.append(line[1:] if line.startswith(b'.') else line)
+        if lines is None:
+            reply = '552 Error: message size exceeds fixed maximum message size'
+        else:
+            reply = await self.server.deliver(self.peer, self.mailfrom, self.rcpttos, b'\n'.join(lines))
+        self.reset()
+        await self.push(reply)
+        return True
@@ -24,7 +24,9 @@
 import os
 import time
 import six.moves.queue
+from collections import deque
 from contextlib import contextmanager
+from functools import partial
 from datetime import datetime, timedelta
 import signal
 import sys
@@ -65,6 +67,10 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--prefetch', dest='prefetch', type='int', default=1,
+                      help='claim up to this many tasks at once, and run them one after another.  Saves mongo round '
+                           'trips on busy queues, but a newly posted higher-priority task may have to wait for the '
+                           'batch to finish.  Unstarted tasks are given back on graceful stop')
 
     def command(self):
         setproctitle('taskd')
@@ -129,15 +135,30 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if M.MonQTask.notify_enabled():
+            # wake up as soon as a task is posted, poll_interval is just the upper bound
+            listener = M.MonQTaskListener(only=only)
+            waitfunc = partial(listener.wait, poll_interval)
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
+        prefetched = deque()
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                        process=name,
-                        waitfunc=waitfunc,
-                        only=only)
+                    if not prefetched:
+                        if self.options.prefetch > 1:
+                            prefetched.extend(M.MonQTask.get_many(
+                                self.options.prefetch,
+                                process=name,
+                                waitfunc=waitfunc,
+                                only=only))
+                        else:
+                            prefetched.append(M.MonQTask.get(
+                                process=name,
+                                waitfunc=waitfunc,
+                                only=only))
+                    self.task = prefetched.popleft() if prefetched else None
                     if self.task:
                         with(proctitle("taskd:{0}:{1}".format(
                                 self.task.task_name, self.task._id))):
@@ -159,12 +180,25 @@ def waitfunc_checks_running():
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        if prefetched:
+            base.log.info('taskd pid %s releasing %s unstarted tasks' % (os.getpid(), len(prefetched)))
+            M.MonQTask.release(prefetched)
+        self.flush_mail()
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
         if self.restart_when_done:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def flush_mail(self):
+        '''Sends the mail still queued by the tasks, since atexit handlers don't run for a restart'''
+        from allura.tasks import mail_tasks
+        try:
+            if not mail_tasks.smtp_client.flush(timeout=asint(tg.config.get('smtp_timeout', 10))):
+                base.log.warning('taskd pid %s could not send all its queued mail' % os.getpid())
+        except Exception:
+            base.log.exception('taskd pid %s error sending its queued mail' % os.getpid())
+
 
 class TaskCommand(base.Command):
     cmd_default_states = {
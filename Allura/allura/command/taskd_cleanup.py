@@ -51,6 +51,7 @@ def command(self):
         self.stuck_pids = []
         self.error_tasks = []
         self.suspicious_tasks = []
+        self.released_tasks = []
 
         taskd_pids = self._taskd_pids()
         base.log.info('Taskd processes on %s: %s' %
@@ -80,7 +81,15 @@ def command(self):
         for task in tasks:
             base.log.info('Verifying task %s' % task)
             pid = task.process.split()[-1]
-            if pid not in taskd_pids:
+            if task.time_start is None:
+                # claimed ahead of time by taskd --prefetch, but never started
+                if pid not in taskd_pids:
+                    base.log.info('Task was never started and taskd with given pid is gone. '
+                                  'Setting state to \'ready\'')
+                    self._release_task(task)
+                else:
+                    base.log.info('...OK, prefetched by taskd pid %s and not started yet' % pid)
+            elif pid not in taskd_pids:
                 # 'forsaken' task
                 base.log.info('Task is forsaken '
                               '(can\'t find taskd with given pid). '
@@ -121,6 +130,8 @@ def print_summary(self):
                     '...to kill these processes run command with -k flag if you are sure they are really stuck')
         if self.error_tasks:
             base.log.info('Tasks marked as \'error\': %s' % self.error_tasks)
+        if self.released_tasks:
+            base.log.info('Unstarted tasks set back to \'ready\': %s' % self.released_tasks)
 
     def _busy_tasks(self, pid=None):
         regex = '^%s ' % self.hostname
@@ -184,10 +195,18 @@ def _kill_stuck_taskd(self, pid):
         base.log.info('...taskd pid %s has assigned tasks: %s. '
                       'setting state to \'error\' for all of them' % (pid, tasks))
         for task in tasks:
+            if task.time_start is None:
+                self._release_task(task)
+                continue
             task.state = 'error'
             task.result = 'Taskd has stuck with this task'
             self.error_tasks.append(task)
 
+    def _release_task(self, task):
+        task.state = 'ready'
+        task.process = None
+        self.released_tasks.append(task)
+
     def _complete_suspicious_tasks(self):
         complete_tasks = M.MonQTask.query.find({
             'state': 'complete',
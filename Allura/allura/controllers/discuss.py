@@ -604,9 +604,9 @@ def reply(self, **kw):
 class ThreadRestController(ThreadController):
 
     @expose('json:')
-    def index(self, limit=25, page=None, **kw):
+    def index(self, limit=25, page=None, after=None, **kw):
         limit, page = h.paging_sanitizer(limit, page)
-        return dict(thread=self.thread.__json__(limit=limit, page=page))
+        return dict(thread=self.thread.__json__(limit=limit, page=page, after=after))
 
     @h.vardec
     @expose()
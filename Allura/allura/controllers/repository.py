@@ -718,11 +718,28 @@ def tarball(self, **kw):
             raise exc.HTTPNotFound()
         rev = self._commit.url().split('/')[-2]
         status = c.app.repo.get_tarball_status(rev, path)
+        if status != 'complete' and c.app.repo.can_stream_tarball():
+            redirect('snapshot?path={0}'.format(h.urlquote(path) if path else ''))
         if not status and request.method == 'POST':
             allura.tasks.repo_tasks.tarball.post(rev, path)
             redirect('tarball?path={0}'.format(h.urlquote(path) if path else ''))
         return dict(commit=self._commit, revision=rev, status=status)
 
+    @expose()
+    def snapshot(self, path=None, **kw):
+        if not asbool(tg.config.get('scm.repos.tarball.enable', False)) or \
+                not c.app.repo.can_stream_tarball():
+            raise exc.HTTPNotFound()
+        rev = self._commit.url().split('/')[-2]
+        chunks = c.app.repo.tarball_stream(rev, path)
+        filename = '%s.zip' % c.app.repo.tarball_filename(rev, path)
+        response.headers['Content-Type'] = str('')
+        response.content_type = str('application/zip')
+        response.headers.add(
+            str('Content-Disposition'),
+            str('attachment;filename="%s"') % h.urlquote(filename))
+        return chunks
+
     @expose('json:')
     def tarball_status(self, path=None, **kw):
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
@@ -32,9 +32,11 @@
 import os
 import time
 import traceback
+from collections import defaultdict
 
 import activitystream
 import pkg_resources
+import pymongo
 import markdown
 import pygments
 import pygments.lexers
@@ -45,7 +47,8 @@
 from tg import tmpl_context as c
 from paste.deploy.converters import asbool, asint, aslist
 from pypeline.markup import markup as pypeline_markup
-from ming.odm import session
+from ming.odm import session, mapper
+from ming.odm.base import ObjectState, state
 
 import ew as ew_core
 import ew.jinja2_ew as ew
@@ -57,9 +60,11 @@
 from allura.lib.markdown_extensions import (
     ForgeExtension,
     CommitMessageExtension,
+    ShortlinkExtension,
     EmojiExtension,
     UserMentionExtension
 )
+from allura.lib.markdown_cache import MarkdownCache
 from allura.eventslistener import PostEvent
 
 from allura.lib import gravatar, plugin, utils
@@ -77,6 +82,25 @@
 
 class ForgeMarkdown(markdown.Markdown):
 
+    cache_bugfix_rev = 4  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+
+    def __init__(self, *args, **kwargs):
+        # converters with a cache_name use the :class:`allura.lib.markdown_cache.MarkdownCache`, if it's enabled
+        self.cache_name = kwargs.pop('cache_name', None)
+        markdown.Markdown.__init__(self, *args, **kwargs)
+
+    @property
+    def forge_extension(self):
+        for ext in self.registeredExtensions:
+            if isinstance(ext, ForgeExtension):
+                return ext
+
+    @property
+    def shortlink_extension(self):
+        for ext in self.registeredExtensions:
+            if isinstance(ext, ShortlinkExtension):
+                return ext
+
     def convert(self, source, render_limit=True):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
@@ -84,6 +108,15 @@ def convert(self, source, render_limit=True):
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return Markup('<pre>%s</pre>' % escaped)
+        cache = MarkdownCache.from_config() if self.cache_name else None
+        if cache:
+            return cache.convert(self, source)
+        return self.convert_uncached(source)
+
+    def convert_uncached(self, source):
+        ext = self.shortlink_extension
+        if ext:
+            ext.prefetch_shortlinks([source])
         try:
             return markdown.Markdown.convert(self, source)
         except Exception:
@@ -99,25 +132,79 @@ def cached_convert(self, artifact, field_name):
         the result if the render time is greater than the defined threshold.
 
         """
+        html, new_cache = self._cached_convert(artifact, field_name)
+        if new_cache:
+            self._set_cache(artifact, field_name + '_cache', new_cache)
+            try:
+                sess = session(artifact)
+            except AttributeError:
+                # this can happen if a non-artifact object is used
+                log.exception('Could not get session for %s', artifact)
+            else:
+                with utils.skip_mod_date(artifact.__class__), \
+                     utils.skip_last_updated(artifact.__class__):
+                    sess.flush(artifact)
+        return html
+
+    def cached_convert_many(self, artifacts, field_name):
+        """Like :meth:`cached_convert` for a list of artifacts (e.g. the posts
+        of a thread), returning a list of their html.
+
+        The shortlinks of all the artifacts are looked up together, and the
+        updated caches of unmodified artifacts are saved with one write per
+        collection.
+
+        """
+        artifacts = list(artifacts)
+        sources = [getattr(a, field_name) for a in artifacts]
+        md5s = [hashlib.md5(source.encode('utf-8')).hexdigest() for source in sources]
+        cache_field_name = field_name + '_cache'
+        ext = self.shortlink_extension
+        if ext:
+            ext.prefetch_shortlinks([
+                source for a, source, md5 in zip(artifacts, sources, md5s)
+                if not self._valid_cache(getattr(a, cache_field_name, None), md5)])
+        result = []
+        updated = []
+        for artifact, md5 in zip(artifacts, md5s):
+            html, new_cache = self._cached_convert(artifact, field_name, md5)
+            self.reset()
+            result.append(html)
+            if not new_cache:
+                continue
+            if self._is_clean(artifact):
+                updated.append((artifact, new_cache))
+            else:
+                # saved along with the artifact's other changes when the session is flushed
+                self._set_cache(artifact, cache_field_name, new_cache)
+        if updated:
+            self._save_caches(updated, cache_field_name)
+        return result
+
+    def _valid_cache(self, cache, md5):
+        return bool(cache) and cache.md5 is not None and cache.md5 == md5 and \
+            getattr(cache, 'fix7528', False) == self.cache_bugfix_rev
+
+    def _cached_convert(self, artifact, field_name, md5=None):
+        """:returns: the html of ``artifact.field_name``, and the new fields of its cache (or None)"""
         source_text = getattr(artifact, field_name)
-        # Check if contents macro and never cache
+        # Check if contents macro and never cache here (the MarkdownCache handles macros)
         if "[[" in source_text:
-            return self.convert(source_text)
+            return self.convert(source_text), None
         cache_field_name = field_name + '_cache'
         cache = getattr(artifact, cache_field_name, None)
         if not cache:
             log.warn(
                 'Skipping Markdown caching - Missing cache field "%s" on class %s',
                 field_name, artifact.__class__.__name__)
-            return self.convert(source_text)
+            return self.convert(source_text), None
 
-        bugfix_rev = 4  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
-        md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
-            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
-                return Markup(cache.html)
+            if md5 is None:
+                md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+            if self._valid_cache(cache, md5):
+                return Markup(cache.html), None
 
         # Convert the markdown and time the result.
         start = time.time()
@@ -136,19 +223,40 @@ def cached_convert(self, artifact, field_name):
             # Save the cache
             if md5 is None:
                 md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            cache.md5, cache.html, cache.render_time = md5, html, render_time
-            cache.fix7528 = bugfix_rev  # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+            return html, dict(md5=md5, html=html, render_time=render_time,
+                              # flag to indicate good caches created after [#7528] and other critical bugs were fixed.
+                              fix7528=self.cache_bugfix_rev)
+        return html, None
+
+    def _set_cache(self, artifact, cache_field_name, new_cache):
+        cache = getattr(artifact, cache_field_name)
+        for k, v in six.iteritems(new_cache):
+            setattr(cache, k, v)
 
+    def _is_clean(self, artifact):
+        try:
+            return state(artifact).status == ObjectState.clean
+        except AttributeError:
+            return False
+
+    def _save_caches(self, updated, cache_field_name):
+        """Write the new cache fields of (artifact, new_cache) pairs straight to the
+        artifacts' collections, with a bulk write per collection.  The artifacts
+        themselves aren't changed, so they aren't saved again (with a new mod_date)
+        when the session is flushed."""
+        by_collection = defaultdict(list)
+        for artifact, new_cache in updated:
             try:
-                sess = session(artifact)
-            except AttributeError:
+                collection = mapper(artifact).collection.m.collection
+            except Exception:
                 # this can happen if a non-artifact object is used
-                log.exception('Could not get session for %s', artifact)
+                log.exception('Could not get collection for %s', artifact)
             else:
-                with utils.skip_mod_date(artifact.__class__), \
-                     utils.skip_last_updated(artifact.__class__):
-                    sess.flush(artifact)
-        return html
+                by_collection[collection].append((artifact, new_cache))
+        for collection, group in six.iteritems(by_collection):
+            collection.bulk_write([
+                pymongo.UpdateOne({'_id': artifact._id}, {'$set': {cache_field_name: new_cache}})
+                for artifact, new_cache in group], ordered=False)
 
 
 class Globals(object):
@@ -443,9 +551,10 @@ def highlight(self, text, lexer=None, filename=None):
         else:
             return Markup(pygments.highlight(text, lexer, formatter))
 
-    def forge_markdown(self, **kwargs):
+    def forge_markdown(self, cache_name=None, **kwargs):
         '''return a markdown.Markdown object on which you can call convert'''
         return ForgeMarkdown(
+            cache_name=cache_name,
             extensions=['markdown.extensions.fenced_code', 'markdown.extensions.codehilite',
                         'markdown.extensions.extra',  # to allow markdown inside HTML tags
                         ForgeExtension(**kwargs), EmojiExtension(), UserMentionExtension(),
@@ -455,16 +564,16 @@ def forge_markdown(self, **kwargs):
 
     @property
     def markdown(self):
-        return self.forge_markdown()
+        return self.forge_markdown(cache_name='markdown')
 
     @property
     def markdown_wiki(self):
         if c.project and c.project.is_nbhd_project:
-            return self.forge_markdown(wiki=True, macro_context='neighborhood-wiki')
+            return self.forge_markdown(cache_name='markdown_wiki', wiki=True, macro_context='neighborhood-wiki')
         elif c.project and c.project.is_user_project:
-            return self.forge_markdown(wiki=True, macro_context='userproject-wiki')
+            return self.forge_markdown(cache_name='markdown_wiki', wiki=True, macro_context='userproject-wiki')
         else:
-            return self.forge_markdown(wiki=True)
+            return self.forge_markdown(cache_name='markdown_wiki', wiki=True)
 
     @property
     def markdown_commit(self):
@@ -473,7 +582,7 @@ def markdown_commit(self):
         """
         app = getattr(c, 'app', None)
         return ForgeMarkdown(extensions=[CommitMessageExtension(app), EmojiExtension(), 'markdown.extensions.nl2br'],
-                             output_format='html4')
+                             output_format='html4', cache_name='markdown_commit')
 
     @property
     def production_mode(self):
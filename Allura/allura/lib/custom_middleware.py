@@ -37,6 +37,10 @@
 from allura.lib.utils import is_ajax
 from allura import model as M
 import allura.model.repository
+import allura.model.index
+import allura.model.project
+import allura.lib.security
+import allura.lib.markdown_cache
 from six.moves import range
 
 log = logging.getLogger(__name__)
@@ -327,6 +331,7 @@ def timers(self):
             Timer('jinja', jinja2.Template, 'render', 'stream', 'generate'),
             Timer('jinja.compile', jinja2.Environment, 'compile'),
             Timer('markdown', markdown.Markdown, 'convert'),
+            Timer('markdown.cache_{method_name}', allura.lib.markdown_cache.cache_counter, 'hit', 'miss'),
             Timer('ming', ming.odm.odmsession.ODMCursor, 'next',  # FIXME: this may captures timings ok, but is misleading for counts
                   debug_each_call=False),
             Timer('ming', ming.odm.odmsession.ODMSession,
@@ -351,6 +356,9 @@ def timers(self):
             Timer('repo.LastCommit.{method_name}',
                   allura.model.repository.LastCommit, '*'),
             Timer('repo.Tree.{method_name}', allura.model.repository.Tree, '*'),
+            Timer('repo.lcd_cache_{method_name}', allura.model.repository.lcd_cache_counter, 'hit', 'miss'),
+            Timer('security.role_cache_{method_name}', allura.lib.security.role_cache_counter, 'hit', 'miss'),
+            Timer('shortlink.{method_name}', allura.model.index.ShortlinkCache, 'hit', 'miss'),
             Timer('socket_read', socket._fileobject if six.PY2 else socket.SocketIO, 'read', 'readline',
                   'readlines', debug_each_call=False),
             Timer('socket_write', socket._fileobject if six.PY2 else socket.SocketIO, 'write', 'writelines',
@@ -364,6 +372,7 @@ def timers(self):
             Timer('difflib', difflib, '_mdiff', 'unified_diff'),
             Timer('logging', logging.Logger, '_log', debug_each_call=False),
             Timer('navbar', M.Project, 'nav_data', 'grouped_navbar_entries'),
+            Timer('navbar.nav_cache_{method_name}', allura.model.project.nav_cache_counter, 'hit', 'miss'),
         ] + [Timer('sidebar', ep.load(), 'sidebar_menu') for ep in tool_entry_points]
 
         try:
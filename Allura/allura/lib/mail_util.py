@@ -17,16 +17,24 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import os
 import re
+import atexit
 import logging
+import tempfile
 import smtplib
+import threading
+import time
 import email.parser
+from collections import OrderedDict
 from six.moves.email_mime_multipart import MIMEMultipart
 from six.moves.email_mime_text import MIMEText
 from email import header
 
 import six
 import tg
+from bson import ObjectId
+from gridfs import GridFS
 from paste.deploy.converters import asbool, asint, aslist
 from formencode import validators as fev
 from tg import tmpl_context as c
@@ -36,6 +44,7 @@
 from allura.lib import exceptions as exc
 from allura.lib import helpers as h
 from six.moves import map
+from six.moves import queue
 
 log = logging.getLogger(__name__)
 
@@ -190,6 +199,45 @@ def identify_sender(peer, email_address, headers, msg):
     return M.User.anonymous()
 
 
+def _spool_fs():
+    from allura import model as M
+    return GridFS(M.session.main_doc_session.db, 'inbound_email')
+
+
+def spool_message(data):
+    '''
+    Keep a message received by the inbound mail server until a
+    :func:`route_email <allura.tasks.mail_tasks.route_email>` task handles it,
+    so that the task doesn't have to hold it: in a file in forgemail.spool_dir
+    if it's set, or else in GridFS.
+
+    :param bytes data: the message
+    :returns: a reference to the message, to pass to :func:`read_spooled_message`
+    '''
+    spool_dir = tg.config.get('forgemail.spool_dir')
+    if spool_dir:
+        fd, path = tempfile.mkstemp(suffix='.eml', dir=os.path.abspath(spool_dir))
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return path
+    return str(_spool_fs().put(data, filename='inbound.eml'))
+
+
+def read_spooled_message(spool):
+    ''':returns: the bytes of a message from :func:`spool_message`'''
+    if os.path.isabs(spool):
+        with open(spool, 'rb') as fp:
+            return fp.read()
+    return _spool_fs().get(ObjectId(spool)).read()
+
+
+def remove_spooled_message(spool):
+    if os.path.isabs(spool):
+        os.remove(spool)
+    else:
+        _spool_fs().delete(ObjectId(spool))
+
+
 # http://www.jebriggs.com/blog/2010/07/smtp-maximum-line-lengths/
 MAX_MAIL_LINE_OCTETS = 990
 
@@ -259,9 +307,22 @@ def isvalid(addr):
 
 
 class SMTPClient(object):
+    '''
+    Sends email through the server in the smtp_* settings.
+
+    By default each message is sent straight away, on one connection per
+    process, which is reconnected after an error.  With smtp_senders set,
+    messages are put in an :class:`OutboundMailQueue` instead, to be sent by
+    that many threads in the background.  A
+    :func:`allura.tasks.mail_tasks.send_raw_mail` task is posted for each
+    message the queue couldn't send, so it's kept (and can be retried) rather
+    than lost.
+    '''
 
     def __init__(self):
         self._client = None
+        self._outbound = None
+        self._outbound_lock = threading.Lock()
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
@@ -298,19 +359,71 @@ def sendmail(
             log.warning('No valid addrs in %s, so not sending mail',
                         list(map(six.text_type, addrs)))
             return
+        outbound = self.outbound()
+        if outbound:
+            outbound.put(config.return_path, smtp_addrs, content)
+            self.post_failed()
+            return
+        self.send_now(config.return_path, smtp_addrs, content)
+
+    def send_now(self, return_path, addrs, content):
+        '''Sends a message straight away, on this process's connection'''
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            self._client.sendmail(return_path, addrs, content)
         except Exception:
             self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            self._client.sendmail(return_path, addrs, content)
+
+    def outbound(self):
+        ''':returns: the process's :class:`OutboundMailQueue`, or None if smtp_senders isn't set'''
+        senders = asint(tg.config.get('smtp_senders', 0))
+        if not senders:
+            return None
+        with self._outbound_lock:
+            if self._outbound is None:
+                self._outbound = OutboundMailQueue(
+                    self._new_connection,
+                    senders=senders,
+                    maxsize=asint(tg.config.get('smtp_queue_size', 1000)),
+                    max_recipients=asint(tg.config.get('smtp_max_recipients', 100)),
+                    stats_interval=asint(tg.config.get('smtp_stats_interval', 60)))
+                # send what's queued before the process exits
+                atexit.register(self.flush, timeout=asint(tg.config.get('smtp_timeout', 10)))
+            return self._outbound
+
+    def flush(self, timeout=None):
+        '''
+        Waits up to timeout seconds for the queued messages to be sent, then posts a
+        task for each one that couldn't be sent, or is still waiting.
+
+        :returns: whether every queued message was sent
+        '''
+        if self._outbound is None:
+            return True
+        sent = self._outbound.flush(timeout)
+        failed = self.post_failed(waiting=True)
+        return sent and not failed
+
+    def post_failed(self, waiting=False):
+        '''
+        Posts a :func:`allura.tasks.mail_tasks.send_raw_mail` task for each message
+        the queue couldn't send, and also for each one still waiting if ``waiting``
+
+        :returns: the number of tasks posted
+        '''
+        from allura.tasks import mail_tasks
+        messages = self._outbound.take_failed(waiting=waiting)
+        for return_path, addrs, content in messages:
+            try:
+                mail_tasks.send_raw_mail.post(return_path, addrs, content)
+            except Exception:
+                log.exception('Error posting a task to send mail to %s, so it is lost', addrs)
+        return len(messages)
 
     def _connect(self):
+        self._client = self._new_connection()
+
+    def _new_connection(self):
         if asbool(tg.config.get('smtp_ssl', False)):
             smtp_client = smtplib.SMTP_SSL(
                 tg.config.get('smtp_server', 'localhost'),
@@ -328,4 +441,187 @@ def _connect(self):
                               tg.config['smtp_password'])
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
-        self._client = smtp_client
+        return smtp_client
+
+
+class MailStats(object):
+    '''Counts of the mail sent by an :class:`OutboundMailQueue`, for its throughput'''
+
+    fields = ['queued', 'messages', 'transactions', 'recipients', 'bytes', 'failures', 'connections']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.send_time = 0.0
+        self.counts = dict((field, 0) for field in self.fields)
+
+    def add(self, send_time=0.0, **counts):
+        with self.lock:
+            self.send_time += send_time
+            for field, count in six.iteritems(counts):
+                self.counts[field] += count
+
+    def snapshot(self):
+        ''':returns: a dict of the counts, and the messages sent per second since the queue started'''
+        with self.lock:
+            stats = dict(self.counts, send_time=round(self.send_time, 3))
+        elapsed = time.time() - self.started
+        stats['messages_per_second'] = round(stats['messages'] / elapsed, 1) if elapsed else 0.0
+        return stats
+
+
+class OutboundMailQueue(object):
+    '''
+    Messages waiting to be sent by ``senders`` threads, each with its own
+    connection to the SMTP server (so there are at most ``senders``
+    connections), which is reconnected after an error.
+
+    A sender takes every message waiting in the queue, up to ``batch_size``,
+    and sends the messages with the same content as one message to all of
+    their recipients, ``max_recipients`` at a time.  :meth:`put` blocks while
+    there are ``maxsize`` messages waiting.
+
+    Messages that can't be sent, even after reconnecting, are logged and kept
+    for :meth:`take_failed`, since the task that sent them has already
+    finished.  Only the messages sent to all their recipients are counted as
+    sent in :attr:`stats`.
+    '''
+
+    def __init__(self, connect, senders=1, maxsize=1000, max_recipients=100, batch_size=100, stats_interval=60):
+        '''
+        :param connect: returns a new :class:`smtplib.SMTP` connection
+        '''
+        self.connect = connect
+        self.max_recipients = max_recipients
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.last_logged = time.time()
+        self.queue = queue.Queue(maxsize)
+        self.failed = queue.Queue()
+        self.stats = MailStats()
+        self.threads = []
+        for i in range(senders):
+            thread = threading.Thread(target=self._run, name='smtp-sender-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, return_path, addrs, content):
+        self.queue.put((return_path, list(addrs), content))
+        self.stats.add(queued=1)
+
+    def flush(self, timeout=None):
+        ''':returns: whether every message put in the queue was sent (or dropped) within timeout seconds'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def take_failed(self, waiting=False):
+        '''
+        :returns: the (return_path, addrs, content) of each message that couldn't be
+            sent, and then of each message still waiting to be sent if ``waiting``,
+            taking them out of the queue
+        '''
+        messages = []
+        sources = [self.failed, self.queue] if waiting else [self.failed]
+        for source in sources:
+            while True:
+                try:
+                    messages.append(source.get_nowait())
+                except queue.Empty:
+                    break
+                if source is self.queue:
+                    self.queue.task_done()
+        return messages
+
+    def _take(self):
+        ''':returns: the messages waiting in the queue, up to batch_size, after waiting for the first one'''
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _transactions(self, batch):
+        ''':returns: the (return_path, addrs, content) to send for a batch, with the same content sent together'''
+        recipients = OrderedDict()
+        for return_path, addrs, content in batch:
+            recipients.setdefault((return_path, content), OrderedDict()).update((addr, None) for addr in addrs)
+        for (return_path, content), addrs in six.iteritems(recipients):
+            addrs = list(addrs)
+            for i in range(0, len(addrs), self.max_recipients):
+                yield return_path, addrs[i:i + self.max_recipients], content
+
+    def _run(self):
+        client = None
+        while True:
+            batch = self._take()
+            failed = {}
+            try:
+                for return_path, addrs, content in self._transactions(batch):
+                    try:
+                        client = self._send(client, return_path, addrs, content)
+                    except Exception:
+                        client = None
+                        failed.setdefault((return_path, content), set()).update(addrs)
+                        self.failed.put((return_path, addrs, content))
+                sent = [addrs for return_path, addrs, content in batch
+                        if not failed.get((return_path, content), set()).intersection(addrs)]
+                self.stats.add(messages=len(sent))
+            except Exception:
+                log.exception('Error sending mail')
+            finally:
+                for message in batch:
+                    self.queue.task_done()
+                self._log_stats()
+
+    def _send(self, client, return_path, addrs, content):
+        '''
+        :returns: the connection to send the next message with
+        :raises: the error, after closing the connection, if the message can't be
+            sent even after reconnecting
+        '''
+        start = time.time()
+        try:
+            if client is None:
+                client = self._new_client()
+            try:
+                client.sendmail(return_path, addrs, content)
+            except Exception:
+                # the server may have closed the connection while it was idle
+                self._close(client)
+                client = self._new_client()
+                client.sendmail(return_path, addrs, content)
+        except Exception:
+            log.exception('Error sending mail to %s', addrs)
+            self.stats.add(time.time() - start, failures=1)
+            self._close(client)
+            raise
+        self.stats.add(time.time() - start, transactions=1, recipients=len(addrs), bytes=len(content))
+        return client
+
+    def _new_client(self):
+        client = self.connect()
+        self.stats.add(connections=1)
+        return client
+
+    def _close(self, client):
+        try:
+            if client is not None:
+                client.close()
+        except Exception:
+            pass
+
+    def _log_stats(self):
+        now = time.time()
+        if self.stats_interval and now - self.last_logged >= self.stats_interval:
+            self.last_logged = now
+            log.info('Outbound mail: %s, %d waiting, %d failed', self.stats.snapshot(), self.queue.qsize(),
+                     self.failed.qsize())
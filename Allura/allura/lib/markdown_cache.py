@@ -0,0 +1,244 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""Rendered markdown, cached across requests by a hash of its source.  See :class:`MarkdownCache`"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import logging
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from tg import config
+from tg import tmpl_context as c
+from paste.deploy.converters import asint, aslist
+from markupsafe import Markup
+import six
+
+from allura.lib import macro
+from allura.lib.utils import LRUCache, CacheCounter
+
+log = logging.getLogger(__name__)
+
+# increment this if all cached html needs to be invalidated (e.g. a fix to the markdown extensions)
+BUGFIX_REV = 1
+
+
+# hits & misses of the MarkdownCache
+cache_counter = CacheCounter()
+
+
+class LRUBackend(object):
+    '''Keeps up to markdown_cache.lru_size entries in each process'''
+
+    def __init__(self):
+        self.entries = LRUCache(asint(config.get('markdown_cache.lru_size', 10000)))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, (time.time() + ttl, value))
+
+
+class MemcachedBackend(object):
+    '''Uses the memcached server at memcached_host'''
+
+    def __init__(self):
+        import pylibmc
+        self.client = pylibmc.Client([config['memcached_host']])
+
+    def get(self, key):
+        return self.client.get(str(key))
+
+    def set(self, key, value, ttl):
+        self.client.set(str(key), value, time=ttl)
+
+
+class MongoBackend(object):
+    '''Uses the markdown_cache collection.  Give its ``expires`` field a TTL index to remove expired entries.'''
+
+    @property
+    def collection(self):
+        from allura import model as M
+        return M.session.main_doc_session.db.markdown_cache
+
+    def get(self, key):
+        doc = self.collection.find_one({'_id': key, 'expires': {'$gt': datetime.utcnow()}})
+        return doc['value'] if doc else None
+
+    def set(self, key, value, ttl):
+        expires = datetime.utcnow() + timedelta(seconds=ttl)
+        self.collection.update_one({'_id': key}, {'$set': {'value': value, 'expires': expires}}, upsert=True)
+
+
+class MacroOutputs(OrderedDict):
+    '''The output of each macro in a markdown text, rendered as they're first looked up'''
+
+    def __init__(self, cache, ext, outputs=()):
+        super(MacroOutputs, self).__init__(outputs)
+        self.cache = cache
+        self.ext = ext
+
+    def __missing__(self, text):
+        html = self[text] = self.cache.macro(self.ext, text)
+        return html
+
+    def digest(self):
+        md5 = hashlib.md5()
+        for text, html in six.iteritems(self):
+            md5.update(('%s\0%s\0' % (text, html)).encode('utf-8'))
+        return md5.hexdigest()
+
+
+class MarkdownCache(object):
+    '''
+    Html rendered by :class:`allura.lib.app_globals.ForgeMarkdown` converters
+    with a cache_name (``g.markdown``, ``g.markdown_wiki`` and
+    ``g.markdown_commit``), stored in a pluggable backend for
+    markdown_cache.ttl seconds.
+
+    Entries are keyed by a hash of the source, the converter and the current
+    project & tool, since links are resolved relative to those, and by the
+    project's shortlink generation (see
+    :func:`allura.model.index.bump_shortlink_generations`).  So an entry isn't
+    used once an artifact in the project is created, renamed, deleted or e.g.
+    closed, since links to it render differently.  Links to other projects'
+    artifacts and user mentions aren't tracked, and are updated when the entry
+    expires.
+
+    Text with macros is cached too.  Macros are rendered every time, since
+    they depend on the user and the state of the project, and the cached
+    html is used if their output hasn't changed.  The output of the macros
+    named in markdown_cache.macros is also cached, per user, for
+    markdown_cache.macro_ttl seconds.
+    '''
+
+    backends = {
+        'lru': LRUBackend,
+        'memcached': MemcachedBackend,
+        'mongo': MongoBackend,
+    }
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, backend, ttl, macro_ttl=0, macros=()):
+        self.backend = backend
+        self.ttl = ttl
+        self.macro_ttl = macro_ttl
+        self.macros = set(macros)
+        self.config_settings = None
+
+    @classmethod
+    def settings(cls):
+        return tuple(config.get('markdown_cache.' + name) for name in
+                     ('backend', 'lru_size', 'ttl', 'macro_ttl', 'macros'))
+
+    @classmethod
+    def from_config(cls):
+        '''
+        :returns: the process's :class:`MarkdownCache`, or None if markdown_cache.backend isn't set
+        '''
+        settings = cls.settings()
+        if not settings[0]:
+            return None
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.config_settings != settings:
+                backend = cls.backends[settings[0]]()
+                cls._instance = cls(backend,
+                                    ttl=asint(config.get('markdown_cache.ttl', 3600)),
+                                    macro_ttl=asint(config.get('markdown_cache.macro_ttl', 0)),
+                                    macros=aslist(config.get('markdown_cache.macros')))
+                cls._instance.config_settings = settings
+            return cls._instance
+
+    def _key(self, kind, *parts):
+        text = '\0'.join(six.text_type(part) for part in parts)
+        return '%s:%s' % (kind, hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+    def _context(self):
+        from allura.model.index import ShortlinkCache
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        project_id = getattr(project, '_id', None)
+        generation = ShortlinkCache.get().generation(project_id) if project_id else None
+        return (project_id, app.config._id if app else None, generation)
+
+    def _get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception:
+            log.exception('Error reading markdown cache')
+            return None
+
+    def _set(self, key, value, ttl):
+        try:
+            self.backend.set(key, value, ttl)
+        except Exception:
+            log.exception('Error writing markdown cache')
+
+    def convert(self, md, source):
+        '''
+        :param md: a :class:`allura.lib.app_globals.ForgeMarkdown`
+        :returns: the html of source, from the cache if possible
+        '''
+        ext = md.forge_extension
+        ext_settings = (ext._use_wiki, ext._is_email, ext._macro_context) if ext else None
+        key = self._key('md', BUGFIX_REV, md.cache_name, ext_settings, self._context(), source)
+        entry = self._get(key)
+        outputs = MacroOutputs(self, ext)
+        if entry is not None:
+            for text in entry['macros']:
+                outputs[text]  # render the macros, to check whether their output has changed
+            if outputs.digest() == entry['digest']:
+                cache_counter.hit()
+                return Markup(entry['html']) if entry['markup'] else entry['html']
+        cache_counter.miss()
+        if ext:
+            ext.macro_outputs = outputs
+        try:
+            html = md.convert_uncached(source)
+        finally:
+            if ext:
+                ext.macro_outputs = None
+        entry = dict(macros=list(outputs), digest=outputs.digest(), html=six.text_type(html),
+                     markup=isinstance(html, Markup))
+        self._set(key, entry, self.ttl)
+        return html
+
+    def macro(self, ext, text):
+        ''':returns: the output of a macro, from the cache if it's one of markdown_cache.macros'''
+        parse = macro.parse(ext._macro_context)
+        name = text.split(None, 1)[0] if text.strip() else None
+        if not (self.macro_ttl and name in self.macros):
+            return parse(text)
+        user = getattr(c, 'user', None)
+        key = self._key('macro', BUGFIX_REV, ext._macro_context, self._context(), getattr(user, '_id', None), text)
+        html = self._get(key)
+        if html is None:
+            html = six.text_type(parse(text))
+            self._set(key, html, self.macro_ttl)
+        return html
@@ -21,6 +21,7 @@
 from __future__ import absolute_import
 import re
 import logging
+from itertools import chain
 
 from six.moves.urllib.parse import urljoin
 
@@ -43,9 +44,32 @@
 
 
 MACRO_PATTERN = r'\[\[([^\]\[]+)\]\]'
+# what ForgeLinkPattern may look up as shortlinks: the text of [links] and the href of [text](links)
+SHORTLINK_TEXT_RE = re.compile(r'\[([^\]\[]+)\]')
+LINK_HREF_RE = re.compile(r'\]\(\s*<?([^)\s>]+)')
 
 
-class CommitMessageExtension(markdown.Extension):
+class ShortlinkExtension(markdown.Extension):
+
+    """Base class for the extensions whose :class:`ForgeLinkPattern` looks up
+    shortlinks, so their sources can be prefetched."""
+
+    def prefetch_shortlinks(self, sources):
+        '''Look up every link that the markdown sources may contain with one query,
+        instead of one per link as they're rendered.  They're kept in the
+        request's :class:`allura.model.index.ShortlinkCache`'''
+        links = set()
+        for source in sources:
+            for link in chain(SHORTLINK_TEXT_RE.findall(source), LINK_HREF_RE.findall(source)):
+                links.add(link)
+                attach_link = link.split('/attachment/')
+                if len(attach_link) == 2 and self._use_wiki:
+                    links.add(attach_link[0])
+        if links:
+            M.Shortlink.from_links(*links)
+
+
+class CommitMessageExtension(ShortlinkExtension):
 
     """Markdown extension for processing commit messages.
 
@@ -239,13 +263,15 @@ def run(self, lines):
         return new_lines
 
 
-class ForgeExtension(markdown.Extension):
+class ForgeExtension(ShortlinkExtension):
 
     def __init__(self, wiki=False, email=False, macro_context=None):
         markdown.Extension.__init__(self)
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        # set by :class:`allura.lib.markdown_cache.MarkdownCache` to record (or reuse) the output of each macro
+        self.macro_outputs = None
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -407,7 +433,10 @@ def __init__(self, *args, **kwargs):
         markdown.inlinepatterns.Pattern.__init__(self, *args, **kwargs)
 
     def handleMatch(self, m):
-        html = self.macro(m.group(2))
+        if self.ext.macro_outputs is None:
+            html = self.macro(m.group(2))
+        else:
+            html = self.ext.macro_outputs[m.group(2)]
         placeholder = self.markdown.htmlStash.store(html)
         return placeholder
 
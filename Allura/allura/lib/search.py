@@ -92,8 +92,11 @@ def should_update_index(self, old_doc, new_doc):
         """
         return old_doc != new_doc
 
-    def solarize(self):
-        doc = self.index()
+    def solarize(self, doc=None):
+        '''Build the document to send to solr from :meth:`index` (or ``doc``, if
+        you already have the result of it).'''
+        if doc is None:
+            doc = self.index()
         if doc is None:
             return None
         # if index() returned doc without text, assume empty text
@@ -157,23 +160,58 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
 
     Raises SearchError if SOLR returns an error.
     """
+    params = _artifact_search_params(atype, history, filter, kw.pop('fq', []))
+    if params is None:
+        return  # if there are no instance of atype, we won't find anything
+    translate, fq = params
+    return search(translate(q), fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+
+
+def count_artifacts(atype, queries, history=False, short_timeout=False, filter=None, **kw):
+    """Counts the artifacts matching each of the queries, with a single SOLR
+    search (one ``facet.query`` per query).  Queries are translated like
+    :func:`search_artifact` does.
+
+    :returns: a list of counts, in the same order as queries
+    Raises SearchError if SOLR returns an error.
+    """
+    params = _artifact_search_params(atype, history, filter, kw.pop('fq', []))
+    if params is None or not queries:
+        return [0] * len(queries)
+    translate, fq = params
+    facet_queries = [inject_user(translate(q)) for q in queries]
+    r = search('*:*', fq=fq, rows=0, short_timeout=short_timeout, ignore_errors=False,
+               **dict(kw, **{'facet': 'true', 'facet.query': facet_queries}))
+    counts = (r.facets or {}).get('facet_queries', {}) if r is not None else {}
+    return [counts.get(q, 0) for q in facet_queries]
+
+
+def _artifact_search_params(atype, history, filter, fq):
+    """
+    :returns: (translate, fq) for searching artifacts of atype: a function to
+        translate queries to atype's indexed fields, and the filter queries.
+        None if there are no artifacts of atype.
+    """
     # first, grab an artifact and get the fields that it indexes
     a = atype.query.find().first()
     if a is None:
-        return  # if there are no instance of atype, we won't find anything
+        return None
     fields = a.index()
-    fq = ['type_s:%s' % fields['type_s']]
+    filter_queries = ['type_s:%s' % fields['type_s']]
     # Now, we'll translate all the fld:
     if c.app is not None:
-        q = atype.translate_query(q, fields)
-        fq.append('mount_point_s:%s' % c.app.config.options.mount_point)
+        filter_queries.append('mount_point_s:%s' % c.app.config.options.mount_point)
+
+        def translate(q):
+            return atype.translate_query(q, fields)
     else:
-        q = SearchIndexable.translate_query(q, fields)
+        def translate(q):
+            return SearchIndexable.translate_query(q, fields)
 
     if c.project is not None:
-        fq.append('project_id_s:%s' % c.project._id)
+        filter_queries.append('project_id_s:%s' % c.project._id)
 
-    fq += kw.pop('fq', [])
+    fq = filter_queries + list(fq)
     if isinstance(filter, six.string_types):  # may be stringified after a ticket filter, then bulk edit
         filter = ast.literal_eval(filter)
     for name, values in six.iteritems((filter or {})):
@@ -189,7 +227,7 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, filte
         fq.append(' OR '.join(parts))
     if not history:
         fq.append('is_history_b:False')
-    return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+    return translate, fq
 
 
 def site_admin_search(model, q, field, **kw):
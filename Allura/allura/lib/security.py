@@ -33,7 +33,7 @@
 from ming.utils import LazyProperty
 import tg
 
-from allura.lib.utils import TruthyCallable
+from allura.lib.utils import TruthyCallable, LRUCache, CacheCounter
 
 log = logging.getLogger(__name__)
 
@@ -64,10 +64,49 @@ def get(cls):
         import allura
         return allura.credentials
 
+    @property
+    def role_generation(self):
+        from allura import model as M
+        db = M.session.main_doc_session.db
+        return db.project_role_generation
+
     def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.generations = {}
+        self.acls = {}
+
+    def project_generations(self, project_ids):
+        '''
+        :returns: a dict of the role generation of each project, see :class:`SharedRoleCache`.
+          Looked up at most once per project per request.
+        '''
+        missing = [pid for pid in project_ids if pid not in self.generations]
+        if missing:
+            for pid in missing:
+                self.generations[pid] = 0
+            for doc in self.role_generation.find({'_id': {'$in': missing}}):
+                self.generations[doc['_id']] = doc['gen']
+        return self.generations
+
+    def compiled_acl(self, acl):
+        '''
+        :returns: a :class:`CompiledACL` for acl, shared by everything with the same ACL
+          in this request (or across requests, see :class:`SharedACLCache`)
+        '''
+        key = CompiledACL.key_for(acl)
+        compiled = self.acls.get(key)
+        if compiled is None:
+            shared = SharedACLCache.from_config()
+            if shared:
+                compiled = shared.get(key)
+            if compiled is None:
+                compiled = CompiledACL(key)
+                if shared:
+                    shared.set(key, compiled)
+            self.acls[key] = compiled
+        return compiled
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -86,6 +125,20 @@ def load_user_roles(self, user_id, *project_ids):
             pid for pid in project_ids if self.users.get((user_id, pid)) is None]
         if not project_ids:
             return
+        shared = SharedRoleCache.from_config()
+        if shared:
+            # the generations must be read before the roles, or roles loaded
+            # just before a change could be cached with the new generation
+            generations = self.project_generations(project_ids)
+            for pid in list(project_ids):
+                entry = shared.get((user_id, pid), generations[pid])
+                if entry is not None:
+                    roles, reaching_roles = entry
+                    self.users[user_id, pid] = RoleCache(self, roles)
+                    self.users[user_id, pid].__dict__['reaching_roles'] = RoleCache(self, reaching_roles)
+                    project_ids.remove(pid)
+            if not project_ids:
+                return
         if user_id is None:
             q = self.project_role.find({
                 'user_id': None,
@@ -106,6 +159,43 @@ def load_user_roles(self, user_id, *project_ids):
             roles_by_project[role['project_id']].append(role)
         for pid, roles in six.iteritems(roles_by_project):
             self.users[user_id, pid] = RoleCache(self, roles)
+            if shared:
+                reaching_roles = list(self.users[user_id, pid].reaching_roles)
+                shared.set((user_id, pid), generations[pid], (roles, reaching_roles))
+
+    def load_users_roles(self, project_id, user_ids):
+        '''
+        Load the credentials of many users in one project, e.g. all the recipients of a notification.
+        The roles of all of them are found with one query, and the roles they reach with another,
+        instead of two queries for each user.
+        '''
+        user_ids = [uid for uid in set(user_ids)
+                    if uid is not None and self.users.get((uid, project_id)) is None]
+        if not user_ids:
+            return
+        named_roles = dict((r['_id'], r) for r in self.project_role.find({
+            'project_id': project_id,
+            'user_id': None}))
+        base_roles = [r for r in six.itervalues(named_roles) if r.get('name') in ('*anonymous', '*authenticated')]
+        roles_by_user = dict((uid, list(base_roles)) for uid in user_ids)
+        for role in self.project_role.find({
+                'user_id': {'$in': user_ids},
+                'project_id': project_id,
+                'name': None}):
+            roles_by_user[role['user_id']].append(role)
+        for uid, roles in six.iteritems(roles_by_user):
+            reaching_roles = []
+            to_visit = list(roles)
+            visited = set()
+            while to_visit:
+                role = to_visit.pop()
+                if role['_id'] in visited:
+                    continue
+                visited.add(role['_id'])
+                reaching_roles.append(role)
+                to_visit.extend(named_roles[rid] for rid in role.get('roles', []) if rid in named_roles)
+            self.users[uid, project_id] = RoleCache(self, roles)
+            self.users[uid, project_id].__dict__['reaching_roles'] = RoleCache(self, reaching_roles)
 
     def load_project_roles(self, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
@@ -114,6 +204,16 @@ def load_project_roles(self, *project_ids):
             pid for pid in project_ids if self.projects.get(pid) is None]
         if not project_ids:
             return
+        shared = SharedRoleCache.from_config()
+        if shared:
+            generations = self.project_generations(project_ids)
+            for pid in list(project_ids):
+                roles = shared.get(pid, generations[pid])
+                if roles is not None:
+                    self.projects[pid] = RoleCache(self, roles)
+                    project_ids.remove(pid)
+            if not project_ids:
+                return
         q = self.project_role.find({
             'project_id': {'$in': project_ids}})
         roles_by_project = dict((pid, []) for pid in project_ids)
@@ -121,6 +221,8 @@ def load_project_roles(self, *project_ids):
             roles_by_project[role['project_id']].append(role)
         for pid, roles in six.iteritems(roles_by_project):
             self.projects[pid] = RoleCache(self, roles)
+            if shared:
+                shared.set(pid, generations[pid], roles)
 
     def project_roles(self, project_id):
         '''
@@ -164,6 +266,146 @@ def userids_with_named_role(self, project_id, name):
         return role.userids_that_reach
 
 
+# hits & misses of the SharedRoleCache
+role_cache_counter = CacheCounter()
+
+
+def bump_role_generations(project_ids):
+    '''Invalidate the :class:`SharedRoleCache` entries of these projects, in every process'''
+    from allura import model as M
+    collection = M.session.main_doc_session.db.project_role_generation
+    for pid in set(project_ids):
+        collection.update_one({'_id': pid}, {'$inc': {'gen': 1}}, upsert=True)
+
+
+class SharedRoleCache(LRUCache):
+    '''
+    The project roles loaded by :class:`Credentials`, kept across requests in
+    this process, for up to max_size users & projects.
+
+    Each project has a generation number in mongo which is incremented
+    whenever any of its ProjectRoles are saved (see
+    :class:`allura.model.session.ProjectRoleSessionExtension`), which
+    includes changes to users' memberships.  Cached roles are only used while
+    their project's generation is the same as when they were loaded.
+
+    Enabled by setting auth.role_cache_size
+    '''
+    config_key = 'auth.role_cache_size'
+    _instance = None
+
+    def __init__(self, max_size):
+        super(SharedRoleCache, self).__init__(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        entry = super(SharedRoleCache, self).get(key)
+        if entry is not None and entry[0] == generation:
+            self.hits += 1
+            role_cache_counter.hit()
+            return entry[1]
+        self.misses += 1
+        role_cache_counter.miss()
+        return None
+
+    def set(self, key, generation, value):
+        super(SharedRoleCache, self).set(key, (generation, value))
+
+
+class SharedACLCache(LRUCache):
+    '''
+    :class:`CompiledACL` objects (and the decisions memoized on them), kept
+    across requests in this process for up to max_size distinct ACLs.  They
+    are keyed by the ACL's contents, so never need invalidating.
+
+    Enabled by setting auth.acl_cache_size
+    '''
+    config_key = 'auth.acl_cache_size'
+    _instance = None
+
+
+class CompiledACL(object):
+    '''
+    An ACL compiled, per permission as it's needed, into the access each role
+    gets from it.  This is what :func:`has_access` checks, rather than walking
+    the ACL for every role.
+
+    Get these with :meth:`Credentials.compiled_acl`
+    '''
+    max_decisions = 1000
+
+    def __init__(self, key):
+        '''
+        :param tuple key: from :meth:`key_for`
+        '''
+        self.key = key
+        self.permissions = {}
+        self.decisions = {}
+
+    @classmethod
+    def key_for(cls, acl):
+        return tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+
+    def _compile(self, permission):
+        from allura import model as M
+        first_match = {}
+        everyone = None
+        denied = set()
+        for access, role_id, ace_permission in self.key:
+            if ace_permission == permission and access == M.ACE.DENY:
+                denied.add(role_id)
+            if ace_permission not in (permission, M.ALL_PERMISSIONS) or everyone is not None:
+                continue
+            if role_id == M.EVERYONE:
+                # decides every role that hasn't matched an earlier ACE
+                everyone = access
+            else:
+                first_match.setdefault(role_id, access)
+        compiled = self.permissions[permission] = (first_match, everyone, denied)
+        return compiled
+
+    def _compiled(self, permission):
+        compiled = self.permissions.get(permission)
+        if compiled is None:
+            compiled = self._compile(permission)
+        return compiled
+
+    def denies(self, role_ids, permission):
+        '''
+        :returns: whether there's an explicit DENY of permission for any of role_ids
+        '''
+        denied = self._compiled(permission)[2]
+        return bool(denied) and any(rid in denied for rid in role_ids)
+
+    def check(self, role_ids, permission):
+        '''
+        :returns: True if the first ACE matching any of role_ids allows the permission,
+          or else a tuple of the role_ids with no matching ACE, to check in the parent context
+        '''
+        key = (permission, role_ids)
+        result = self.decisions.get(key)
+        if result is not None:
+            return result
+        from allura import model as M
+        first_match, everyone, denied = self._compiled(permission)
+        chainable_roles = []
+        result = None
+        for rid in role_ids:
+            access = first_match.get(rid, everyone)
+            if access == M.ACE.ALLOW:
+                result = True
+                break
+            elif access is None:
+                chainable_roles.append(rid)
+        if result is None:
+            result = tuple(chainable_roles)
+        if len(self.decisions) >= self.max_decisions:
+            self.decisions.clear()
+        self.decisions[key] = result
+        return result
+
+
 class RoleCache(object):
     '''
     An iterable collection of :class:`ProjectRoles <allura.model.auth.ProjectRole>` that is cached after first use
@@ -286,10 +528,11 @@ def has_access(obj, permission, user=None, project=None):
       user's project role, return False and deny access.  TODO: make ACL order
       matter instead of doing DENY first; see ticket [#6715]
 
-    - Next, for each role, the given object's ACL is examined linearly. If an ACE
-      is found which matches the permission and user, and that ACE ALLOWs access,
-      then the function returns True and access is permitted. If the ACE DENYs
-      access, then that role is removed from further consideration.
+    - Next, for each role, the first ACE in the given object's ACL which matches
+      the permission and role is found (using a :class:`CompiledACL`, so the ACL
+      isn't walked for each role). If that ACE ALLOWs access, then the function
+      returns True and access is permitted. If the ACE DENYs access, then that
+      role is removed from further consideration.
 
     - If the obj is not a Neighborhood and the given user has the 'admin'
       permission on the current neighborhood, then the function returns True and
@@ -339,34 +582,23 @@ def predicate(obj=obj, user=user, project=project, roles=None):
                     project = project.root_project
             roles = cred.user_roles(
                 user_id=user._id, project_id=project._id).reaching_ids
+        acl = Credentials.get().compiled_acl(obj.acl)
 
         # TODO: move deny logic into loop below; see ticket [#6715]
         if user != M.User.anonymous():
             user_roles = Credentials.get().user_roles(user_id=user._id,
                                                       project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
+            if acl.denies(user_roles.index, permission):
+                return False
 
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
+        # roles whose access is neither allowed or denied may chain to parent context
+        chainable_roles = acl.check(tuple(roles), permission)
+        if chainable_roles is True:
+            return True
         parent = obj.parent_security_context()
         if parent and chainable_roles:
             result = has_access(parent, permission, user=user, project=project)(
-                roles=tuple(chainable_roles))
+                roles=chainable_roles)
         elif not isinstance(obj, M.Neighborhood):
             result = has_access(project.neighborhood, 'admin', user=user)()
             if not (result or isinstance(obj, M.Project)):
@@ -127,6 +127,8 @@ class MockSOLR(object):
 
     class MockHits(list):
 
+        facet_queries = None
+
         @property
         def hits(self):
             return len(self)
@@ -137,7 +139,7 @@ def docs(self):
 
         @property
         def facets(self):
-            return {'facet_fields': {}}
+            return {'facet_fields': {}, 'facet_queries': self.facet_queries or {}}
 
     def __init__(self):
         self.db = {}
@@ -159,7 +161,7 @@ def search(self, q, fq=None, **kw):
         if fq:
             q_parts += fq
         for part in q_parts:
-            if part in ('&&', 'AND'):
+            if part in ('&&', 'AND', '*:*'):
                 continue
             if part in ('||', 'OR'):
                 log.warn("MockSOLR doesn't implement OR yet; treating as AND. q={} fq={}".format(q, fq))
@@ -192,6 +194,11 @@ def search(self, q, fq=None, **kw):
 
         if asbool(kw.get('hl')):
             result.highlighting = {}
+        if asbool(kw.get('facet')):
+            ids = set(obj['id'] for obj in result)
+            result.facet_queries = dict(
+                (facet_q, sum(1 for obj in self.search(facet_q, fq=fq) if obj['id'] in ids))
+                for facet_q in kw.get('facet.query', []))
         return result
 
     def delete(self, *args, **kwargs):
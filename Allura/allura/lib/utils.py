@@ -41,6 +41,7 @@
 import six.moves.urllib.error
 import types
 import socket
+import threading
 
 import tg
 import emoji
@@ -398,6 +399,69 @@ def __bool__(self):
     __nonzero__ = __bool__  # python 2
 
 
+class LRUCache(object):
+    '''
+    A thread-safe mapping of up to max_size entries, kept for the life of the
+    process.  The least recently used entries are dropped first.
+
+    Subclasses set config_key to the setting for max_size; :meth:`from_config`
+    returns None when that's 0 or unset.
+    '''
+    config_key = None
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        '''
+        :returns: the process's instance of this cache, or None if it's not enabled
+        '''
+        max_size = asint(tg.config.get(cls.config_key, 0))
+        if not max_size:
+            return None
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.max_size != max_size:
+                cls._instance = cls(max_size)
+            return cls._instance
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value  # most recently used
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CacheCounter(object):
+    '''
+    Where a cache reports its hits and misses.  :meth:`hit` and :meth:`miss` do
+    nothing, but :class:`allura.lib.custom_middleware.AlluraTimerMiddleware`
+    counts the calls to them, with a Timer for each counter.
+    '''
+
+    def hit(self):
+        pass
+
+    def miss(self):
+        pass
+
+
 class TransformedDict(collections.MutableMapping):
 
     """
@@ -18,6 +18,7 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 from formencode import validators as fev
+from tg import app_globals as g
 
 import ew as ew_core
 import ew.jinja2_ew as ew
@@ -303,6 +304,7 @@ class Post(HierWidget):
         page=0,
         limit=25,
         show_subject=False,
+        rendered_text=None,
     )
     widgets = dict(
         moderate_post=ModeratePost(),
@@ -335,7 +337,8 @@ class PostThread(ew_core.Widget):
         limit=25,
         show_subject=False,
         parent=None,
-        children=None)
+        children=None,
+        rendered_text=None)
 
 
 class Thread(HierWidget):
@@ -356,6 +359,14 @@ class Thread(HierWidget):
         post=Post(),
         edit_post=EditPost(submit_text='Submit'))
 
+    def prepare_context(self, context):
+        response = super(Thread, self).prepare_context(context)
+        posts = response['posts'] = response['value'].find_posts(page=response['page'], limit=response['limit'])
+        # render all the posts' markdown together, rather than one at a time in each post widget
+        html = g.markdown.cached_convert_many(posts, 'text')
+        response['rendered_text'] = dict((post._id, post_html) for post, post_html in zip(posts, html))
+        return response
+
     def resources(self):
         for r in super(Thread, self).resources():
             yield r
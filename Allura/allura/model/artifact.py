@@ -373,6 +373,15 @@ def link_text(self):
         """
         return self.shorthand_id()
 
+    def should_update_links(self, old_doc, new_doc):
+        """Determines if links to this artifact are rendered differently after a change,
+        so that cached markdown linking to it must be invalidated.
+
+        Values passed as old_doc and new_doc are original and modified
+        versions of same object, represented as dictionaries.
+        """
+        return False
+
     def get_discussion_thread(self, data=None):
         """Return the discussion thread and parent_id for this artifact.
 
@@ -190,8 +190,9 @@ def attachments_for_json(self, page):
         return [dict(bytes=attach.length,
                      url=h.absurl(attach.url())) for attach in page.attachments]
 
-    def __json__(self, limit=None, page=None, is_export=False):
-        return dict(
+    def __json__(self, limit=None, page=None, is_export=False, after=None):
+        posts = self.query_posts(status='ok', style='chronological', limit=limit, page=page, after=after).all()
+        json = dict(
             _id=self._id,
             discussion_id=str(self.discussion_id),
             subject=self.subject,
@@ -205,9 +206,13 @@ def __json__(self, limit=None, page=None, is_export=False):
                         timestamp=p.timestamp,
                         last_edited=p.last_edit_date,
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p))
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in posts
                    ]
         )
+        if limit:
+            # the post to start the next page after
+            json['next_after'] = posts[-1]._id if len(posts) == int(limit) else None
+        return json
 
     @property
     def activity_name(self):
@@ -405,7 +410,15 @@ def create_post_threads(self, posts):
         return result
 
     def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded', status=None):
+                    timestamp=None, style='threaded', status=None, after=None):
+        """Query the thread's posts, sorted by full_slug ('threaded' style) or by timestamp.
+
+        :param after: the ``_id`` of a post to start after, instead of skipping
+            to the page.  Deep pages of long threads are found with an index
+            that way, rather than by reading and skipping every post before
+            them.  If the post doesn't exist any more (or isn't in this
+            thread), ``page`` is used.
+        """
         if timestamp:
             terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
                          status={'$in': ['ok', 'pending']}, timestamp=timestamp)
@@ -415,22 +428,31 @@ def query_posts(self, page=None, limit=None,
         if status:
             terms['status'] = status
         terms['deleted'] = False
-        q = self.post_class().query.find(terms)
+        after_post = self.post_class().query.get(_id=after, thread_id=self._id) if after else None
         if style == 'threaded':
-            q = q.sort('full_slug')
+            sort = [('full_slug', pymongo.ASCENDING)]
+            if after_post:
+                terms['full_slug'] = {'$gt': after_post.full_slug}
         else:
-            q = q.sort('timestamp')
+            # _id breaks ties, so that no post is left out between pages
+            sort = [('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+            if after_post:
+                terms['$or'] = [
+                    {'timestamp': {'$gt': after_post.timestamp}},
+                    {'timestamp': after_post.timestamp, '_id': {'$gt': after_post._id}},
+                ]
+        q = self.post_class().query.find(terms).sort(sort)
         if limit is not None:
             limit = int(limit)
-            if page is not None:
+            if page is not None and not after_post:
                 q = q.skip(page * limit)
             q = q.limit(limit)
         return q
 
     def find_posts(self, page=None, limit=None, timestamp=None,
-                   style='threaded'):
+                   style='threaded', after=None):
         return self.query_posts(page=page, limit=limit,
-                                timestamp=timestamp, style=style).all()
+                                timestamp=timestamp, style=style, after=after).all()
 
     def url(self):
         # Can't use self.discussion because it might change during the req
@@ -504,7 +526,10 @@ class __mongometa__:
         indexes = [
             # used in general lookups, last_post, etc
             ('discussion_id', 'status', 'timestamp'),
-            'thread_id'
+            'thread_id',
+            # for paging through a thread's posts
+            ('thread_id', 'full_slug'),
+            ('thread_id', 'timestamp', '_id'),
         ]
     type_s = 'Post'
 
@@ -106,6 +106,102 @@ def artifact(self):
             log.exception('Error loading artifact for %s: %r',
                           self._id, aref)
 
+    @classmethod
+    def artifacts_by_ref_id(cls, refs):
+        '''Look up the artifacts for many references at once, with one query
+        per artifact class and project instead of one per reference.
+
+        :return: dict of reference ``_id`` to artifact (missing if not found)
+        '''
+        groups = defaultdict(list)
+        for ref in refs:
+            aref = ref.artifact_reference
+            groups[(six.binary_type(aref.cls), aref.project_id)].append(ref)
+        result = {}
+        for (cls_pickle, project_id), group in six.iteritems(groups):
+            try:
+                a_cls = loads(cls_pickle)
+                with h.push_context(project_id):
+                    artifact_ids = [ref.artifact_reference.artifact_id for ref in group]
+                    artifacts = {a._id: a for a in a_cls.query.find(dict(_id={'$in': artifact_ids}))}
+            except Exception:
+                log.exception('Error loading artifacts for %s',
+                              [ref._id for ref in group])
+                continue
+            for ref in group:
+                artifact = artifacts.get(ref.artifact_reference.artifact_id)
+                if artifact is not None:
+                    result[ref._id] = artifact
+        return result
+
+
+def bump_shortlink_generations(project_ids):
+    '''Invalidate the :class:`allura.lib.markdown_cache.MarkdownCache` entries rendered in
+    these projects, since links in them may render differently now, in every process'''
+    collection = main_doc_session.db.project_shortlink_generation
+    for pid in set(project_ids):
+        if pid is not None:
+            collection.update_one({'_id': pid}, {'$inc': {'gen': 1}}, upsert=True)
+
+
+class ShortlinkCache(object):
+    '''Shortlinks resolved in the current request (or task), keyed by the
+    project and tool they were resolved in, since that's what links are
+    relative to.  Cleared whenever shortlinks are created, changed or removed.
+
+    Also keeps the projects' shortlink generations, see :meth:`generation`.
+    '''
+
+    def __init__(self):
+        self.links = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get(cls):
+        cache = getattr(c, 'shortlink_cache', None)
+        if not isinstance(cache, cls):
+            cache = c.shortlink_cache = cls()
+        return cache
+
+    @classmethod
+    def invalidate(cls):
+        cache = cls.get()
+        cache.links.clear()
+        cache.generations.clear()
+
+    @classmethod
+    def reset(cls):
+        '''Start a new cache, so that a task or script doesn't use (or keep
+        growing) the one of whatever ran before it in the same process'''
+        c.shortlink_cache = cls()
+
+    def generation(self, project_id):
+        '''
+        :returns: a number that changes whenever shortlinks in a project are created,
+            changed or removed (see :func:`bump_shortlink_generations`), read once per request
+        '''
+        if project_id not in self.generations:
+            doc = main_doc_session.db.project_shortlink_generation.find_one({'_id': project_id})
+            self.generations[project_id] = doc['gen'] if doc else 0
+        return self.generations[project_id]
+
+    def key(self, link):
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        return (getattr(project, '_id', None), app.config._id if app else None, link)
+
+    def hit(self):
+        '''Counts a link found in the cache.
+        Also counted by :class:`allura.lib.custom_middleware.AlluraTimerMiddleware`'''
+        self.hits += 1
+
+    def miss(self):
+        '''Counts a link not in the cache.
+        Also counted by :class:`allura.lib.custom_middleware.AlluraTimerMiddleware`'''
+        self.misses += 1
+
 
 class Shortlink(object):
 
@@ -144,16 +240,50 @@ def from_artifact(cls, a):
             except pymongo.errors.DuplicateKeyError:  # pragma no cover
                 session(result).expunge(result)
                 result = cls.query.get(ref_id=a.index_id())
-        result.link = a.shorthand_id()
-        result.url = a.url()
+        link, url = a.shorthand_id(), a.url()
+        if (result.link, result.url) != (link, url):
+            bump_shortlink_generations([result.project_id])
+            ShortlinkCache.invalidate()
+        result.link = link
+        result.url = url
         if result.link is None:
             result.delete()
             return None
         return result
 
+    @classmethod
+    def remove_by_ref_ids(cls, ref_ids):
+        '''Remove the shortlinks to the artifacts with the given index_ids'''
+        query = dict(ref_id={'$in': list(ref_ids)})
+        bump_shortlink_generations([link.project_id for link in cls.query.find(query)])
+        cls.query.remove(query)
+        ShortlinkCache.invalidate()
+
     @classmethod
     def from_links(cls, *links):
-        '''Convert a sequence of shortlinks to the matching Shortlink objects'''
+        '''Convert a sequence of shortlinks to the matching Shortlink objects.
+        Links already resolved in this request come from the :class:`ShortlinkCache`,
+        the rest are resolved together and added to it.'''
+        cache = ShortlinkCache.get()
+        result = {}
+        missing = []
+        for link in set(links):
+            key = cache.key(link)
+            if key in cache.links:
+                cache.hit()
+                result[link] = cache.links[key]
+            else:
+                cache.miss()
+                missing.append(link)
+        if missing:
+            resolved = cls._resolve_links(missing)
+            for link, shortlink in six.iteritems(resolved):
+                cache.links[cache.key(link)] = shortlink
+            result.update(resolved)
+        return result
+
+    @classmethod
+    def _resolve_links(cls, links):
         if len(links):
             result = {}
             # Parse all the links
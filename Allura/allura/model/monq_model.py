@@ -26,7 +26,7 @@
 import pymongo
 from tg import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
@@ -153,19 +153,7 @@ def post(cls,
         task_name = '%s.%s' % (
             function.__module__,
             function.__name__)
-        context = dict(
-            project_id=None,
-            app_config_id=None,
-            user_id=None,
-            notifications_disabled=False)
-        if getattr(c, 'project', None):
-            context['project_id'] = c.project._id
-            context[
-                'notifications_disabled'] = c.project.notifications_disabled
-        if getattr(c, 'app', None):
-            context['app_config_id'] = c.app.config._id
-        if getattr(c, 'user', None):
-            context['user_id'] = c.user._id
+        context = cls._current_context()
         obj = cls(
             state='ready',
             priority=priority,
@@ -179,8 +167,105 @@ def post(cls,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         if flush_immediately:
             session(obj).flush(obj)
+            if delay <= 0:
+                cls.notify(obj)
         return obj
 
+    @classmethod
+    def _current_context(cls):
+        context = dict(
+            project_id=None,
+            app_config_id=None,
+            user_id=None,
+            notifications_disabled=False)
+        if getattr(c, 'project', None):
+            context['project_id'] = c.project._id
+            context[
+                'notifications_disabled'] = c.project.notifications_disabled
+        if getattr(c, 'app', None):
+            context['app_config_id'] = c.app.config._id
+        if getattr(c, 'user', None):
+            context['user_id'] = c.user._id
+        return context
+
+    @classmethod
+    def post_merged(cls, function, ids, kwargs=None, delay=0, max_ids=10000, **post_kwargs):
+        '''Post a task whose only positional argument is a list of ``ids``, or
+        add ``ids`` to an identical task (same function, kwargs, project, app)
+        that is still waiting in the queue, if there is one.
+
+        With a ``delay`` this works as a debounce: all the ids posted during the
+        delay window are handled by a single task.  The merged task keeps the
+        user context of whoever posted it first, so only use this for tasks that
+        don't depend on c.user.
+        '''
+        if kwargs is None:
+            kwargs = {}
+        task_name = '%s.%s' % (
+            function.__module__,
+            function.__name__)
+        context = cls._current_context()
+        query = {
+            'state': 'ready',
+            'task_name': task_name,
+            'kwargs': kwargs,
+            'context.project_id': context['project_id'],
+            'context.app_config_id': context['app_config_id'],
+            'context.notifications_disabled': context['notifications_disabled'],
+            # don't grow tasks without bound
+            'args.0.%d' % (max_ids - 1): {'$exists': False},
+        }
+        obj = cls.query.find_and_modify(
+            query=query,
+            update={'$addToSet': {'args.0': {'$each': list(ids)}}},
+            new=True)
+        if obj is not None:
+            return obj
+        return cls.post(function, (list(ids),), kwargs, delay=delay, **post_kwargs)
+
+    @classmethod
+    def notify_enabled(cls):
+        return asbool(config.get('monq.notify', False))
+
+    # (db name, collection name) of the notify collections known to exist, so they're only checked once per process
+    _notify_collections = set()
+
+    @classmethod
+    def notify_collection(cls):
+        '''The capped collection that :meth:`post` writes wakeup messages to and
+        idle taskd workers tail (see :class:`MonQTaskListener`).  Created on
+        first use, and only looked for once per process.'''
+        db = session(cls).impl.db
+        name = cls.__mongometa__.name + '_notify'
+        key = (db.name, name)
+        if key in cls._notify_collections:
+            return db[name]
+        if name not in db.list_collection_names():
+            try:
+                db.create_collection(
+                    name, capped=True,
+                    size=asint(config.get('monq.notify_size', 1024 * 1024)))
+                # a tailable cursor on an empty capped collection dies immediately,
+                # so make sure there is always at least one document
+                db[name].insert_one(dict(task_id=None, task_name=None))
+            except pymongo.errors.CollectionInvalid:
+                pass  # created concurrently by another process
+        cls._notify_collections.add(key)
+        return db[name]
+
+    @classmethod
+    def notify(cls, task):
+        '''Wake any idle taskd workers that are waiting for a new task.'''
+        if not cls.notify_enabled():
+            return
+        try:
+            cls.notify_collection().insert_one(dict(
+                task_id=task._id,
+                task_name=task.task_name))
+        except Exception:
+            # workers still poll every monq.poll_interval, so this is never fatal
+            log.warning('Could not send notification for task %s', task._id, exc_info=True)
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
@@ -216,6 +301,50 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_many(cls, n, process='worker', state='ready', waitfunc=None, only=None):
+        '''Like :meth:`get`, but lock up to ``n`` of the highest-priority, oldest,
+        ready tasks to the current process at once, and return them in priority
+        order.
+
+        Claimed tasks are 'busy' with no ``time_start`` until they are actually
+        run.  Tasks that are never run should be given back with :meth:`release`.
+        '''
+        while True:
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': datetime.utcnow()}
+            if only:
+                query['task_name'] = {'$in': only}
+            collection = session(cls).impl.db[cls.__mongometa__.name]
+            ids = [t['_id'] for t in collection.find(query, {'_id': 1}).sort(cls.sort).limit(n)]
+            if ids:
+                # other processes may claim some of these in the meantime, we'll just get fewer
+                cls.query.update(
+                    {'_id': {'$in': ids}, 'state': state},
+                    {'$set': dict(state='busy', process=process, time_start=None)},
+                    multi=True)
+                claimed = cls.query.find({'_id': {'$in': ids}, 'state': 'busy', 'process': process,
+                                          'time_start': None}).sort(cls.sort).all()
+                if claimed:
+                    return claimed
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def release(cls, tasks):
+        '''Set claimed tasks that haven't started yet back to 'ready', so
+        another process can run them.'''
+        ids = [t._id for t in tasks]
+        if ids:
+            cls.query.update(
+                {'_id': {'$in': ids}, 'state': 'busy', 'time_start': None},
+                {'$set': dict(state='ready', process=None)},
+                multi=True)
+
     @classmethod
     def run_ready(cls, worker=None):
         '''Run all the tasks that are currently ready'''
@@ -239,6 +368,7 @@ def __call__(self, restore_context=True, nocapture=False):
         old_cuser = getattr(c, 'user', None)
         try:
             func = self.function
+            M.ShortlinkCache.reset()
             c.project = M.Project.query.get(_id=self.context.project_id)
             c.app = None
             if c.project:
@@ -267,6 +397,7 @@ def __call__(self, restore_context=True, nocapture=False):
         finally:
             self.time_stop = datetime.utcnow()
             session(self).flush(self)
+            M.ShortlinkCache.reset()
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
@@ -284,3 +415,65 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQTaskListener(object):
+
+    '''Waits for :meth:`MonQTask.notify` messages by tailing
+    :meth:`MonQTask.notify_collection`.
+
+    If the collection can't be tailed (e.g. an in-memory "mim" database, or an
+    error talking to mongo) :meth:`wait` falls back to sleeping for the
+    timeout, which is the same as the normal polling behavior.
+    '''
+
+    def __init__(self, only=None):
+        self.only = only
+        self.cursor = None
+        self.last_id = None
+        self.fallback = False
+        try:
+            latest = MonQTask.notify_collection().find_one(sort=[('$natural', pymongo.DESCENDING)])
+            self.last_id = latest and latest['_id']
+        except Exception:
+            log.warning('Cannot listen for task notifications, falling back to polling', exc_info=True)
+            self.fallback = True
+
+    def _open_cursor(self, timeout):
+        query = {}
+        if self.last_id is not None:
+            query['_id'] = {'$gt': self.last_id}
+        cursor = MonQTask.notify_collection().find(
+            query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+        return cursor.max_await_time_ms(int(timeout * 1000))
+
+    def wait(self, timeout):
+        '''Block until a matching task is posted, or ``timeout`` seconds pass.
+
+        Returns True if a task was posted, False on timeout.'''
+        if self.fallback:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self.cursor is None or not self.cursor.alive:
+                    self.cursor = self._open_cursor(timeout)
+                for msg in self.cursor:
+                    self.last_id = msg['_id']
+                    if msg['task_id'] is None:
+                        continue
+                    if self.only and msg['task_name'] not in self.only:
+                        continue
+                    return True
+                if not self.cursor.alive:
+                    # capped collection rolled over past our position; don't spin
+                    time.sleep(min(0.1, max(remaining, 0)))
+        except pymongo.errors.PyMongoError:
+            log.warning('Error waiting for task notifications, falling back to polling', exc_info=True)
+            self.cursor = None
+            time.sleep(max(deadline - time.time(), 0))
+            return False
@@ -39,13 +39,13 @@
 import logging
 from bson import ObjectId
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from tg import tmpl_context as c, app_globals as g
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool, aslist
+from paste.deploy.converters import asbool, asint, aslist
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -53,7 +53,6 @@
 
 from allura.lib import helpers as h
 from allura.lib import security
-from allura.lib.utils import take_while_true
 import allura.tasks.mail_tasks
 
 from .session import main_orm_session
@@ -285,56 +284,113 @@ def send_simple(self, toaddr):
             text=(self.text or '') + self.footer(toaddr))
 
     def send_direct(self, user_id):
-        user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
+        self.send_direct_to([user_id])
+
+    def send_direct_to(self, user_ids, users=None):
+        '''
+        Send this notification to several users at once.  They're all recipients of the same email
+        (which is addressed to the reply-to address, so they don't see each other), split into
+        emails of at most notifications.max_recipients recipients.  Users who are disabled or can't
+        read the artifact are skipped.
+
+        :param users: a dict of the enabled users by _id, if they've been looked up already,
+            see :meth:`enabled_users`
+        '''
         artifact = self.ref.artifact
-        log.debug('Sending direct notification %s to user %s',
-                  self._id, user_id)
-        # Don't send if user disabled
-        if not user:
-            log.debug("Skipping notification - enabled user %s not found" %
-                      user_id)
-            return
+        user_ids = [ObjectId(user_id) for user_id in user_ids]
+        if users is None:
+            users = self.enabled_users(user_ids)
+        log.debug('Sending direct notification %s to users [%s]',
+                  self._id, ', '.join(map(str, user_ids)))
+        recipients = []
+        for user_id in OrderedDict.fromkeys(user_ids):
+            # Don't send if user disabled
+            if user_id not in users:
+                log.debug("Skipping notification - enabled user %s not found" %
+                          user_id)
+                continue
+            recipients.append(users[user_id])
         # Don't send if user doesn't have read perms to the artifact
-        if user and artifact and \
-                not security.has_access(artifact, 'read', user)():
+        if artifact:
+            recipients = self.readers(artifact, recipients)
+        if not recipients:
+            return
+        text = (self.text or '') + self.footer()
+        metalink = h.absurl(self.link)
+        sender = self._sender()
+        max_recipients = asint(config.get('notifications.max_recipients', 100))
+        for i in range(0, len(recipients), max_recipients):
+            allura.tasks.mail_tasks.sendmail.post(
+                destinations=[str(user._id) for user in recipients[i:i + max_recipients]],
+                fromaddr=self.from_address,
+                reply_to=self.reply_to_address,
+                subject=self.subject,
+                message_id=self._id,
+                in_reply_to=self.in_reply_to,
+                references=self.references,
+                sender=sender,
+                metalink=metalink,
+                text=text)
+
+    @classmethod
+    def enabled_users(cls, user_ids):
+        ''':returns: a dict of the enabled users among user_ids by _id, looked up with one query'''
+        user_ids = [ObjectId(user_id) for user_id in user_ids]
+        return dict((user._id, user) for user in User.query.find({
+            '_id': {'$in': user_ids},
+            'disabled': False,
+            'pending': False,
+        }))
+
+    @classmethod
+    def readers(cls, artifact, users):
+        '''
+        :returns: the users who can read artifact.  The roles of all of them are loaded
+            together, instead of one user at a time by each has_access check.
+        '''
+        cred = security.Credentials.get()
+        project = (getattr(artifact, 'project', None) or c.project).root_project
+        user_ids = [user._id for user in users]
+        cred.load_users_roles(project._id, user_ids)
+        nbhd_project = project.neighborhood.neighborhood_project
+        if nbhd_project:
+            cred.load_users_roles(nbhd_project._id, user_ids)
+        readers = []
+        for user in users:
+            if security.has_access(artifact, 'read', user)():
+                readers.append(user)
+                continue
             log.debug("Skipping notification - User %s doesn't have read "
-                      "access to artifact %s" % (user_id, str(self.ref_id)))
+                      "access to artifact %s" % (user._id, str(artifact.index_id())))
             log.debug("User roles [%s]; artifact ACL [%s]; PSC ACL [%s]",
-                      ', '.join([str(r) for r in security.Credentials.get().user_roles(
-                          user_id=user_id, project_id=artifact.project._id).reaching_ids]),
+                      ', '.join([str(r) for r in cred.user_roles(
+                          user_id=user._id, project_id=project._id).reaching_ids]),
                       ', '.join([str(a) for a in artifact.acl]),
                       ', '.join([str(a) for a in artifact.parent_security_context().acl]))
-            return
-        allura.tasks.mail_tasks.sendmail.post(
-            destinations=[str(user_id)],
-            fromaddr=self.from_address,
-            reply_to=self.reply_to_address,
-            subject=self.subject,
-            message_id=self._id,
-            in_reply_to=self.in_reply_to,
-            references=self.references,
-            sender=self._sender(),
-            metalink=h.absurl(self.link),
-            text=(self.text or '') + self.footer())
+        return readers
 
     @classmethod
     def send_digest(self, user_id, from_address, subject, notifications,
-                    reply_to_address=None):
+                    reply_to_address=None, users=None):
         if not notifications:
             return
-        user = User.query.get(_id=ObjectId(user_id), disabled=False, pending=False)
+        if users is None:
+            users = self.enabled_users([user_id])
+        user = users.get(ObjectId(user_id))
         if not user:
             log.debug("Skipping notification - enabled user %s not found " %
                       user_id)
             return
         # Filter out notifications for which the user doesn't have read
         # permissions to the artifact.
-        artifact = self.ref.artifact
 
         def perm_check(notification):
-            return not (user and artifact) or \
+            artifact = notification.ref.artifact
+            return not artifact or \
                 security.has_access(artifact, 'read', user)()
         notifications = list(filter(perm_check, notifications))
+        if not notifications:
+            return
 
         log.debug('Sending digest of notifications [%s] to user %s', ', '.join(
             [n._id for n in notifications]), user_id)
@@ -400,7 +456,7 @@ class __mongometa__:
             ('project_id', 'artifact_index_id'),
             ('is_flash', 'user_id'),
             ('type', 'next_scheduled'),  # for q_digest
-            ('type', 'queue_empty'),  # for q_direct
+            ('type', 'queue_empty', 'last_modified'),  # for q_direct, and its oldest mailbox
             # for deliver()
             ('project_id', 'app_config_id', 'artifact_index_id', 'topic'),
         ]
@@ -537,7 +593,11 @@ def subscribed(
     def deliver(cls, nid, artifact_index_ids, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, with one update for all of them.
+
+        Mailboxes that already have the nid are skipped, so a retried delivery
+        doesn't queue it twice.  If the update fails, each mailbox is updated
+        on its own instead, so an error with one doesn't keep the nid from the rest.
         '''
 
         artifact_index_ids.append(None)  # get tool-wide ("None") and specific artifact subscriptions
@@ -547,16 +607,22 @@ def deliver(cls, nid, artifact_index_ids, topic):
             'artifact_index_id': {'$in': artifact_index_ids},
             'topic': {'$in': [None, topic]}
         }
+        update = {'$push': dict(queue=nid),
+                  '$set': dict(last_modified=datetime.utcnow(),
+                               queue_empty=False),
+                  }
+        try:
+            cls.query.update(dict(d, queue={'$ne': nid}), update, multi=True)
+            log.debug('Delivered notification %s to mailboxes matching %s', nid, d)
+            return
+        except Exception:
+            log.exception('Error adding notification: %s for artifact %s on project %s to mailboxes, '
+                          'adding it to each one instead', nid, artifact_index_ids, c.project._id)
         mboxes = cls.query.find(d).all()
         log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
         for mbox in mboxes:
             try:
-                mbox.query.update(
-                    # _id is automatically specified by ming's "query", so this matches the current mbox
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
+                cls.query.update({'_id': mbox._id, 'queue': {'$ne': nid}}, update)
                 # Make sure the mbox doesn't stick around to be flush()ed
                 session(mbox).expunge(mbox)
             except Exception:
@@ -567,13 +633,8 @@ def deliver(cls, nid, artifact_index_ids, topic):
                     nid, artifact_index_ids, c.project._id, mbox.user_id)
 
     @classmethod
-    def fire_ready(cls):
-        '''Fires all direct subscriptions with notifications as well as
-        all summary & digest subscriptions with notifications that are ready.
-        Clears the mailbox queue.
-        '''
-        now = datetime.utcnow()
-        # Queries to find all matching subscription objects
+    def ready_queries(cls, now):
+        ''':returns: queries for the direct mailboxes, and the digest & summary mailboxes, that are ready to fire'''
         q_direct = dict(
             type='direct',
             queue_empty=False,
@@ -583,27 +644,55 @@ def fire_ready(cls):
         q_digest = dict(
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
+        return q_direct, q_digest
 
-        def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
+    @classmethod
+    def fire_ready(cls, user_ids=None, limit=None):
+        '''Fires all direct subscriptions with notifications as well as
+        all summary & digest subscriptions with notifications that are ready.
+        Clears the mailbox queue.
+
+        If a mailbox can't be fired, its notifications are put back in its
+        queue to be fired next time, and the other mailboxes are still fired.
+
+        The emails are collected in a :class:`NotificationBatch`, so that a
+        notification queued in many mailboxes is sent to all their users at once.
+
+        :param user_ids: only fire the mailboxes of these users, so that
+            several :func:`allura.tasks.notification_tasks.fire_ready` tasks
+            can fire different users' mailboxes at once
+        :param limit: fire at most this many mailboxes.  Mailboxes that can't be
+            fired don't count, since they're put back
+        :returns: the number of mailboxes fired, not counting those put back
+        '''
+        now = datetime.utcnow()
+        q_direct, q_digest = cls.ready_queries(now)
+        if user_ids is not None:
+            q_direct['user_id'] = q_digest['user_id'] = {'$in': list(user_ids)}
+
+        fired = 0
+        failed = []  # so they aren't picked up again straight away
+        batch = NotificationBatch()
+        while limit is None or fired < limit:
+            mbox = cls.query.find_and_modify(
+                query=dict(q_direct, _id={'$nin': failed}),
                 update={'$set': dict(
                     queue=[],
                     queue_empty=True,
                 )},
                 new=False)
-
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            try:
-                mbox.fire(now)
-            except Exception:
-                log.exception(
-                    'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
+            if mbox is None:
+                break
+            if not mbox._fire_or_requeue(now, batch):
+                failed.append(mbox._id)
+                continue
+            fired += 1
+            if fired % NotificationBatch.size == 0:
+                batch.flush()
 
         for mbox in cls.query.find(q_digest):
+            if limit is not None and fired >= limit:
+                break
             next_scheduled = now
             if mbox.frequency.unit == 'day':
                 next_scheduled += timedelta(days=mbox.frequency.n)
@@ -619,14 +708,48 @@ def find_and_modify_direct_mbox():
                         queue_empty=True,
                         )},
                 new=False)
-            mbox.fire(now)
-
-    def fire(self, now):
+            if not mbox._fire_or_requeue(now, batch):
+                continue
+            fired += 1
+            if fired % NotificationBatch.size == 0:
+                batch.flush()
+        batch.flush()
+        return fired
+
+    def _fire_or_requeue(self, now, batch=None):
+        ''':returns: whether the mailbox was fired, or had its queue put back after an error'''
+        try:
+            self.fire(now, batch)
+            return True
+        except Exception:
+            log.exception(
+                'Error firing mbox: %s with queue: [%s]', str(self._id), ', '.join(self.queue))
+            if self.queue:
+                self.query.update({
+                    '$push': {'queue': {'$each': list(self.queue)}},
+                    '$set': dict(last_modified=now, queue_empty=False),
+                })
+            return False
+
+    def fire(self, now, batch=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param batch: a :class:`NotificationBatch` to add the emails to, to be sent
+            along with those of other mailboxes, instead of sending them straight away
         '''
         if len(self.queue) == 0:
             return
+        if batch is None:
+            def send_direct(n):
+                n.send_direct(self.user_id)
+            send_digest = Notification.send_digest
+            send_summary = Notification.send_summary
+        else:
+            def send_direct(n):
+                batch.send_direct(n, self.user_id)
+            send_digest = batch.send_digest
+            send_summary = batch.send_summary
 
         notifications = Notification.query.find(dict(_id={'$in': self.queue}))
         notifications = notifications.all()
@@ -641,7 +764,7 @@ def fire(self, now):
             for n in notifications:
                 try:
                     if n.topic == 'message':
-                        n.send_direct(self.user_id)
+                        send_direct(n)
                         # Messages must be sent individually so they can be replied
                         # to individually
                     else:
@@ -659,9 +782,9 @@ def fire(self, now):
             for (subject, from_address, reply_to_address, author_id), ns in six.iteritems(ngroups):
                 try:
                     if len(ns) == 1:
-                        ns[0].send_direct(self.user_id)
+                        send_direct(ns[0])
                     else:
-                        Notification.send_digest(
+                        send_digest(
                             self.user_id, from_address, subject, ns, reply_to_address)
                 except Exception:
                     # log error but keep trying to deliver other notifications,
@@ -671,15 +794,77 @@ def fire(self, now):
                         'Error sending notifications: [%s] to mbox %s (user %s)',
                         ', '.join([n._id for n in ns]), self._id, self.user_id)
         elif self.type == 'digest':
-            Notification.send_digest(
+            send_digest(
                 self.user_id, g.noreply, 'Digest Email',
                 notifications)
         elif self.type == 'summary':
-            Notification.send_summary(
+            send_summary(
                 self.user_id, g.noreply, 'Digest Email',
                 notifications)
 
 
+class NotificationBatch(object):
+    '''
+    The emails of the mailboxes fired by :meth:`Mailbox.fire_ready`, collected so
+    that each notification is sent to all of its users with one
+    :meth:`Notification.send_direct_to`, and the users of all the emails are
+    looked up with one query, when the batch is flushed.
+    '''
+
+    # mailboxes to fire before flushing the batch
+    size = 1000
+
+    def __init__(self):
+        self.direct = OrderedDict()  # notification _id: (notification, [user_id])
+        self.digests = []  # (user_id, args)
+        self.summaries = []  # (user_id, args)
+
+    def send_direct(self, notification, user_id):
+        self.direct.setdefault(notification._id, (notification, []))[1].append(user_id)
+
+    def send_digest(self, user_id, from_address, subject, notifications, reply_to_address=None):
+        self.digests.append((user_id, (from_address, subject, notifications, reply_to_address)))
+
+    def send_summary(self, user_id, from_address, subject, notifications):
+        self.summaries.append((user_id, (from_address, subject, notifications)))
+
+    def flush(self):
+        '''Send the emails collected so far'''
+        direct, self.direct = self.direct, OrderedDict()
+        digests, self.digests = self.digests, []
+        summaries, self.summaries = self.summaries, []
+        user_ids = set()
+        for n, n_user_ids in six.itervalues(direct):
+            user_ids.update(n_user_ids)
+        user_ids.update(user_id for user_id, args in digests)
+        users = Notification.enabled_users(user_ids) if user_ids else {}
+        for n, n_user_ids in six.itervalues(direct):
+            try:
+                n.send_direct_to(n_user_ids, users=users)
+            except Exception:
+                # log error but keep trying to deliver other notifications,
+                # lest they (which have already been removed from their
+                # mboxes' queues in mongo) be lost
+                log.exception(
+                    'Error sending notification: %s to users [%s]',
+                    n._id, ', '.join(map(str, n_user_ids)))
+        for user_id, args in digests:
+            try:
+                Notification.send_digest(user_id, *args, users=users)
+            except Exception:
+                self._log_error(user_id, args[2])
+        for user_id, args in summaries:
+            try:
+                Notification.send_summary(user_id, *args)
+            except Exception:
+                self._log_error(user_id, args[2])
+
+    def _log_error(self, user_id, notifications):
+        log.exception(
+            'Error sending notifications: [%s] to user %s',
+            ', '.join([n._id for n in notifications]), user_id)
+
+
 class MailFooter(object):
     view = jinja2.Environment(
         loader=jinja2.PackageLoader('allura', 'templates'),
@@ -54,10 +54,11 @@
 from allura.lib.decorators import memoize
 from allura.lib.security import has_access
 from allura.lib.search import SearchIndexable
-from allura.lib.utils import is_nofollow_url
+from allura.lib.utils import is_nofollow_url, LRUCache, CacheCounter
 from allura.model.types import MarkdownCache
 
 from .session import main_orm_session
+from .session import main_doc_session
 from .session import project_orm_session
 from .neighborhood import Neighborhood
 from .auth import ProjectRole, User
@@ -77,6 +78,48 @@
 DEFAULT_ICON_WIDTH = 48
 
 
+# hits & misses of the NavCache
+nav_cache_counter = CacheCounter()
+
+
+def bump_nav_generations(project_ids):
+    '''Invalidate the :class:`NavCache` entries of these projects (and their subprojects), in every process'''
+    collection = main_doc_session.db.project_nav_generation
+    for pid in set(project_ids):
+        collection.update_one({'_id': pid}, {'$inc': {'gen': 1}}, upsert=True)
+
+
+class NavCache(LRUCache):
+    '''
+    Project navbars (:meth:`Project.grouped_navbar_entries` and
+    :meth:`Project.nav_data`), kept across requests in this process for up to
+    max_size distinct projects & sets of user roles.
+
+    Each project has a generation number in mongo which is incremented
+    whenever it, or any of its tools or subprojects, are saved (see
+    :class:`allura.model.session.ProjectNavSessionExtension`).  Cached navbars
+    are only used while the generations of their project and its parents are
+    the same as when they were built.
+
+    The cached entries are shared, so callers mustn't modify them.
+
+    Enabled by setting nav_cache_size
+    '''
+    config_key = 'nav_cache_size'
+    _instance = None
+
+    def get(self, key, generation):
+        entry = super(NavCache, self).get(key)
+        if entry is not None and entry[0] == generation:
+            nav_cache_counter.hit()
+            return entry[1]
+        nav_cache_counter.miss()
+        return None
+
+    def set(self, key, generation, value):
+        super(NavCache, self).set(key, (generation, value))
+
+
 class ProjectFile(File):
 
     class __mongometa__:
@@ -656,6 +699,39 @@ def install_anchored_tools(self):
                 i += 1
         return new_tools
 
+    def _nav_cache_key(self, name):
+        '''
+        :returns: a :class:`NavCache` key for this project's navbar, as seen by the current user
+        '''
+        nbhd = self.neighborhood
+        roles = security.Credentials.get().user_roles(user_id=c.user._id, project_id=self.root_project._id)
+        return (name, self._id, getattr(c.project, '_id', None), nbhd.url_prefix, nbhd.anchored_tools,
+                tuple(sorted(set(roles.reaching_ids))), bool(has_access(nbhd, 'admin')()))
+
+    def _nav_generation(self):
+        ''':returns: the nav generations of this project and its parents, see :class:`NavCache`'''
+        ids = [p._id for p in self.parent_iter()]
+        generations = dict.fromkeys(ids, 0)
+        for doc in main_doc_session.db.project_nav_generation.find({'_id': {'$in': ids}}):
+            generations[doc['_id']] = doc['gen']
+        return tuple(generations[pid] for pid in ids)
+
+    def _nav_cached(self, name, func):
+        '''
+        :returns: func's result, from the :class:`NavCache` if it's enabled.  Don't modify it.
+        '''
+        cache = NavCache.from_config()
+        if cache is None:
+            return func()
+        key = self._nav_cache_key(name)
+        # read before building, or a navbar built just before a change could be cached with the new generation
+        generation = self._nav_generation()
+        value = cache.get(key, generation)
+        if value is None:
+            value = func()
+            cache.set(key, generation, value)
+        return value
+
     def nav_data(self, admin_options=False, navbar_entries=None):
         """
         Return data about project nav entries
@@ -664,6 +740,12 @@ def nav_data(self, admin_options=False, navbar_entries=None):
         :param navbar_entries: for performance, include this if you already have grouped_navbar_entries data
         :return:
         """
+        if admin_options:
+            # admin options come from each tool's admin_menu, which can depend on more than its config
+            return self._nav_data(admin_options, navbar_entries)
+        return self._nav_cached('nav_data', lambda: self._nav_data(admin_options, navbar_entries))
+
+    def _nav_data(self, admin_options, navbar_entries):
         from allura.ext.admin.admin_main import ProjectAdminRestController
 
         grouping_threshold = self.get_tool_data('allura', 'grouping_threshold', 1)
@@ -711,6 +793,9 @@ def grouped_navbar_entries(self):
         """Return a :class:`~allura.app.SitemapEntry` list suitable for rendering
         the project navbar with tools grouped together by tool type.
         """
+        return self._nav_cached('grouped_navbar_entries', self._grouped_navbar_entries)
+
+    def _grouped_navbar_entries(self):
         # get orginal (non-grouped) navbar entries
         sitemap = self.sitemap()
         # ordered dict to preserve the orginal ordering of tools
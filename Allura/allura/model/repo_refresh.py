@@ -26,7 +26,7 @@
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, asbool
 from tg import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -62,10 +62,13 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
 
     # Refresh commits
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    if all_commits:
+        for i, oid in enumerate(commit_ids):
+            repo.refresh_commit_info(oid, seen, False)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+    else:
+        repo.refresh_commit_info_bulk(commit_ids, seen)
 
     refresh_commit_repos(all_commit_ids, repo)
 
@@ -77,6 +80,9 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
             log.info('Refresh child info %d for parents of %s',
                      (i + 1), ci._id)
 
+    if asbool(tg.config.get('lcd_precompute', False)):
+        refresh_last_commits(repo, commit_ids)
+
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
         repo.cached_branches = []
@@ -124,6 +130,52 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         send_notifications(repo, reversed(commit_ids))
 
 
+def refresh_last_commits(repo, commit_ids):
+    '''Build the last commit docs for every tree changed by the given commits
+    (newest first, like refresh_repo's commit_ids), so that browsing those
+    trees finds them instead of building them on the request.'''
+    model_cache = ModelCache(
+        max_instances={LastCommit: 4000},
+        max_queries={LastCommit: 4000},
+    )
+    # by commit, the commit that last changed each directory, of those in commit_ids on
+    # its first-parent line, so each LCD's previous one is found without asking the SCM
+    last_changed = {}
+    with h.push_config(c, model_cache=model_cache):
+        # oldest first, so each LCD can build on the previous one for its path
+        for i, oid in enumerate(reversed(commit_ids)):
+            commit = Commit.query.get(_id=oid)
+            if commit is None:
+                continue
+            commit.set_context(repo)
+            # taken over from the first parent; any other child of it starts again
+            changed_dirs = last_changed.pop(commit.parent_ids[0], {}) if commit.parent_ids else {}
+            dirs = []
+            for path in sorted(commit.changed_paths):
+                if model_cache.get(LastCommit, dict(path=path, commit_id=oid)):
+                    dirs.append(path)
+                    continue
+                try:
+                    tree = commit.get_path(path)
+                except KeyError:
+                    continue  # deleted in this commit
+                if not isinstance(tree, Tree):
+                    continue
+                dirs.append(path)
+                prev_commit_id = changed_dirs.get(path)
+                if prev_commit_id and path in commit.added_paths:
+                    prev_commit_id = None  # deleted since, so it starts again
+                try:
+                    LastCommit._build(tree, prev_commit_id=prev_commit_id)
+                except Exception:
+                    log.exception('Error building last commit data for %s in %s', path or '/', oid)
+            changed_dirs.update((path, oid) for path in dirs)
+            last_changed[oid] = changed_dirs
+            ThreadLocalORMSession.flush_all()
+            if (i + 1) % 100 == 0:
+                log.info('Refresh last commit data %d: %s', (i + 1), oid)
+
+
 def refresh_commit_repos(all_commit_ids, repo):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
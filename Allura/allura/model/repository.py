@@ -30,7 +30,7 @@
 from time import time
 from collections import defaultdict, OrderedDict
 from six.moves.urllib.parse import urljoin
-from threading import Thread
+from threading import Thread, Lock
 from six.moves.queue import Queue
 from itertools import chain, islice
 from difflib import SequenceMatcher
@@ -107,6 +107,9 @@
 
 class RepositoryImplementation(object):
 
+    # whether tarball_stream is implemented
+    supports_tarball_stream = False
+
     # Repository-specific code
     def init(self):  # pragma no cover
         raise NotImplementedError('init')
@@ -137,6 +140,14 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commit_info_bulk(self, commit_ids, seen):
+        '''Refresh the data in many new commits, skipping any that are already
+        stored.  Implementations can override this to write in batches.'''
+        for i, oid in enumerate(commit_ids):
+            self.refresh_commit_info(oid, seen, True)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -181,6 +192,11 @@ def tarball(self, revision, path=None):
         '''Create a tarball for the revision'''
         raise NotImplementedError('tarball')
 
+    def tarball_stream(self, revision, archive_name):
+        '''Return an iterator over a zip of the revision, with everything in an
+        archive_name directory.  Only used if supports_tarball_stream is set'''
+        raise NotImplementedError('tarball_stream')
+
     def is_empty(self):
         '''Determine if the repository is empty by checking the filesystem'''
         raise NotImplementedError('is_empty')
@@ -464,6 +480,9 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def refresh_commit_info_bulk(self, commit_ids, seen):
+        return self._impl.refresh_commit_info_bulk(commit_ids, seen)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -750,6 +769,30 @@ def tarball(self, revision, path=None):
             path = path.strip('/')
         self._impl.tarball(revision, path)
 
+    def can_stream_tarball(self):
+        return asbool(tg.config.get('scm.repos.tarball.stream', False)) and self._impl.supports_tarball_stream
+
+    def tarball_stream(self, revision, path=None):
+        '''
+        Return an iterator over a zip of the revision, to send straight to the
+        client instead of waiting for the tarball task.
+
+        If scm.repos.tarball.cache_dir is set, snapshots are read from and
+        saved to a :class:`SnapshotCache` shared by all repos.
+        '''
+        archive_name = self.tarball_filename(revision, path)
+        cache = SnapshotCache.from_config()
+        if cache is None:
+            chunks = self._impl.tarball_stream(revision, archive_name)
+        else:
+            commit_id = self.commit(revision)._id
+            chunks = cache.get(commit_id, archive_name) or \
+                cache.store(commit_id, archive_name, self._impl.tarball_stream(revision, archive_name))
+        # start it here, so that if the SCM fails right away the client gets
+        # an error page instead of a truncated zip
+        first = next(chunks, b'')
+        return chain([first], chunks)
+
     def rev_to_commit_id(self, rev):
         raise NotImplementedError('rev_to_commit_id')
 
@@ -1017,7 +1060,11 @@ def add_meta_post(self, changes):
     Field('_id', S.ObjectId()),
     Field('commit_id', str),
     Field('path', str),
+    # id of the tree at this path, so it can be found without asking the SCM which
+    # commit last changed the path (see LastCommit.get)
+    Field('tree_id', str),
     Index('commit_id', 'path'),
+    Index('tree_id', 'path'),
     Field('entries', [dict(
         name=str,
         commit_id=str)]))
@@ -1584,9 +1631,24 @@ def _prev_commit_id(cls, commit, path):
 
     @classmethod
     def get(cls, tree):
-        '''Find or build the LastCommitDoc for the given tree.'''
+        '''
+        Find or build the LastCommitDoc for the given tree.
+
+        It's found without asking the SCM if the tree's path was changed in the
+        tree's commit, or if it's the only LCD for the same tree at this path
+        (tree ids are content addressed).  Otherwise, e.g. when the same tree
+        is at the path again after a revert, the SCM is asked which commit last
+        changed the path.
+        '''
         cache = getattr(c, 'model_cache', '') or ModelCache()
         path = tree.path().strip('/')
+        lcd = cache.get(cls, {'path': path, 'commit_id': tree.commit._id})
+        if lcd is None:
+            lcd = cls._get_by_tree_id(tree._id, path)
+        if lcd is not None:
+            lcd_cache_counter.hit()
+            return lcd
+        lcd_cache_counter.miss()
         last_commit_id = cls._last_commit_id(tree.commit, path)
         lcd = cache.get(cls, {'path': path, 'commit_id': last_commit_id})
         if lcd is None:
@@ -1596,16 +1658,27 @@ def get(cls, tree):
         return lcd
 
     @classmethod
-    def _build(cls, tree):
+    def _get_by_tree_id(cls, tree_id, path):
+        ''':returns: the LastCommitDoc for a tree at a path, if there's exactly one'''
+        lcds = cls.query.find(dict(tree_id=tree_id, path=path)).limit(2).all()
+        if len(lcds) == 1:
+            return lcds[0]
+        return None
+
+    @classmethod
+    def _build(cls, tree, prev_commit_id=None):
         '''
           Build the LCD record, presuming that this tree is where it was most
           recently changed.
+
+          :param prev_commit_id: the commit that changed the tree's path before
+            this one, if it's known; otherwise the SCM is asked
         '''
         model_cache = getattr(c, 'model_cache', '') or ModelCache()
         path = tree.path().strip('/')
         entries = []
         prev_lcd = None
-        prev_lcd_cid = cls._prev_commit_id(tree.commit, path)
+        prev_lcd_cid = prev_commit_id or cls._prev_commit_id(tree.commit, path)
         if prev_lcd_cid:
             prev_lcd = model_cache.get(
                 cls, {'path': path, 'commit_id': prev_lcd_cid})
@@ -1638,6 +1711,7 @@ def _build(cls, tree):
         lcd = cls(
             commit_id=tree.commit._id,
             path=path,
+            tree_id=tree._id,
             entries=entries,
         )
         model_cache.set(cls, {'path': path, 'commit_id': tree.commit._id}, lcd)
@@ -1648,6 +1722,10 @@ def by_name(self):
         return {n.name: n.commit_id for n in self.entries}
 
 
+# LastCommit.get finding a tree's last commit data without asking the SCM, or not
+lcd_cache_counter = utils.CacheCounter()
+
+
 class ModelCache(object):
 
     '''
@@ -1953,6 +2031,127 @@ def zipdir(source, zipfile, exclude=None):
             "STDERR: {3}".format(command, p.returncode, stdout, stderr))
 
 
+class SnapshotCache(object):
+    '''
+    A directory of snapshot zips shared by all repos, limited to max_size bytes.
+
+    Snapshots are keyed by commit id and the name of their top-level
+    directory, since the zip records the commit id and its date.  Reading a
+    snapshot touches it, and the least recently used ones are removed once
+    the cache grows past max_size.
+
+    Each process counts the bytes it stores, starting from a walk of the
+    directory, and only walks it again to evict.  Eviction goes down to
+    low_water of max_size, so it isn't needed again on the next store.
+    '''
+    chunk_size = 64 * 1024
+    low_water = 0.9
+    _instances = {}
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.size = None  # unknown until the first store
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls):
+        '''Return this process's cache for the configured directory, or None'''
+        root = tg.config.get('scm.repos.tarball.cache_dir')
+        if not root:
+            return None
+        max_size = asint(tg.config.get('scm.repos.tarball.cache_size', 10 * 1024 ** 3))
+        key = (root, max_size)
+        if key not in cls._instances:
+            cls._instances.setdefault(key, cls(root, max_size))
+        return cls._instances[key]
+
+    def path(self, commit_id, archive_name):
+        return os.path.join(self.root, commit_id[:2], commit_id, archive_name + '.zip')
+
+    def get(self, commit_id, archive_name):
+        '''Return an iterator over a cached snapshot, or None'''
+        path = self.path(commit_id, archive_name)
+        try:
+            fp = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        os.utime(path, None)
+        return self._read(fp)
+
+    def _read(self, fp):
+        with fp:
+            for chunk in iter(lambda: fp.read(self.chunk_size), b''):
+                yield chunk
+
+    def store(self, commit_id, archive_name, chunks):
+        '''
+        Pass chunks through, and save them once they've all been read.
+        Nothing is saved if reading them raises (or the client goes away).
+        '''
+        path = self.path(commit_id, archive_name)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+        tmpfilename = '%s.%s.tmp' % (path, os.getpid())
+        size = 0
+        try:
+            with open(tmpfilename, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.rename(tmpfilename, path)
+        finally:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+        self._stored(size)
+
+    def _stored(self, size):
+        with self._lock:
+            if self.size is None:
+                # includes the one just stored
+                self.size = sum(size for mtime, size, path in self._snapshots())
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _snapshots(self):
+        '''Yield (mtime, size, path) of every snapshot in the cache'''
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith('.zip'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        '''Remove the least recently used snapshots until the cache is down to low_water of max_size'''
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        snapshots = sorted(self._snapshots())
+        total = sum(size for mtime, size, path in snapshots)
+        for mtime, size, path in snapshots:
+            if total <= self.max_size * self.low_water:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+
 mapper(Commit, CommitDoc, repository_orm_session)
 mapper(Tree, TreeDoc, repository_orm_session)
 mapper(LastCommit, LastCommitDoc, repository_orm_session)
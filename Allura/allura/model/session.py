@@ -26,6 +26,8 @@
 from ming.orm.base import state
 from ming.orm.ormsession import ThreadLocalORMSession, SessionExtension
 from contextlib import contextmanager
+from paste.deploy.converters import asint
+from tg import config
 
 from allura.lib.utils import chunked_list
 from allura.tasks import index_tasks
@@ -40,6 +42,14 @@ def _needs_update(o):
     return o.should_update_index(old, new)
 
 
+def _links_changed(o):
+    '''Whether links to o render differently after its changes, see :meth:`Artifact.should_update_links`'''
+    should_update_links = getattr(o, 'should_update_links', None)
+    if should_update_links is None:
+        return False
+    return should_update_links(dict(state(o).original_document), dict(state(o).document))
+
+
 class ManagedSessionExtension(SessionExtension):
 
     def __init__(self, session):
@@ -114,13 +124,50 @@ def after_flush(self, obj=None):
         super(IndexerSessionExtension, self).after_flush(obj)
 
 
+class ProjectRoleSessionExtension(ManagedSessionExtension):
+    '''Invalidates the shared role cache of projects whose ProjectRoles were saved, see
+    :class:`allura.lib.security.SharedRoleCache`'''
+
+    def after_flush(self, obj=None):
+        from allura.lib.security import bump_role_generations
+        from allura.model.auth import ProjectRole
+        project_ids = set(
+            o.project_id for o in self.objects_added + self.objects_modified + self.objects_deleted
+            if isinstance(o, ProjectRole))
+        if project_ids:
+            bump_role_generations(project_ids)
+        super(ProjectRoleSessionExtension, self).after_flush(obj)
+
+
+class ProjectNavSessionExtension(ManagedSessionExtension):
+    '''Invalidates the cached navbars of projects whose tools, subprojects or settings were saved, see
+    :class:`allura.model.project.NavCache`'''
+
+    def after_flush(self, obj=None):
+        from allura.model.project import Project, AppConfig, bump_nav_generations
+        project_ids = set()
+        for o in self.objects_added + self.objects_modified + self.objects_deleted:
+            if isinstance(o, AppConfig):
+                project_ids.add(o.project_id)
+            elif isinstance(o, Project):
+                # saving a project's artifacts updates its last_updated, which isn't in the navbar
+                if o in self.objects_modified and not _needs_update(o):
+                    continue
+                # a subproject is in its parent's navbar
+                project_ids.update([o._id, o.parent_id])
+        project_ids.discard(None)
+        if project_ids:
+            bump_nav_generations(project_ids)
+        super(ProjectNavSessionExtension, self).after_flush(obj)
+
+
 class ArtifactSessionExtension(ManagedSessionExtension):
 
     def after_flush(self, obj=None):
         "Update artifact references, and add/update this artifact to solr"
         if not getattr(self.session, 'disable_index', False):
             from tg import app_globals as g
-            from .index import ArtifactReference, Shortlink
+            from .index import ArtifactReference, Shortlink, ShortlinkCache, bump_shortlink_generations
             from .session import main_orm_session
             # Ensure artifact references & shortlinks exist for new objects
             arefs = []
@@ -136,16 +183,33 @@ def after_flush(self, obj=None):
             except Exception:
                 log.exception(
                     "Failed to update artifact references. Is this a borked project migration?")
+            # links to deleted (or e.g. closed) artifacts are rendered differently
+            relinked = self.objects_deleted + [o for o in self.objects_modified if _links_changed(o)]
+            if relinked:
+                bump_shortlink_generations(getattr(o, 'project_id', None) for o in relinked)
+                ShortlinkCache.invalidate()
             self.update_index(self.objects_deleted, arefs)
         super(ArtifactSessionExtension, self).after_flush(obj)
 
     def update_index(self, objects_deleted, arefs):
         # Post delete and add indexing operations
-        if objects_deleted:
-            index_tasks.del_artifacts.post(
-                [obj.index_id() for obj in objects_deleted])
-        if arefs:
-            index_tasks.add_artifacts.post([aref._id for aref in arefs])
+        index_delay = asint(config.get('solr.index_delay', 0))
+        if index_delay:
+            # merge with index tasks that haven't run yet, so frequently edited
+            # artifacts are only sent to solr once per index_delay window
+            from .monq_model import MonQTask
+            if objects_deleted:
+                MonQTask.post_merged(index_tasks.del_artifacts,
+                                     [obj.index_id() for obj in objects_deleted])
+            if arefs:
+                MonQTask.post_merged(index_tasks.add_artifacts,
+                                     [aref._id for aref in arefs], delay=index_delay)
+        else:
+            if objects_deleted:
+                index_tasks.del_artifacts.post(
+                    [obj.index_id() for obj in objects_deleted])
+            if arefs:
+                index_tasks.add_artifacts.post([aref._id for aref in arefs])
 
 
 class BatchIndexer(ArtifactSessionExtension):
@@ -276,7 +340,7 @@ def substitute_extensions(session, extensions=None):
 task_doc_session = Session.by_name('task')
 main_orm_session = ThreadLocalORMSession(
     doc_session=main_doc_session,
-    extensions=[IndexerSessionExtension]
+    extensions=[IndexerSessionExtension, ProjectRoleSessionExtension, ProjectNavSessionExtension]
     )
 main_explicitflush_orm_session = ThreadLocalORMSession(
     doc_session=main_doc_session,
@@ -284,7 +348,7 @@ def substitute_extensions(session, extensions=None):
 )
 project_orm_session = ThreadLocalORMSession(
     doc_session=project_doc_session,
-    extensions=[IndexerSessionExtension]
+    extensions=[IndexerSessionExtension, ProjectNavSessionExtension]
 )
 task_orm_session = ThreadLocalORMSession(task_doc_session)
 artifact_orm_session = ThreadLocalORMSession(
@@ -0,0 +1,85 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime
+import logging
+
+import argparse
+
+from allura.scripts import ScriptTask
+from allura import model as M
+from allura.tasks import notification_tasks
+
+log = logging.getLogger('allura.scripts.fire_mailboxes')
+
+
+class FireMailboxes(ScriptTask):
+    '''
+    Fires the mailboxes that are ready, for sites with ``notifications.dispatcher = true``
+    (so that notify tasks only deliver notifications to mailboxes).  Run it every minute or so.
+
+    The users with ready mailboxes are split into shards, and a fire_ready
+    task is posted for each one, so that several taskd workers can fire them
+    at once without contending for the same mailboxes.
+    '''
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description="Post tasks to fire the mailboxes that are ready")
+        parser.add_argument('--shards', type=int, default=4,
+                            help='Number of tasks to split the users with ready mailboxes between')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='Number of mailboxes each task fires before posting itself again')
+        return parser
+
+    @classmethod
+    def execute(cls, options):
+        now = datetime.utcnow()
+        q_direct, q_digest = M.Mailbox.ready_queries(now)
+        direct = M.Mailbox.query.find(q_direct).count()
+        digest = M.Mailbox.query.find(q_digest).count()
+        oldest = M.Mailbox.query.find(q_direct).sort('last_modified').first()
+        log.info('Mailbox backlog: %d direct, %d digest & summary mailboxes ready. Oldest delivery waiting %ds',
+                 direct, digest, (now - oldest.last_modified).total_seconds() if oldest else 0)
+
+        running = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.notification_tasks.fire_ready',
+            state={'$in': ['ready', 'busy']},
+        )).count()
+        if running:
+            log.info('Not posting fire_ready tasks, %d are still queued or running', running)
+            return
+
+        user_ids = set(M.Mailbox.query.find(q_direct).distinct('user_id'))
+        user_ids.update(M.Mailbox.query.find(q_digest).distinct('user_id'))
+        shards = [[] for i in range(max(options.shards, 1))]
+        for user_id in user_ids:
+            shard = int(str(user_id), 16) % len(shards) if user_id else 0
+            shards[shard].append(user_id)
+        for shard_user_ids in shards:
+            if shard_user_ids:
+                notification_tasks.fire_ready.post(user_ids=shard_user_ids, batch_size=options.batch_size)
+
+
+def get_parser():
+    return FireMailboxes.parser()
+
+
+if __name__ == '__main__':
+    FireMailboxes.main()
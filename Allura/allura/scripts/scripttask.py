@@ -94,5 +94,7 @@ def parser(cls):
 
     @classmethod
     def main(cls):
+        from allura import model as M
         options = cls.parser().parse_args()
+        M.ShortlinkCache.reset()
         cls.execute(options)
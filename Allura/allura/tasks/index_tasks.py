@@ -102,14 +102,22 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     exceptions = []
     solr_updates = []
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+        artifacts = M.ArtifactReference.artifacts_by_ref_id(refs)
+        for ref in refs:
             try:
-                artifact = ref.artifact
+                artifact = artifacts.get(ref._id)
                 if artifact is None:
                     continue
                 # c.app is normally set, so keep using it.  During a reindex its not though, so set it from artifact
                 with h.push_config(c, app=getattr(c, 'app', None) or artifact.app):
-                    s = artifact.solarize()
+                    doc = artifact.index()
+                    if doc is None:
+                        continue
+                    # Find shortlinks in the raw text, not the escaped html
+                    # created by the `solarize()`.
+                    link_text = doc.get('text') or ''
+                    s = artifact.solarize(doc)
                     if s is None:
                         continue
                     if update_solr:
@@ -117,9 +125,6 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
                     if update_refs:
                         if isinstance(artifact, M.Snapshot):
                             continue
-                        # Find shortlinks in the raw text, not the escaped html
-                        # created by the `solarize()`.
-                        link_text = artifact.index().get('text') or ''
                         shortlinks = find_shortlinks(link_text)
                         ref.references = [link.ref_id for link in shortlinks]
             except Exception:
@@ -140,7 +145,7 @@ def del_artifacts(ref_ids):
     if ref_ids:
         __del_objects(ref_ids)
         M.ArtifactReference.query.remove(dict(_id={'$in': ref_ids}))
-        M.Shortlink.query.remove(dict(ref_id={'$in': ref_ids}))
+        M.Shortlink.remove_by_ref_ids(ref_ids)
 
 
 @task
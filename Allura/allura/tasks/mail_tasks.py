@@ -56,13 +56,30 @@ def mail_meta_content(metalink):
 
 @task
 def route_email(
-        peer, mailfrom, rcpttos, data):
+        peer, mailfrom, rcpttos, data=None, spool=None):
     '''
     Route messages according to their destination:
 
     <topic>@<mount_point>.<subproj2>.<subproj1>.<project>.projects.domain.net
     gets sent to c.app.handle_message(topic, message)
+
+    :param spool: a reference to the message, instead of its data, from
+        :func:`allura.lib.mail_util.spool_message`.  It's removed once the message has been routed.
+        If it can't be read the task fails, so it can be retried rather than the message being lost.
     '''
+    if spool is not None:
+        try:
+            data = h.really_unicode(mail_util.read_spooled_message(spool))
+        except Exception:
+            log.error('Error reading spooled message %s: (%r,%r,%r)', spool, peer, mailfrom, rcpttos)
+            raise
+        _route_email(peer, mailfrom, rcpttos, data)
+        mail_util.remove_spooled_message(spool)
+    else:
+        _route_email(peer, mailfrom, rcpttos, data)
+
+
+def _route_email(peer, mailfrom, rcpttos, data):
     try:
         msg = mail_util.parse_message(data)
     except Exception:  # pragma no cover
@@ -163,18 +180,29 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             fromaddr = g.noreply
         else:
             fromaddr = user.email_address_header()
-    # Divide addresses based on preferred email formats
+    # Look up all the users at once
+    user_ids = []
     for addr in destinations:
-        if mail_util.isvalid(addr):
-            addrs_plain.append(addr)
-        else:
+        if not mail_util.isvalid(addr):
             try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
+                user_ids.append(ObjectId(addr))
             except Exception:
                 log.exception('Error looking up user with ID: %r' % addr)
+    users = {}
+    if user_ids:
+        users = dict((user._id, user) for user in M.User.query.find({
+            '_id': {'$in': user_ids},
+            'disabled': False,
+            'pending': False,
+        }))
+    # Divide addresses based on preferred email formats
+    for addr in destinations:
+        if mail_util.isvalid(addr):
+            addrs_plain.append(addr)
+        elif ObjectId.is_valid(addr):
+            user = users.get(ObjectId(addr))
+            if not user:
+                log.warning('Cannot find user with ID: %s', addr)
                 continue
             addr = user.email_address_header()
             if not addr and user.email_addresses:
@@ -248,6 +276,16 @@ def sendsimplemail(
         in_reply_to, multi_msg, sender=sender, references=references, cc=cc, to=toaddr)
 
 
+@task
+def send_raw_mail(return_path, addrs, content):
+    '''
+    Send a message that was already formatted, straight away.  Posted by
+    :class:`allura.lib.mail_util.SMTPClient` for the messages its outbound queue
+    couldn't send, so an error here leaves the task to be retried.
+    '''
+    smtp_client.send_now(return_path, addrs, content)
+
+
 def send_system_mail_to_user(user_or_emailaddr, subject, text):
     '''
     Sends a standard email from the Allura system itself, to a user.
@@ -17,15 +17,38 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import logging
+import time
+
 from allura.lib.decorators import task
 from allura.lib import utils
 from tg import tmpl_context as c
+from tg import config
+from paste.deploy.converters import asbool
+
+log = logging.getLogger(__name__)
+
 
 @task
 def notify(n_id, ref_ids, topic):
     from allura import model as M
     M.Mailbox.deliver(n_id, ref_ids, topic)
-    M.Mailbox.fire_ready()
+    if not asbool(config.get('notifications.dispatcher', False)):
+        M.Mailbox.fire_ready()
+
+
+@task
+def fire_ready(user_ids=None, batch_size=None):
+    '''Fires the ready mailboxes of some users, for :class:`allura.scripts.fire_mailboxes.FireMailboxes`.
+    Posts itself again if there may be more than batch_size of them.  Mailboxes that
+    can't be fired aren't counted, so a batch of only those isn't posted again.'''
+    from allura import model as M
+    start = time.time()
+    fired = M.Mailbox.fire_ready(user_ids=user_ids, limit=batch_size)
+    log.info('Fired %d mailboxes in %.3fs', fired, time.time() - start)
+    if batch_size and fired >= batch_size:
+        fire_ready.post(user_ids=user_ids, batch_size=batch_size)
+
 
 @task
 def send_usermentions_notification(artifact_id, text, old_text=None):
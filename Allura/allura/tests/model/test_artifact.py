@@ -142,6 +142,53 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_shortlink_cache():
+    WM.Page(title='TestPage3')
+    ThreadLocalORMSession.flush_all()
+    assert M.Shortlink.lookup('[TestPage3]')
+    assert not M.Shortlink.lookup('[TestPage4]')
+    with patch.object(M.Shortlink, '_resolve_links') as resolve:
+        assert M.Shortlink.lookup('[TestPage3]')
+        assert not M.Shortlink.lookup('[TestPage4]')
+    assert not resolve.called
+    cache = M.ShortlinkCache.get()
+    assert_equal((cache.hits, cache.misses), (2, 2))
+
+    # new artifacts invalidate the cache, and cached markdown in the project
+    generation = cache.generation(c.project._id)
+    pg = WM.Page(title='TestPage4')
+    ThreadLocalORMSession.flush_all()
+    assert M.Shortlink.lookup('[TestPage4]')
+    assert M.ShortlinkCache.get().generation(c.project._id) > generation
+    generation = M.ShortlinkCache.get().generation(c.project._id)
+
+    # and so do deleted ones
+    pg.delete()
+    assert not M.Shortlink.lookup('[TestPage4]')
+    assert M.ShortlinkCache.get().generation(c.project._id) > generation
+
+
+@with_setup(setUp, tearDown)
+def test_artifacts_by_ref_id():
+    pages = [WM.Page(title='BulkPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    refs = [M.ArtifactReference.from_artifact(pg) for pg in pages]
+    refs.append(M.ArtifactReference.from_artifact(Checkmessage(slug='bulk')))
+    ThreadLocalORMSession.flush_all()
+    WM.Page.query.remove(dict(_id=pages[0]._id))
+    ThreadLocalORMSession.close_all()
+
+    refs = M.ArtifactReference.query.find(dict(_id={'$in': [r._id for r in refs]})).all()
+    artifacts = M.ArtifactReference.artifacts_by_ref_id(refs)
+    assert_equal(len(artifacts), 3)
+    for ref in refs:
+        if ref._id in artifacts:
+            assert_equal(artifacts[ref._id]._id, ref.artifact._id)
+    assert_equal(sorted(pg.title for pg in artifacts.values() if isinstance(pg, WM.Page)),
+                 ['BulkPage1', 'BulkPage2'])
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
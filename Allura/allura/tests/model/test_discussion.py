@@ -120,6 +120,47 @@ def test_thread_methods():
     t.delete()
 
 
+@with_setup(setUp, tearDown)
+def test_query_posts_after():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread.new(discussion_id=d._id, subject='Test Thread')
+    now = datetime.utcnow()
+    p0 = t.post('First post', timestamp=now)
+    p1 = t.post('Second post', timestamp=now + timedelta(seconds=1))
+    t.post('Reply to first post', parent_id=p0._id, timestamp=now + timedelta(seconds=2))
+    p3 = t.post('Same time as the reply', timestamp=now + timedelta(seconds=2))
+    ThreadLocalORMSession.flush_all()
+
+    for style in ['threaded', 'chronological']:
+        posts = t.find_posts(limit=100, style=style)
+        assert_equal(len(posts), 4)
+        pages = []
+        after = None
+        while True:
+            page = t.find_posts(limit=1, style=style, after=after)
+            if not page:
+                break
+            pages.extend(page)
+            after = page[-1]._id
+        assert_equal([p._id for p in pages], [p._id for p in posts])
+    threaded = t.find_posts(limit=100)
+    assert_equal(threaded[1].text, 'Reply to first post')
+
+    # page is still used if the post to start after is gone
+    posts = t.find_posts(page=1, limit=2, style='chronological', after='missing')
+    assert_in(p3._id, [p._id for p in posts])
+    assert_equal([p._id for p in t.find_posts(page=0, limit=2, style='chronological')], [p0._id, p1._id])
+
+    # and if it's in another thread
+    other = M.Thread.new(discussion_id=d._id, subject='Other Thread')
+    foreign = other.post('Elsewhere', timestamp=now + timedelta(seconds=3))
+    ThreadLocalORMSession.flush_all()
+    posts = t.find_posts(page=1, limit=2, style='chronological', after=foreign._id)
+    assert_in(p3._id, [p._id for p in posts])
+    posts = t.find_posts(page=0, limit=2, after=foreign._id)
+    assert_equal([p._id for p in posts], [p._id for p in threaded[:2]])
+
+
 @with_setup(setUp, tearDown)
 def test_thread_new():
     with mock.patch('allura.model.discuss.h.nonce') as nonce:
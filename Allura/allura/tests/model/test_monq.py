@@ -18,7 +18,10 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import pprint
-from alluratest.tools import with_setup
+from alluratest.tools import with_setup, assert_equal
+
+import mock
+from tg import config
 
 from ming.orm import ThreadLocalORMSession
 
@@ -42,3 +45,94 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_task_shortlink_cache():
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    cache = M.ShortlinkCache.get()
+    cache.links['stale'] = None
+    with mock.patch.object(M.ShortlinkCache, 'reset', wraps=M.ShortlinkCache.reset) as reset:
+        task()
+    # one for the task, and a new one for whatever runs next
+    assert_equal(reset.call_count, 2)
+    assert M.ShortlinkCache.get() is not cache
+    assert_equal(M.ShortlinkCache.get().links, {})
+
+
+@with_setup(setUp)
+def test_post_notify_disabled():
+    with mock.patch.object(M.MonQTask, 'notify_collection') as notify_collection:
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert not notify_collection.called
+
+
+@with_setup(setUp)
+def test_post_notify():
+    with mock.patch.dict(config, {'monq.notify': 'true'}), \
+            mock.patch.object(M.MonQTask, 'notify_collection') as notify_collection:
+        task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    notify_collection.return_value.insert_one.assert_called_once_with(
+        dict(task_id=task._id, task_name='pprint.pformat'))
+
+
+@with_setup(setUp)
+def test_notify_collection_checked_once():
+    with mock.patch.object(M.MonQTask, '_notify_collections', set()), \
+            mock.patch('allura.model.monq_model.session') as session:
+        db = session.return_value.impl.db
+        db.list_collection_names.return_value = ['monq_task_notify']
+        M.MonQTask.notify_collection()
+        M.MonQTask.notify_collection()
+    assert_equal(db.list_collection_names.call_count, 1)
+    assert not db.create_collection.called
+
+
+@with_setup(setUp)
+def test_listener_fallback():
+    # mim doesn't support capped collections, so the listener just sleeps like the regular poll loop
+    listener = M.MonQTaskListener()
+    assert listener.fallback
+    with mock.patch('allura.model.monq_model.time.sleep') as sleep:
+        assert_equal(listener.wait(5), False)
+    sleep.assert_called_once_with(5)
+
+
+@with_setup(setUp)
+def test_get_many():
+    low = M.MonQTask.post(pprint.pformat, ([1],), priority=1)
+    high = M.MonQTask.post(pprint.pformat, ([2],), priority=20)
+    M.MonQTask.post(pprint.pformat, ([3],), delay=60)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+    tasks = M.MonQTask.get_many(5, process='host pid 1')
+    assert_equal([t._id for t in tasks], [high._id, low._id])
+    for t in tasks:
+        assert_equal(t.state, 'busy')
+        assert_equal(t.process, 'host pid 1')
+        assert_equal(t.time_start, None)
+    assert_equal(M.MonQTask.get_many(5, process='host pid 2'), [])
+
+    tasks[0]()
+    M.MonQTask.release(tasks)
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.query.get(_id=high._id).state, 'complete')
+    assert_equal(M.MonQTask.query.get(_id=low._id).state, 'ready')
+    assert_equal(M.MonQTask.query.get(_id=low._id).process, None)
+
+
+@with_setup(setUp)
+def test_post_merged():
+    task = M.MonQTask.post_merged(pprint.pformat, [1, 2], delay=60)
+    merged = M.MonQTask.post_merged(pprint.pformat, [2, 3])
+    assert_equal(merged._id, task._id)
+    assert_equal(merged.args, [[1, 2, 3]])
+    other = M.MonQTask.post_merged(pprint.pformat, [4], kwargs=dict(width=10))
+    assert other._id != task._id
+    full = M.MonQTask.post_merged(pprint.pformat, [5], max_ids=3)
+    assert full._id not in (task._id, other._id)
+    assert_equal(full.args, [[5]])
+    assert_equal(M.MonQTask.query.find().count(), 3)
@@ -22,8 +22,10 @@
 import collections
 
 from tg import tmpl_context as c, app_globals as g
+from tg import config
 from alluratest.tools import assert_equal, assert_in
 from ming.orm import ThreadLocalORMSession
+from ming.odm.odmsession import ODMSession
 import mock
 import bson
 
@@ -215,6 +217,37 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_deliver(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        M.Mailbox.subscribe(user_id=user2._id, type='direct', topic='other topic')
+        ThreadLocalORMSession.flush_all()
+        with mock.patch.object(ODMSession, 'update', autospec=True, side_effect=ODMSession.update) as update:
+            M.Mailbox.deliver('nid', [self.pg.index_id()], 'metadata')
+        assert_equal(update.call_count, 1)  # one update for all the mailboxes
+        ThreadLocalORMSession.close_all()
+        queues = sorted((mbox.topic or '', mbox.queue) for mbox in M.Mailbox.query.find())
+        assert_equal(queues, [('', ['nid']), ('', ['nid']), ('other topic', [])])
+
+    def test_deliver_one_at_a_time_after_error(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        bad_mbox = M.Mailbox.query.get(user_id=user2._id)
+        orig_update = ODMSession.update
+
+        def update(session, cls, spec, fields, **kw):
+            if kw.get('multi') or spec['_id'] == bad_mbox._id:
+                raise ValueError('oops')
+            return orig_update(session, cls, spec, fields, **kw)
+
+        with mock.patch.object(ODMSession, 'update', autospec=True, side_effect=update):
+            M.Mailbox.deliver('nid', [self.pg.index_id()], 'metadata')
+        ThreadLocalORMSession.close_all()
+        assert_equal(M.Mailbox.query.get(user_id=c.user._id).queue, ['nid'])
+        assert_equal(M.Mailbox.query.get(user_id=user2._id).queue, [])
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -341,6 +374,63 @@ def test_summary_sub(self):
         self._post_notification()
         M.Mailbox.fire_ready()
 
+    def _ready_mailbox(self, username, queue):
+        user = M.User.by_username(username)
+        M.Mailbox(user_id=user._id, type='direct', queue=queue, queue_empty=False)
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        return user
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    def test_fire_ready_user_ids_and_limit(self, fire):
+        user1 = self._ready_mailbox('test-user', ['a'])
+        self._ready_mailbox('test-user-1', ['b'])
+        self._ready_mailbox('test-user-2', ['c'])
+        assert_equal(M.Mailbox.fire_ready(user_ids=[user1._id]), 1)
+        assert_equal([mbox.user_id for mbox, now, batch in (call[0] for call in fire.call_args_list)], [user1._id])
+        assert_equal(M.Mailbox.fire_ready(limit=1), 1)
+        assert_equal(M.Mailbox.query.find(dict(queue_empty=False)).count(), 1)
+        assert_equal(M.Mailbox.fire_ready(), 1)
+        assert_equal(M.Mailbox.query.find(dict(queue_empty=False)).count(), 0)
+
+    @mock.patch.object(M.Mailbox, 'fire', autospec=True)
+    def test_fire_ready_requeues_after_error(self, fire):
+        user1 = self._ready_mailbox('test-user', ['a', 'b'])
+        user2 = self._ready_mailbox('test-user-1', ['c'])
+
+        def fire_mbox(mbox, now, batch=None):
+            if mbox.user_id == user1._id:
+                raise ValueError('oops')
+        fire.side_effect = fire_mbox
+        assert_equal(M.Mailbox.fire_ready(limit=1), 1)  # the other mailbox is still fired, and counted
+        ThreadLocalORMSession.close_all()
+        mbox1 = M.Mailbox.query.get(user_id=user1._id)
+        assert_equal(mbox1.queue, ['a', 'b'])
+        assert_equal(mbox1.queue_empty, False)
+        mbox2 = M.Mailbox.query.get(user_id=user2._id)
+        assert_equal(mbox2.queue, [])
+        assert_equal(mbox2.queue_empty, True)
+
+    @mock.patch('allura.tasks.mail_tasks.sendmail')
+    def test_fire_ready_sends_notification_to_users_together(self, sendmail):
+        n = self._post_notification()
+        users = [self._ready_mailbox(username, [n._id]) for username in ('test-user', 'test-user-1', 'test-admin')]
+        with mock.patch.object(M.User, 'query', wraps=M.User.query) as user_query:
+            assert_equal(M.Mailbox.fire_ready(), 3)
+        assert_equal(user_query.find.call_count, 1)
+        assert not any(kw.get('_id') for args, kw in user_query.get.call_args_list)  # only the anonymous user
+        assert_equal(sendmail.post.call_count, 1)
+        assert_equal(sorted(sendmail.post.call_args[1]['destinations']), sorted(str(u._id) for u in users))
+
+    @mock.patch('allura.tasks.mail_tasks.sendmail')
+    def test_fire_ready_max_recipients(self, sendmail):
+        n = self._post_notification()
+        for username in ('test-user', 'test-user-1', 'test-admin'):
+            self._ready_mailbox(username, [n._id])
+        with h.push_config(config, **{'notifications.max_recipients': '2'}):
+            M.Mailbox.fire_ready()
+        assert_equal(sorted(len(call[1]['destinations']) for call in sendmail.post.call_args_list), [1, 2])
+
     def test_message(self):
         self._test_message()
 
@@ -432,6 +522,16 @@ def __getitem__(self, key):
         notifications[3].send_direct.assert_called_once_with(u0)
         notifications[4].send_direct.assert_called_once_with(u0)
 
+    @mock.patch('allura.tasks.mail_tasks.sendmail')
+    def test_send_direct_to(self, sendmail):
+        users = [M.User.by_username(username) for username in ('test-admin', 'test-user', 'test-user-1')]
+        users[1].disabled = True
+        ThreadLocalORMSession.flush_all()
+        n = self._post_notification()
+        n.send_direct_to([users[0]._id, users[1]._id, users[2]._id, users[0]._id])
+        assert_equal(sendmail.post.call_count, 1)
+        assert_equal(sendmail.post.call_args[1]['destinations'], [str(users[0]._id), str(users[2]._id)])
+
     def test_send_direct_disabled_user(self):
         user = M.User.by_username('test-admin')
         thd = M.Thread.query.get(ref_id=self.pg.index_id())
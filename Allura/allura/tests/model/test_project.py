@@ -22,8 +22,10 @@
 """
 from __future__ import unicode_literals
 from __future__ import absolute_import
+from datetime import datetime
+
 from alluratest.tools import with_setup, assert_equals, assert_in
-from tg import tmpl_context as c
+from tg import tmpl_context as c, config
 from ming.orm.ormsession import ThreadLocalORMSession
 from formencode import validators as fev
 
@@ -32,6 +34,7 @@
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.exceptions import ToolError, Invalid
+from allura.model.project import NavCache
 from mock import MagicMock, patch
 
 
@@ -159,6 +162,36 @@ def test_set_ordinal_to_admin_tool():
         assert_equals(sm[-1].tool_name, 'admin')
 
 
+@with_setup(setUp)
+def test_nav_cache():
+    NavCache._instance = None
+    with h.push_config(config, nav_cache_size='100'), \
+            patch.object(M.Project, '_grouped_navbar_entries', autospec=True,
+                         side_effect=M.Project._grouped_navbar_entries) as grouped_navbar_entries:
+        entries = c.project.grouped_navbar_entries()
+        # shared, not copied
+        assert c.project.grouped_navbar_entries() is entries
+        assert_equals(grouped_navbar_entries.call_count, 1)
+
+        # only last_updated changed, so still cached
+        c.project.last_updated = datetime.utcnow()
+        ThreadLocalORMSession.flush_all()
+        assert c.project.grouped_navbar_entries() is entries
+        assert_equals(grouped_navbar_entries.call_count, 1)
+
+        # saving a tool bumps the project's generation
+        c.app.config.options.mount_label = 'Renamed'
+        ThreadLocalORMSession.flush_all()
+        assert_in('Renamed', [e.label for e in c.project.grouped_navbar_entries()])
+        assert_equals(grouped_navbar_entries.call_count, 2)
+
+        # and the user's roles are in the key
+        with h.push_config(c, user=M.User.anonymous()):
+            c.project.grouped_navbar_entries()
+        assert_equals(grouped_navbar_entries.call_count, 3)
+    NavCache._instance = None
+
+
 @with_setup(setUp)
 def test_users_and_roles():
     p = M.Project.query.get(shortname='test')
@@ -20,6 +20,9 @@
 from __future__ import absolute_import
 from datetime import datetime
 from collections import defaultdict, OrderedDict
+import os
+import shutil
+import tempfile
 
 import unittest
 import mock
@@ -31,6 +34,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.model.repo_refresh import refresh_last_commits
 from allura.lib import helpers as h
 
 
@@ -179,6 +183,7 @@ def n(p):
             else:
                 blob_nodes.append(n(p))
         tree = mock.Mock(
+            _id=str(ObjectId()),
             commit=commit,
             path=mock.Mock(return_value=path),
             tree_ids=tree_nodes,
@@ -363,6 +368,64 @@ def test_existing_lcd_partial(self):
         self.assertEqual(lcd.by_name['file3'], commit3._id)
         self.assertEqual(lcd.by_name['file4'], commit4._id)
 
+    def test_lcd_precomputed(self):
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'dir1/file2'], ['dir1/file2'], [commit1])
+        lcd2 = M.repository.LastCommit._build(self._build_tree(commit2, '/dir1', ['file1', 'file2']))
+        session(lcd2).flush()
+        tree = self._build_tree(commit2, '/dir1', ['file1', 'file2'])
+        with mock.patch.object(self.repo, 'log') as log, \
+                mock.patch.object(M.repository.LastCommit, '_build') as build, \
+                mock.patch.object(M.repository.lcd_cache_counter, 'hit') as hit:
+            lcd = M.repository.LastCommit.get(tree)
+        assert not log.called
+        assert not build.called
+        assert hit.called
+        self.assertEqual(lcd._id, lcd2._id)
+        self.assertEqual(lcd.by_name['file1'], commit1._id)
+        self.assertEqual(lcd.by_name['file2'], commit2._id)
+
+    def test_lcd_by_tree_id(self):
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'file2'], ['file2'], [commit1])
+        tree = self._build_tree(commit2, '/dir1', ['file1'])
+        lcd1 = M.repository.LastCommit._build(self._build_tree(commit1, '/dir1', ['file1']))
+        lcd1.tree_id = tree._id
+        session(lcd1).flush()
+        with mock.patch.object(self.repo, 'log') as log, \
+                mock.patch.object(M.repository.lcd_cache_counter, 'hit') as hit:
+            lcd = M.repository.LastCommit.get(tree)
+        assert not log.called
+        assert hit.called
+        self.assertEqual(lcd._id, lcd1._id)
+        self.assertEqual(lcd.by_name['file1'], commit1._id)
+
+        # ambiguous, so ask the repo
+        M.repository.LastCommit(path='dir1', commit_id=str(ObjectId()), tree_id=tree._id, entries=[])
+        session(lcd1).flush()
+        with mock.patch.object(M.repository.lcd_cache_counter, 'miss') as miss:
+            lcd = M.repository.LastCommit.get(tree)
+        assert miss.called
+        self.assertEqual(lcd._id, lcd1._id)
+
+    def test_refresh_last_commits(self):
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'dir1/file2'], ['dir1/file2'], [commit1])
+        commit3 = self._add_commit('Commit 3', ['file1', 'dir1/file1', 'dir1/file2'], ['file1'], [commit2])
+        with mock.patch('allura.model.repo_refresh.Commit') as Commit, \
+                mock.patch('allura.model.repo_refresh.Tree', mock.Mock), \
+                mock.patch.object(M.repository.LastCommit, '_prev_commit_id', return_value=None) as prev:
+            Commit.query.get.side_effect = lambda _id: self.repo._commits[_id]
+            refresh_last_commits(self.repo, [commit3._id, commit2._id, commit1._id])
+        # the previous LCDs of the directories come from the same refresh, not the SCM
+        asked = set((args[0]._id, args[1]) for args, kwargs in prev.call_args_list)
+        for commit_id, path in [(commit2._id, ''), (commit2._id, 'dir1'), (commit3._id, '')]:
+            assert (commit_id, path) not in asked
+        lcd = M.repository.LastCommit.query.get(path='dir1', commit_id=commit2._id)
+        self.assertEqual(lcd.by_name, {'file1': commit1._id, 'file2': commit2._id})
+        lcd = M.repository.LastCommit.query.get(path='', commit_id=commit3._id)
+        self.assertEqual(lcd.by_name, {'file1': commit3._id, 'dir1': commit2._id})
+
     def test_missing_add_record(self):
         self._add_commit('Commit 1', ['file1'])
         commit2 = self._add_commit('Commit 2', ['file2'])
@@ -681,6 +744,68 @@ def test_pruning_instance_flush(self, session):
         session.return_value.expunge.assert_called_once_with(tree1)
 
 
+class TestSnapshotCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = M.repository.SnapshotCache(self.root, 12)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_get_store(self):
+        self.assertIsNone(self.cache.get('abc123', 'p-code-1'))
+        chunks = self.cache.store('abc123', 'p-code-1', iter([b'12', b'34']))
+        self.assertEqual(b''.join(chunks), b'1234')
+        self.assertEqual(b''.join(self.cache.get('abc123', 'p-code-1')), b'1234')
+        self.assertIsNone(self.cache.get('abc123', 'p-code-2'))
+
+    def test_store_incomplete(self):
+        chunks = self.cache.store('abc123', 'p-code-1', iter([b'12', b'34']))
+        next(chunks)
+        chunks.close()  # client went away
+        self.assertIsNone(self.cache.get('abc123', 'p-code-1'))
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.path('abc123', 'p-code-1'))), [])
+
+    def test_store_failed(self):
+        def chunks():
+            yield b'12'
+            raise RuntimeError('git archive failed')
+        with self.assertRaises(RuntimeError):
+            list(self.cache.store('abc123', 'p-code-1', chunks()))
+        self.assertIsNone(self.cache.get('abc123', 'p-code-1'))
+
+    def test_evict(self):
+        for i, commit_id in enumerate(['aaa', 'bbb', 'ccc']):
+            list(self.cache.store(commit_id, 'p', iter([b'1234'])))
+            os.utime(self.cache.path(commit_id, 'p'), (i, i))
+        # reading aaa makes bbb and then ccc the least recently used
+        list(self.cache.get('aaa', 'p'))
+        list(self.cache.store('ddd', 'p', iter([b'1234'])))
+        # down to low_water of max_size
+        self.assertEqual(self.cache.size, 8)
+        self.assertIsNone(self.cache.get('bbb', 'p'))
+        self.assertIsNone(self.cache.get('ccc', 'p'))
+        for commit_id in ['aaa', 'ddd']:
+            self.assertEqual(b''.join(self.cache.get(commit_id, 'p')), b'1234')
+
+    def test_size_counted(self):
+        with mock.patch('allura.model.repository.os.walk', wraps=os.walk) as walk:
+            list(self.cache.store('aaa', 'p', iter([b'1234'])))
+            list(self.cache.store('bbb', 'p', iter([b'1234'])))
+        # only walked to find the size of what was already there
+        self.assertEqual(walk.call_count, 1)
+        self.assertEqual(self.cache.size, 8)
+
+    @mock.patch.object(M.repository.SnapshotCache, '_instances', {})
+    def test_from_config(self):
+        with mock.patch.dict(config, {'scm.repos.tarball.cache_dir': self.root}):
+            cache = M.repository.SnapshotCache.from_config()
+            self.assertIs(M.repository.SnapshotCache.from_config(), cache)
+        with mock.patch.dict(config, {'scm.repos.tarball.cache_dir': ''}):
+            self.assertIsNone(M.repository.SnapshotCache.from_config())
+
+
 class TestMergeRequest(object):
 
     def setUp(self):
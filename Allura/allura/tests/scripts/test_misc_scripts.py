@@ -19,8 +19,11 @@
 
 from bson import ObjectId
 from alluratest.tools import assert_equal
+import mock
 
 from allura.scripts.clear_old_notifications import ClearOldNotifications
+from allura.scripts.fire_mailboxes import FireMailboxes
+from allura.tasks import notification_tasks
 from alluratest.controller import setup_basic_test
 from allura import model as M
 from ming.odm import session
@@ -45,3 +48,37 @@ def test(self):
         assert_equal(M.Notification.query.find().count(), 1)
         self.run_script(['--back-days', '0'])
         assert_equal(M.Notification.query.find().count(), 0)
+
+
+class TestFireMailboxes(object):
+
+    def setUp(self):
+        setup_basic_test()
+
+    def run_script(self, options):
+        cls = FireMailboxes
+        opts = cls.parser().parse_args(options)
+        cls.execute(opts)
+
+    def _mailbox(self, user_id, **kw):
+        mbox = M.Mailbox(user_id=user_id, project_id=ObjectId(), app_config_id=ObjectId(), **kw)
+        session(mbox).flush(mbox)
+
+    def test(self):
+        user_ids = [ObjectId() for i in range(5)]
+        for user_id in user_ids:
+            self._mailbox(user_id, type='direct', queue=['nid'], queue_empty=False)
+        self._mailbox(ObjectId(), type='direct', queue=[], queue_empty=True)
+        with mock.patch('allura.scripts.fire_mailboxes.notification_tasks.fire_ready.post') as post:
+            self.run_script(['--shards', '2', '--batch-size', '100'])
+        assert_equal(post.call_count, 2)
+        posted = sorted(user_id for call in post.call_args_list for user_id in call[1]['user_ids'])
+        assert_equal(posted, sorted(user_ids))
+        assert_equal(set(call[1]['batch_size'] for call in post.call_args_list), {100})
+
+    def test_tasks_still_running(self):
+        self._mailbox(ObjectId(), type='direct', queue=['nid'], queue_empty=False)
+        notification_tasks.fire_ready.post()
+        with mock.patch('allura.scripts.fire_mailboxes.notification_tasks.fire_ready.post') as post:
+            self.run_script([])
+        assert not post.called
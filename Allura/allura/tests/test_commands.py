@@ -337,6 +337,19 @@ def test_purge_old_only(self):
         assert_equal(M.MonQTask.query.find().count(), 0)
 
 
+class TestTaskdCommand(object):
+
+    @patch('allura.tasks.mail_tasks.smtp_client')
+    def test_flush_mail(self, smtp_client):
+        taskd.TaskdCommand('taskd').flush_mail()
+        smtp_client.flush.assert_called_once_with(timeout=10)
+
+    @patch('allura.tasks.mail_tasks.smtp_client')
+    def test_flush_mail_error(self, smtp_client):
+        smtp_client.flush.side_effect = IOError('oops')
+        taskd.TaskdCommand('taskd').flush_mail()  # logged, so taskd still stops or restarts
+
+
 class TestTaskdCleanupCommand(object):
 
     def setUp(self):
@@ -387,6 +400,31 @@ def test_forsaken_tasks(self):
         assert task.result == '', task.result
         assert cmd.error_tasks == []
 
+    def test_prefetched_tasks(self):
+        # claimed by a taskd that went away, but never started
+        task = Mock(state='busy', process='host pid 1111', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x: [task]
+        self.cmd_class._taskd_pids = lambda x: ['2222']
+
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        assert task.state == 'ready', task.state
+        assert task.process is None, task.process
+        assert cmd.error_tasks == []
+        assert cmd.released_tasks == [task]
+
+        # waiting its turn in a running taskd, not currently being handled
+        task = Mock(state='busy', process='host pid 2222', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x: [task]
+        self.cmd_class._check_task = lambda x, p, t: 'FAIL'
+
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        # nothing should change
+        assert task.state == 'busy', task.state
+        assert cmd.suspicious_tasks == []
+        assert cmd.released_tasks == []
+
     def test_stuck_taskd(self):
         # does not stuck
         cmd = self.cmd_class('taskd_command')
@@ -596,3 +634,30 @@ def on_post(chunk, **kw):
     def test_ming_config(self):
         cmd = show_models.ReindexCommand('reindex')
         cmd.run([test_config, '-p', 'test', '--tasks', '--ming-config', 'test.ini'])
+
+    @patch('allura.command.show_models.ReindexCommand._reindex_project')
+    def test_checkpoint(self, reindex_project):
+        reindex_project.return_value = 3
+        projects = M.Project.query.find().sort('_id').all()
+        checkpoints = M.main_doc_session.db.reindex_checkpoint
+        checkpoints.insert_one({'_id': 'test-run', 'project_id': projects[0]._id})
+
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '--checkpoint', 'test-run'])
+        reindexed = [args[0]._id for args, kw in reindex_project.call_args_list]
+        assert_equal(reindexed, [p._id for p in projects[1:]])
+        assert_equal(cmd.progress.projects, len(projects) - 1)
+        assert_equal(cmd.progress.artifacts, 3 * (len(projects) - 1))
+        # finished, so next run starts over
+        assert_equal(checkpoints.find_one({'_id': 'test-run'}), None)
+
+    def test_project_done_checkpoint(self):
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.options, args = cmd.parser.parse_args(['--checkpoint', 'test-run'])
+        cmd.progress = show_models.ReindexProgress(10)
+        project_id = M.Project.query.get(shortname='test')._id
+        cmd._project_done(project_id, 5)
+        cmd._project_done(None, 5)  # out of order in a process pool, don't move the checkpoint
+        assert_equal(cmd._load_checkpoint(), project_id)
+        assert_equal(cmd.progress.projects, 2)
+        assert_in('2/10 projects, 10 artifacts', str(cmd.progress))
@@ -46,6 +46,7 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib.app_globals import ForgeMarkdown
+from allura.lib.markdown_cache import MarkdownCache, LRUBackend, MongoBackend
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -809,6 +810,159 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestCachedConvertMany(unittest.TestCase):
+
+    def setUp(self):
+        self.posts = [M.Post(text='**bold**'), M.Post(text='[foo] and [bar](baz)'), M.Post(text='[[not_a_macro]]')]
+        M.ShortlinkCache.invalidate()
+
+    def test_same_as_cached_convert(self):
+        expected = [g.markdown.cached_convert(p, 'text') for p in self.posts]
+        assert_equal(g.markdown.cached_convert_many(self.posts, 'text'), expected)
+
+    def test_shortlinks_prefetched(self):
+        with patch.object(M.Shortlink, '_resolve_links', side_effect=dict.fromkeys) as resolve:
+            g.markdown.cached_convert_many(self.posts, 'text')
+        assert_equal(resolve.call_count, 1)
+        assert_equal(sorted(resolve.call_args[0][0]), ['bar', 'baz', 'foo', 'not_a_macro'])
+
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='-0.01')
+    def test_caches_saved_together(self):
+        with patch('allura.lib.app_globals.session') as session, \
+                patch.object(ForgeMarkdown, '_is_clean', return_value=True), \
+                patch.object(ForgeMarkdown, '_save_caches') as save_caches:
+            html = g.markdown.cached_convert_many(self.posts, 'text')
+        assert not session.called
+        assert_equal(save_caches.call_count, 1)
+        saved = save_caches.call_args[0][0]
+        assert_equal([p for p, new_cache in saved], self.posts[:2])
+        assert_equal([new_cache['html'] for p, new_cache in saved], html[:2])
+        # written to the collection only, so the artifacts aren't saved again on flush
+        assert_equal(self.posts[0].text_cache.html, None)
+        assert_equal(self.posts[1].text_cache.html, None)
+
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='-0.01')
+    def test_modified_caches_set(self):
+        with patch('allura.lib.app_globals.session') as session, \
+                patch.object(ForgeMarkdown, '_save_caches') as save_caches:
+            html = g.markdown.cached_convert_many(self.posts, 'text')
+        assert not session.called
+        assert not save_caches.called
+        # not saved yet, so the cache is saved with them
+        assert_equal(self.posts[0].text_cache.html, html[0])
+        assert_equal(self.posts[1].text_cache.html, html[1])
+        assert_equal(self.posts[2].text_cache.html, None)
+
+        # cached now, so no shortlinks to look up
+        with patch.object(M.Shortlink, 'from_links') as from_links:
+            assert_equal(g.markdown.cached_convert_many(self.posts[:2], 'text'), html[:2])
+        assert not from_links.called
+
+    def test_commit_message_shortlinks_prefetched(self):
+        with patch.object(M.Shortlink, '_resolve_links', side_effect=dict.fromkeys) as resolve:
+            g.markdown_commit.convert_uncached('see [foo] and [bar]')
+        assert_equal(resolve.call_count, 1)
+        assert_equal(sorted(resolve.call_args[0][0]), ['bar', 'foo'])
+
+
+class TestMarkdownCache(unittest.TestCase):
+
+    def setUp(self):
+        MarkdownCache._instance = None
+        self.config = patch.dict(tg.config, {'markdown_cache.backend': 'lru'})
+        self.config.start()
+        self.convert_uncached = patch.object(ForgeMarkdown, 'convert_uncached', autospec=True,
+                                             side_effect=ForgeMarkdown.convert_uncached)
+        self.convert_uncached.start()
+
+    def tearDown(self):
+        patch.stopall()
+        MarkdownCache._instance = None
+
+    def test_disabled(self):
+        with patch.dict(tg.config, {'markdown_cache.backend': ''}):
+            assert_equal(MarkdownCache.from_config(), None)
+            g.markdown.convert('**bold**')
+            g.markdown.convert('**bold**')
+        assert_equal(ForgeMarkdown.convert_uncached.call_count, 2)
+
+    def test_shared(self):
+        html = g.markdown.convert('**bold**')
+        assert_equal(g.markdown.convert('**bold**'), html)
+        assert_equal(ForgeMarkdown.convert_uncached.call_count, 1)
+        g.markdown_wiki.convert('**bold**')
+        g.markdown.convert('**other**')
+        assert_equal(ForgeMarkdown.convert_uncached.call_count, 3)
+
+    def test_keeps_type(self):
+        html = g.markdown_commit.convert('a commit message')
+        cached = g.markdown_commit.convert('a commit message')
+        assert_equal(ForgeMarkdown.convert_uncached.call_count, 1)
+        assert_equal(cached, html)
+        assert_equal(type(cached), type(html))
+        assert isinstance(g.markdown.convert('**bold**'), h.Markup)
+        assert isinstance(g.markdown.convert('**bold**'), h.Markup)
+
+    @td.with_wiki
+    def test_context(self):
+        with h.push_context('test', 'wiki', neighborhood='Projects'):
+            g.markdown.convert('[Home]')
+        with h.push_context('test2', neighborhood='Projects'):
+            g.markdown.convert('[Home]')
+        assert_equal(ForgeMarkdown.convert_uncached.call_count, 2)
+
+    @td.with_wiki
+    def test_shortlink_generation(self):
+        with h.push_context('test', 'wiki', neighborhood='Projects'):
+            g.markdown.convert('[Home]')
+            g.markdown.convert('[Home]')
+            assert_equal(ForgeMarkdown.convert_uncached.call_count, 1)
+            M.index.bump_shortlink_generations([c.project._id])
+            M.ShortlinkCache.reset()
+            g.markdown.convert('[Home]')
+            assert_equal(ForgeMarkdown.convert_uncached.call_count, 2)
+
+    def test_macros(self):
+        with patch.object(MarkdownCache, 'macro', return_value='<b>one</b>') as macro:
+            html = g.markdown.convert('before [[some_macro]] after')
+            assert_in('<b>one</b>', html)
+            assert_equal(g.markdown.convert('before [[some_macro]] after'), html)
+            assert_equal(ForgeMarkdown.convert_uncached.call_count, 1)
+            assert_equal(macro.call_count, 2)
+
+            macro.return_value = '<b>two</b>'
+            html = g.markdown.convert('before [[some_macro]] after')
+            assert_in('<b>two</b>', html)
+            assert_equal(ForgeMarkdown.convert_uncached.call_count, 2)
+            assert_equal(macro.call_count, 3)
+
+    def test_macro_ttl(self):
+        cache = MarkdownCache(LRUBackend(), ttl=60, macro_ttl=60, macros=['cached_macro'])
+        ext = Mock(_macro_context=None)
+        with patch('allura.lib.markdown_cache.macro.parse') as parse:
+            parse.return_value.return_value = 'output'
+            assert_equal(cache.macro(ext, 'cached_macro a=b'), 'output')
+            assert_equal(cache.macro(ext, 'cached_macro a=b'), 'output')
+            assert_equal(cache.macro(ext, 'other_macro a=b'), 'output')
+            assert_equal(cache.macro(ext, 'other_macro a=b'), 'output')
+        assert_equal(parse.return_value.call_count, 3)
+
+    def test_lru_expiry(self):
+        backend = LRUBackend()
+        backend.set('a', 'A', 60)
+        backend.set('b', 'B', -1)
+        assert_equal(backend.get('a'), 'A')
+        assert_equal(backend.get('b'), None)
+
+    def test_mongo(self):
+        backend = MongoBackend()
+        backend.set('a', dict(html='A'), 60)
+        backend.set('b', dict(html='B'), -1)
+        assert_equal(backend.get('a'), dict(html='A'))
+        assert_equal(backend.get('b'), None)
+        assert_equal(backend.get('c'), None)
+
+
 class TestEmojis(unittest.TestCase):
 
     def test_markdown_emoji_atomic(self):
@@ -19,17 +19,20 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import asyncio
+import smtplib
 import unittest
 from six.moves.email_mime_multipart import MIMEMultipart
 from six.moves.email_mime_text import MIMEText
 
 import mock
-from alluratest.tools import raises, assert_equal, assert_false, assert_true, assert_in
+from alluratest.tools import raises, assert_equal, assert_false, assert_true, assert_in, assert_raises
 from ming.orm import ThreadLocalORMSession
 from tg import config as tg_config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
-from allura.command.smtp_server import MailServer
+from alluratest.smtp_debug import CollectingServer
+from allura.command.smtp_server import MailServer, SMTPSession
 from allura.lib.utils import ConfigProxy
 from allura.app import Application
 from allura.lib.mail_util import (
@@ -39,6 +42,9 @@
     is_autoreply,
     identify_sender,
     _parse_message_id,
+    OutboundMailQueue,
+    SMTPClient,
+    read_spooled_message,
 )
 from allura.lib.exceptions import AddressException
 from allura.tests import decorators as td
@@ -337,8 +343,199 @@ def setUp(self):
     @mock.patch('allura.command.base.log', autospec=True)
     def test(self, log):
         listen_port = ('0.0.0.0', 8825)
-        mailserver = MailServer(listen_port, None)
-        mailserver.process_message('127.0.0.1', 'foo@bar.com', ['1234@tickets.test.p.localhost'],
-                                   'this is the email body with headers and everything ÎÅ¸'.encode('utf-8'))
+        mailserver = MailServer(listen_port)
+        data = 'this is the email body with headers and everything ÎÅ¸'.encode('utf-8')
+        with mock.patch('allura.tasks.mail_tasks.route_email') as route_email:
+            assert_equal(mailserver.process_message('127.0.0.1', 'foo@bar.com', ['1234@tickets.test.p.localhost'],
+                                                    data), '250 OK')
         assert_equal([], log.exception.call_args_list)
         log.info.assert_called_with('Msg passed along')
+        # only a reference to the message goes in the task
+        spool = route_email.post.call_args[1]['spool']
+        assert_equal(read_spooled_message(spool), data)
+
+
+class TestSMTPSession(object):
+
+    def setUp(self):
+        self.server = MailServer(('0.0.0.0', 8825), data_size_limit=100, max_recipients=2)
+        self.server.deliver = mock.Mock(side_effect=self.deliver)
+        self.delivered = []
+
+    async def deliver(self, peer, mailfrom, rcpttos, data):
+        self.delivered.append((mailfrom, rcpttos, data))
+        return '250 OK'
+
+    def converse(self, *lines):
+        ''':returns: the server's replies (after its greeting) to the client sending lines'''
+        writer = mock.Mock()
+
+        async def drain():
+            pass
+
+        async def talk():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b''.join(line + b'\r\n' for line in lines))
+            reader.feed_eof()
+            writer.drain.side_effect = drain
+            try:
+                await SMTPSession(self.server, reader, writer, ('127.0.0.1', 1234)).run()
+            except asyncio.IncompleteReadError:
+                pass
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(talk())
+        finally:
+            loop.close()
+        replies = [c[0][0].decode('ascii').rstrip('\r\n') for c in writer.write.call_args_list]
+        return replies[1:]
+
+    def test_message(self):
+        replies = self.converse(b'EHLO client', b'MAIL FROM:<a@x.com>', b'RCPT TO:<b@x.com>', b'DATA',
+                                b'Subject: hi', b'', b'..dotted', b'.', b'QUIT')
+        assert_equal(replies, ['250-%s' % self.server.hostname, '250-SIZE 100', '250 8BITMIME',
+                               '250 OK', '250 OK', '354 End data with <CR><LF>.<CR><LF>', '250 OK', '221 Bye'])
+        assert_equal(self.delivered, [('a@x.com', ['b@x.com'], b'Subject: hi\n\n.dotted')])
+
+    def test_size_limits(self):
+        replies = self.converse(b'EHLO client', b'MAIL FROM:<a@x.com> SIZE=1000', b'MAIL FROM:<a@x.com>',
+                                b'RCPT TO:<b@x.com>', b'DATA', b'x' * 200, b'.', b'QUIT')
+        assert_equal(replies[3:], ['552 Error: message size exceeds fixed maximum message size', '250 OK', '250 OK',
+                                   '354 End data with <CR><LF>.<CR><LF>',
+                                   '552 Error: message size exceeds fixed maximum message size', '221 Bye'])
+        assert_equal(self.delivered, [])
+
+    def test_sequence(self):
+        replies = self.converse(b'MAIL FROM:<a@x.com>', b'HELO client', b'RCPT TO:<b@x.com>', b'DATA',
+                                b'MAIL FROM:<a@x.com>', b'RCPT TO:<b@x.com>', b'RCPT TO:<c@x.com>',
+                                b'RCPT TO:<d@x.com>', b'BOGUS')
+        assert_equal(replies, ['503 Error: send HELO first', '250 %s' % self.server.hostname,
+                               '503 Error: need MAIL command', '503 Error: need RCPT command',
+                               '250 OK', '250 OK', '250 OK', '452 Error: too many recipients',
+                               '500 Error: command "BOGUS" not recognized'])
+
+
+class TestOutboundMailQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+    def connect(self):
+        conn = mock.Mock()
+        self.connections.append(conn)
+        return conn
+
+    def _sent(self):
+        return [c[0] for conn in self.connections for c in conn.sendmail.call_args_list]
+
+    def test_same_content_sent_together(self):
+        q = OutboundMailQueue(self.connect, senders=0, max_recipients=2)
+        batch = [
+            ('rp', ['a@x.com', 'b@x.com'], 'same'),
+            ('rp', ['c@x.com'], 'other'),
+            ('rp', ['b@x.com', 'd@x.com'], 'same'),
+        ]
+        assert_equal(list(q._transactions(batch)), [
+            ('rp', ['a@x.com', 'b@x.com'], 'same'),
+            ('rp', ['d@x.com'], 'same'),
+            ('rp', ['c@x.com'], 'other'),
+        ])
+
+    def test_senders(self):
+        q = OutboundMailQueue(self.connect, senders=2)
+        for i in range(10):
+            q.put('rp', ['%d@x.com' % i], 'message %d' % i)
+        assert_true(q.flush(timeout=10))
+        assert_equal(sorted(addrs[0] for rp, addrs, content in self._sent()),
+                     sorted('%d@x.com' % i for i in range(10)))
+        assert_true(len(self.connections) <= 2)
+        stats = q.stats.snapshot()
+        assert_equal(stats['queued'], 10)
+        assert_equal(stats['messages'], 10)
+        assert_equal(stats['recipients'], 10)
+        assert_equal(stats['failures'], 0)
+
+    def test_reconnect_after_error(self):
+        q = OutboundMailQueue(self.connect, senders=0)
+        conn = q._send(None, 'rp', ['a@x.com'], 'message')
+        conn.sendmail.side_effect = IOError('disconnected')
+        conn = q._send(conn, 'rp', ['b@x.com'], 'message')
+        assert_equal(len(self.connections), 2)
+        assert_equal(self.connections[0].close.call_count, 1)
+        assert_equal(conn, self.connections[1])
+        assert_equal(q.stats.snapshot()['transactions'], 2)
+
+    def test_error_kept(self):
+        def connect():
+            raise IOError('refused')
+        q = OutboundMailQueue(connect, senders=1)
+        q.put('rp', ['a@x.com'], 'message')
+        assert_true(q.flush(timeout=10))
+        stats = q.stats.snapshot()
+        assert_equal(stats['failures'], 1)
+        assert_equal(stats['messages'], 0)
+        assert_equal(q.take_failed(), [('rp', ['a@x.com'], 'message')])
+        assert_equal(q.take_failed(), [])
+
+    def test_only_sent_counted(self):
+        q = OutboundMailQueue(self.connect, senders=0, max_recipients=1)
+        for addr, content in [('a@x.com', 'good'), ('b@x.com', 'bad'), ('c@x.com', 'good')]:
+            q.put('rp', [addr], content)
+
+        def sendmail(return_path, addrs, content):
+            if content == 'bad':
+                raise IOError('rejected')
+        with mock.patch.object(q, '_take', side_effect=[q._take(), SystemExit]):
+            with mock.patch.object(q, 'connect') as connect:
+                connect.return_value.sendmail.side_effect = sendmail
+                assert_raises(SystemExit, q._run)
+        assert_equal(q.stats.snapshot()['messages'], 2)
+        assert_equal(q.take_failed(), [('rp', ['b@x.com'], 'bad')])
+
+    def test_take_failed_waiting(self):
+        q = OutboundMailQueue(self.connect, senders=0)
+        q.put('rp', ['a@x.com'], 'message')
+        assert_equal(q.take_failed(), [])
+        assert_equal(q.take_failed(waiting=True), [('rp', ['a@x.com'], 'message')])
+        assert_true(q.flush(timeout=0))
+
+    @mock.patch('allura.lib.mail_util.atexit')
+    @mock.patch.object(SMTPClient, '_new_connection')
+    def test_smtp_client(self, _new_connection, atexit):
+        _new_connection.side_effect = self.connect
+        client = SMTPClient()
+        msg = MIMEText('Hello')
+        with mock.patch.dict(tg_config, {'smtp_senders': '1'}):
+            client.sendmail(['a@x.com'], 'from@x.com', 'reply@x.com', 'Subject', 'id', None, msg)
+            assert_true(client.outbound().flush(timeout=10))
+        assert_equal(client._client, None)
+        assert_equal([(rp, addrs) for rp, addrs, content in self._sent()], [(config.return_path, ['a@x.com'])])
+        assert_equal(atexit.register.call_count, 1)
+
+    @mock.patch('allura.tasks.mail_tasks.send_raw_mail')
+    def test_smtp_client_failed_posted(self, send_raw_mail):
+        def connect():
+            raise IOError('refused')
+        client = SMTPClient()
+        assert_true(client.flush(timeout=0))
+        client._outbound = OutboundMailQueue(connect, senders=1)
+        client._outbound.put('rp', ['a@x.com'], 'message')
+        assert_false(client.flush(timeout=10))
+        send_raw_mail.post.assert_called_once_with('rp', ['a@x.com'], 'message')
+
+    def test_smtp_sink(self):
+        sink = CollectingServer().start()
+        try:
+            q = OutboundMailQueue(lambda: smtplib.SMTP('localhost', sink.port), senders=2)
+            q.put('rp@x.com', ['a@x.com'], 'Subject: one\n\nsame')
+            q.put('rp@x.com', ['b@x.com'], 'Subject: one\n\nsame')
+            q.put('rp@x.com', ['c@x.com'], 'Subject: two\n\nother')
+            assert_true(q.flush(timeout=10))
+        finally:
+            sink.stop()
+        assert_equal(q.stats.snapshot()['failures'], 0)
+        assert_equal(sorted(addr for mailfrom, rcpttos, data in sink.messages for addr in rcpttos),
+                     ['a@x.com', 'b@x.com', 'c@x.com'])
+        assert_equal(sorted(data for mailfrom, rcpttos, data in sink.messages),
+                     [b'Subject: one\n\nsame', b'Subject: two\n\nother'])
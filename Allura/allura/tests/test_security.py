@@ -18,13 +18,16 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 from tg import tmpl_context as c
+from tg import config
+from bson import ObjectId
 from alluratest.tools import assert_equal
+from mock import patch
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib.security import Credentials, SharedRoleCache, SharedACLCache, CompiledACL, all_allowed, has_access
 from allura import model as M
 from forgewiki import model as WM
 
@@ -192,3 +195,132 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+
+class TestLoadUsersRoles(TestController):
+
+    def test_same_as_each_user(self):
+        project = M.Project.query.get(shortname='test')
+        users = [M.User.by_username(username) for username in ('test-admin', 'test-user', 'test-user-1')]
+        _add_to_group(users[1], M.ProjectRole.by_name('Developer', project))
+        expected = [set(Credentials().user_roles(user._id, project._id).reaching_ids) for user in users]
+
+        cred = Credentials()
+        with patch.object(Credentials, 'project_role', wraps=cred.project_role) as project_role:
+            cred.load_users_roles(project._id, [user._id for user in users])
+            reaching_ids = [set(cred.user_roles(user._id, project._id).reaching_ids) for user in users]
+        assert_equal(reaching_ids, expected)
+        assert_equal(project_role.find.call_count, 2)
+
+
+class TestSharedRoleCache(TestController):
+
+    def setUp(self):
+        super(TestSharedRoleCache, self).setUp()
+        SharedRoleCache._instance = None
+
+    def tearDown(self):
+        SharedRoleCache._instance = None
+        super(TestSharedRoleCache, self).tearDown()
+
+    def test_disabled(self):
+        assert_equal(SharedRoleCache.from_config(), None)
+
+    @patch.dict(config, {'auth.role_cache_size': '100'})
+    def test_shared_across_requests(self):
+        user = M.User.by_username('test-user')
+        project = M.Project.query.get(shortname='test')
+        reaching_ids = Credentials().user_roles(user._id, project._id).reaching_ids
+        project_role_ids = set(Credentials().project_roles(project._id).index)
+        shared = SharedRoleCache.from_config()
+        assert_equal(shared.hits, 0)
+
+        cred = Credentials()
+        with patch.object(Credentials, 'project_role') as project_role:
+            assert_equal(cred.user_roles(user._id, project._id).reaching_ids, reaching_ids)
+            assert_equal(set(cred.project_roles(project._id).index), project_role_ids)
+        assert not project_role.find.called
+        assert_equal(shared.hits, 2)
+
+    @patch.dict(config, {'auth.role_cache_size': '100'})
+    def test_invalidated_by_role_change(self):
+        user = M.User.by_username('test-user-2')
+        project = M.Project.query.get(shortname='test')
+        developer = M.ProjectRole.by_name('Developer', project)
+        assert developer._id not in Credentials().user_roles(user._id, project._id).reaching_ids_set
+        assert developer._id not in Credentials().user_roles(user._id, project._id).reaching_ids_set
+        shared = SharedRoleCache.from_config()
+        assert_equal(shared.hits, 1)
+
+        _add_to_group(user, developer)
+        assert developer._id in Credentials().user_roles(user._id, project._id).reaching_ids_set
+        assert_equal(shared.hits, 1)
+
+    def test_lru(self):
+        cache = SharedRoleCache(2)
+        cache.set('a', 0, 'A')
+        cache.set('b', 0, 'B')
+        assert_equal(cache.get('a', 0), 'A')
+        cache.set('c', 0, 'C')
+        assert_equal(cache.get('b', 0), None)
+        assert_equal(cache.get('a', 0), 'A')
+        assert_equal(cache.get('c', 1), None)
+        assert_equal(cache.get('c', 0), 'C')
+
+
+class TestCompiledACL(object):
+
+    def setUp(self):
+        self.r1, self.r2, self.r3 = ObjectId(), ObjectId(), ObjectId()
+        self.acl = [
+            M.ACE.allow(self.r1, 'read'),
+            M.ACE.deny(self.r2, 'read'),
+            M.ACE.allow(self.r2, '*'),
+            M.ACE.deny(M.EVERYONE, 'post'),
+            M.ACE.allow(self.r3, 'post'),
+        ]
+        self.compiled = CompiledACL(CompiledACL.key_for(self.acl))
+
+    def test_check(self):
+        assert_equal(self.compiled.check((self.r2, self.r1), 'read'), True)
+        assert_equal(self.compiled.check((self.r2, self.r3), 'read'), (self.r3,))
+        assert_equal(self.compiled.check((self.r2,), 'create'), True)
+        assert_equal(self.compiled.check((self.r1, self.r3), 'post'), ())
+        assert_equal(self.compiled.check((self.r1,), 'create'), (self.r1,))
+
+    def test_denies(self):
+        assert self.compiled.denies([self.r1, self.r2], 'read')
+        assert not self.compiled.denies([self.r1, self.r2], 'post')
+        assert not self.compiled.denies([self.r2], 'create')
+
+    def test_decisions_memoized(self):
+        self.compiled.check((self.r1,), 'read')
+        assert_equal(self.compiled.decisions, {('read', (self.r1,)): True})
+        self.compiled.decisions[('read', (self.r1,))] = ()
+        assert_equal(self.compiled.check((self.r1,), 'read'), ())
+
+
+class TestSharedACLCache(TestController):
+
+    def setUp(self):
+        super(TestSharedACLCache, self).setUp()
+        SharedACLCache._instance = None
+
+    def tearDown(self):
+        SharedACLCache._instance = None
+        super(TestSharedACLCache, self).tearDown()
+
+    def test_per_request(self):
+        project = M.Project.query.get(shortname='test')
+        cred = Credentials()
+        assert cred.compiled_acl(project.acl) is cred.compiled_acl(list(project.acl))
+        assert Credentials().compiled_acl(project.acl) is not cred.compiled_acl(project.acl)
+        assert_equal(SharedACLCache.from_config(), None)
+
+    @patch.dict(config, {'auth.acl_cache_size': '100'})
+    def test_shared(self):
+        project = M.Project.query.get(shortname='test')
+        compiled = Credentials().compiled_acl(project.acl)
+        assert Credentials().compiled_acl(project.acl) is compiled
+        project.acl.append(M.ACE.allow(ObjectId(), 'read'))
+        assert Credentials().compiled_acl(project.acl) is not compiled
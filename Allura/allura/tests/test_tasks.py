@@ -22,6 +22,7 @@
 import operator
 import shutil
 import sys
+import tempfile
 import unittest
 
 import six
@@ -31,10 +32,11 @@
 
 import tg
 import mock
+from bson import ObjectId
 from tg import tmpl_context as c, app_globals as g
 
 from datadiff.tools import assert_equal
-from alluratest.tools import assert_in, assert_less
+from alluratest.tools import assert_in, assert_less, assert_raises
 from ming.orm import FieldProperty, Mapper
 from ming.orm import ThreadLocalORMSession
 from testfixtures import LogCapture
@@ -44,6 +46,7 @@
 from allura import model as M
 from allura.command.taskd import TaskdCommand
 from allura.lib import helpers as h
+from allura.lib import mail_util
 from allura.lib import search
 from allura.lib.exceptions import CompoundError
 from allura.tasks import event_tasks
@@ -502,6 +505,40 @@ def test_receive_email_ok(self):
             assert args[0] == 'Page'
             assert len(args) == 2
 
+    @td.with_wiki
+    def test_receive_spooled_email(self):
+        c.user = M.User.by_username('test-admin')
+        import forgewiki
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for spool_dir in [None, tmpdir]:
+                with h.push_config(tg.config, **{'forgemail.spool_dir': spool_dir}):
+                    spool = mail_util.spool_message('This is a mail message'.encode('utf-8'))
+                    with mock.patch.object(forgewiki.wiki_main.ForgeWikiApp, 'handle_message') as f:
+                        mail_tasks.route_email(
+                            '0.0.0.0', c.user.email_addresses[0],
+                            ['Page@wiki.test.p.in.localhost'],
+                            spool=spool)
+                    args, kwargs = f.call_args
+                    assert_equal(args[0], 'Page')
+                    assert_equal(args[1]['payload'], 'This is a mail message')
+                    # removed once it's routed
+                    assert_raises(Exception, mail_util.read_spooled_message, spool)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @td.with_wiki
+    def test_receive_spooled_email_missing(self):
+        c.user = M.User.by_username('test-admin')
+        import forgewiki
+        with mock.patch.object(forgewiki.wiki_main.ForgeWikiApp, 'handle_message') as f:
+            # fails, so the task is kept to be retried
+            assert_raises(Exception, mail_tasks.route_email,
+                          '0.0.0.0', c.user.email_addresses[0],
+                          ['Page@wiki.test.p.in.localhost'],
+                          spool=str(ObjectId()))
+        assert_equal(f.call_count, 0)
+
     @td.with_tool('test', 'Tickets', 'bugs')
     def test_receive_autoresponse(self):
         message = '''Date: Wed, 30 Oct 2013 01:38:40 -0700
@@ -583,6 +620,26 @@ def test_delivers_messages(self):
                 assert deliver.called_with('42', ['52'], 'none')
                 assert fire_ready.called_with()
 
+    def test_notify_with_dispatcher(self):
+        with mock.patch.object(M.Mailbox, 'deliver') as deliver, \
+                mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready, \
+                h.push_config(tg.config, **{'notifications.dispatcher': 'true'}):
+            notification_tasks.notify('42', ['52'], 'none')
+        deliver.assert_called_once_with('42', ['52'], 'none')
+        assert not fire_ready.called
+
+    def test_fire_ready(self):
+        user_ids = [ObjectId()]
+        with mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready, \
+                mock.patch.object(notification_tasks.fire_ready, 'post') as post:
+            fire_ready.return_value = 5
+            notification_tasks.fire_ready(user_ids=user_ids, batch_size=10)
+            fire_ready.assert_called_once_with(user_ids=user_ids, limit=10)
+            assert not post.called
+            fire_ready.return_value = 10
+            notification_tasks.fire_ready(user_ids=user_ids, batch_size=10)
+            post.assert_called_once_with(user_ids=user_ids, batch_size=10)
+
 
 @event_handler('my_event')
 def _my_event(event_type, testcase, *args, **kwargs):
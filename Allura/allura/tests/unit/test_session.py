@@ -153,6 +153,20 @@ def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
         self.extension.after_flush()
         assert index_tasks.add_artifacts.post.call_count == 0
 
+    @mock.patch.dict('allura.model.session.config', {'solr.index_delay': '5'})
+    @mock.patch('allura.model.monq_model.MonQTask.post_merged')
+    @mock.patch('allura.model.session.index_tasks')
+    def test_update_index_merged(self, index_tasks, post_merged):
+        deleted = [self._mock_indexable(_id=i) for i in (1, 2)]
+        arefs = [mock.Mock(_id=i) for i in (3, 4)]
+        self.extension.update_index(deleted, arefs)
+        assert index_tasks.add_artifacts.post.call_count == 0
+        assert index_tasks.del_artifacts.post.call_count == 0
+        post_merged.assert_has_calls([
+            mock.call(index_tasks.del_artifacts, [id(o) for o in deleted]),
+            mock.call(index_tasks.add_artifacts, [3, 4], delay=5),
+        ])
+
 
 class TestBatchIndexer(TestCase):
 
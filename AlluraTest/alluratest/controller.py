@@ -142,6 +142,7 @@ def setup_unit_test():
     tg.request_local.context._push_object(tgl)
 
     c.model_cache = None
+    c.shortlink_cache = None
     ThreadLocalORMSession.close_all()
 setup_unit_test.__test__ = False  # sometimes __test__ above isn't sufficient
 
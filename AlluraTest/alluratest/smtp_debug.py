@@ -20,11 +20,69 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
+import asyncio
+import threading
 from smtpd import DebuggingServer
 
+from allura.command.smtp_server import MailServer
+
 
 class BetterDebuggingServer(DebuggingServer, object):
 
     def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
         print('TO: ' + ', '.join(rcpttos))
-        super(BetterDebuggingServer, self).process_message(peer, mailfrom, rcpttos, data)
\ No newline at end of file
+        super(BetterDebuggingServer, self).process_message(peer, mailfrom, rcpttos, data)
+
+
+class CollectingServer(MailServer):
+    '''
+    A :class:`allura.command.smtp_server.MailServer` that keeps the (mailfrom, rcpttos, data)
+    of the messages it receives in ``messages``, instead of spooling them and posting
+    tasks, for tests and benchmarks of sending mail.  Runs its event loop in a thread,
+    listening on a free port by default.
+    '''
+
+    def __init__(self, localaddr=('localhost', 0), **kwargs):
+        super(CollectingServer, self).__init__(localaddr, **kwargs)
+        self.messages = []
+        self.open_sessions = {}
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def deliver(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+        return '250 OK'
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, *self.localaddr))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(1)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
+        self.loop.close()
+
+    async def handle(self, reader, writer):
+        self.open_sessions[asyncio.current_task()] = writer
+        try:
+            await super(CollectingServer, self).handle(reader, writer)
+        finally:
+            del self.open_sessions[asyncio.current_task()]
+
+    async def _close(self):
+        '''Stops listening, and ends the sessions still open'''
+        self.server.close()
+        sessions = list(self.open_sessions)
+        for writer in self.open_sessions.values():
+            writer.close()
+        await asyncio.gather(*sessions, return_exceptions=True)
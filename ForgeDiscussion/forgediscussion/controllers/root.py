@@ -405,11 +405,15 @@ def _check_security(self):
         require_access(self.forum, 'read')
 
     @expose('json:')
-    def index(self, limit=None, page=0, **kw):
+    def index(self, limit=None, page=0, after=None, **kw):
         limit, page, start = g.handle_paging(limit, int(page))
         json_data = {}
-        json_data['topic'] = self.topic.__json__(limit=limit, page=page)
-        json_data['count'] = self.topic.query_posts(status='ok').count()
+        json_data['topic'] = self.topic.__json__(limit=limit, page=page, after=after)
+        if after:
+            # estimated, so that paging through a long topic doesn't count its posts every time
+            json_data['count'] = self.topic.num_replies
+        else:
+            json_data['count'] = self.topic.query_posts(status='ok').count()
         json_data['page'] = page
         json_data['limit'] = limit
         return json_data
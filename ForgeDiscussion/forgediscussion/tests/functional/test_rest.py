@@ -19,6 +19,8 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+from datetime import datetime, timedelta
+
 from alluratest.tools import assert_equal, assert_in
 
 from allura.lib import helpers as h
@@ -197,6 +199,25 @@ def test_topic_pagination(self):
         assert_equal(resp.json['page'], 1)
         assert_equal(resp.json['limit'], 1)
 
+    def test_topic_pagination_after(self):
+        thread = ForumThread.query.find({'subject': 'Hi guys'}).first()
+        now = datetime.utcnow()
+        thread.post('Hi guy', 'I am second post', timestamp=now + timedelta(seconds=1))
+        thread.post('Hi guy', 'I am third post', timestamp=now + timedelta(seconds=2))
+        thread.update_stats()
+        ThreadLocalORMSession.flush_all()
+        url = '/rest/p/test/discussion/general/thread/%s/' % thread._id
+        resp = self.app.get(url + '?limit=2')
+        posts = resp.json['topic']['posts']
+        assert_equal([p['text'] for p in posts], ['Hi boys and girls', 'I am second post'])
+        after = resp.json['topic']['next_after']
+        assert after
+        resp = self.app.get(url + '?limit=2&after=' + after)
+        posts = resp.json['topic']['posts']
+        assert_equal([p['text'] for p in posts], ['I am third post'])
+        assert_equal(resp.json['topic']['next_after'], None)
+        assert_equal(resp.json['count'], 3)
+
     def test_topic_show_ok_only(self):
         thread = ForumThread.query.find({'subject': 'Hi guys'}).first()
         url = '/rest/p/test/discussion/general/thread/%s/' % thread._id
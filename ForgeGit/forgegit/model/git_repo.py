@@ -25,13 +25,14 @@
 from datetime import datetime
 from contextlib import contextmanager
 from time import time
+from threading import Thread
 
 import tg
 import git
 import gitdb
 from tg import tmpl_context as c
-from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from paste.deploy.converters import asbool, asint
 import six
 
 from ming.base import Object
@@ -39,10 +40,11 @@
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
-from allura.model.repository import topological_sort, prefix_paths_union
+from allura.model.repository import topological_sort, prefix_paths_union, QSIZE
 from allura import model as M
 from io import open
-from six.moves import zip
+from six.moves import zip, range
+from six.moves.queue import Queue
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +52,24 @@
     max_open_handles=128)
 
 
+def _insert_new_docs(doc_cls, docs):
+    '''Insert the docs that aren't stored yet, and empty the list'''
+    if not docs:
+        return
+    collection = doc_cls.m.collection
+    ids = [doc['_id'] for doc in docs]
+    existing = set(doc['_id'] for doc in collection.find({'_id': {'$in': ids}}, {'_id': 1}))
+    new_docs = [doc for doc in docs if doc['_id'] not in existing]
+    if new_docs:
+        try:
+            collection.insert_many(new_docs, ordered=False)
+        except BulkWriteError as e:
+            # another refresh may have inserted some of them meanwhile
+            if any(err['code'] != 11000 for err in e.details['writeErrors']):
+                raise
+    del docs[:]
+
+
 class GitLibCmdWrapper(object):
 
     def __init__(self, client):
@@ -150,6 +170,8 @@ def rev_to_commit_id(self, rev):
 
 
 class GitImplementation(M.RepositoryImplementation):
+    supports_tarball_stream = True
+
     post_receive_template = string.Template(
         '#!/bin/bash\n'
         '# The following is required for site integration, do not remove/modify.\n'
@@ -259,6 +281,7 @@ def all_commit_ids(self):
 
     def new_commits(self, all_commits=False):
         graph = {}
+        known = {}  # commit id -> whether it's already stored
 
         to_visit = [self._git.commit(rev=hd.object_id) for hd in self.heads]
         while to_visit:
@@ -267,32 +290,43 @@ def new_commits(self, all_commits=False):
                 continue
             if not all_commits:
                 # Look up the object
-                if M.repository.Commit.query.find(dict(_id=obj.hexsha)).count():
+                if obj.hexsha not in known:
+                    self._find_known_commits(obj, to_visit, known)
+                if known[obj.hexsha]:
                     graph[obj.hexsha] = set()  # mark as parentless
                     continue
             graph[obj.hexsha] = set(p.hexsha for p in obj.parents)
             to_visit += obj.parents
         return list(topological_sort(graph))
 
+    def _find_known_commits(self, obj, to_visit, known):
+        '''
+        Check which commits are already stored, for obj along with the other
+        commits waiting to be visited and obj's first-parent ancestors, so a
+        long line of new commits doesn't need a query per commit.
+        '''
+        batch = [obj] + [o for o in to_visit if o.hexsha not in known]
+        ancestor = obj
+        while len(batch) < QSIZE and ancestor.parents:
+            ancestor = ancestor.parents[0]
+            if ancestor.hexsha in known:
+                break
+            batch.append(ancestor)
+        ids = list(set(o.hexsha for o in batch))
+        for i in range(0, len(ids), QSIZE):
+            chunk = ids[i:i + QSIZE]
+            stored = M.repository.CommitDoc.m.collection.find({'_id': {'$in': chunk}}, {'_id': 1})
+            stored = set(ci['_id'] for ci in stored)
+            for oid in chunk:
+                known[oid] = oid in stored
+
     def refresh_commit_info(self, oid, seen, lazy=True):
         from allura.model.repository import CommitDoc
         ci_doc = CommitDoc.m.get(_id=oid)
         if ci_doc and lazy:
             return False
         ci = self._git.rev_parse(oid)
-        args = dict(
-            tree_id=ci.tree.hexsha,
-            committed=Object(
-                name=h.really_unicode(ci.committer.name),
-                email=h.really_unicode(ci.committer.email),
-                date=datetime.utcfromtimestamp(ci.committed_date)),
-            authored=Object(
-                name=h.really_unicode(ci.author.name),
-                email=h.really_unicode(ci.author.email),
-                date=datetime.utcfromtimestamp(ci.authored_date)),
-            message=h.really_unicode(ci.message or ''),
-            child_ids=[],
-            parent_ids=[p.hexsha for p in ci.parents])
+        args = self._commit_doc_args(ci)
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
@@ -306,16 +340,72 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
+    def refresh_commit_info_bulk(self, commit_ids, seen, batch_size=1000):
+        '''
+        Like calling :meth:`refresh_commit_info` lazily for each commit, but
+        trees are walked without recursion and the docs are written with
+        unordered insert_many calls, batch_size docs at a time, instead of a
+        get and an insert or save per commit and tree.
+
+        Commits and trees that are already stored are skipped.
+        '''
+        from allura.model.repository import CommitDoc, TreeDoc
+        commit_docs, tree_docs = [], []
+        for i, oid in enumerate(commit_ids):
+            ci = self._git.rev_parse(oid)
+            commit_docs.append(CommitDoc.m.make(dict(self._commit_doc_args(ci), _id=ci.hexsha)))
+            to_visit = [ci.tree]
+            while to_visit:
+                tree = to_visit.pop()
+                if tree.binsha in seen:
+                    continue
+                seen.add(tree.binsha)
+                doc, subtrees = self._tree_doc(tree)
+                tree_docs.append(TreeDoc.m.make(doc))
+                to_visit.extend(subtrees)
+            if len(commit_docs) >= batch_size or len(tree_docs) >= batch_size:
+                # trees first, so a stored commit always has its trees
+                _insert_new_docs(TreeDoc, tree_docs)
+                _insert_new_docs(CommitDoc, commit_docs)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+        _insert_new_docs(TreeDoc, tree_docs)
+        _insert_new_docs(CommitDoc, commit_docs)
+
+    def _commit_doc_args(self, ci):
+        return dict(
+            tree_id=ci.tree.hexsha,
+            committed=Object(
+                name=h.really_unicode(ci.committer.name),
+                email=h.really_unicode(ci.committer.email),
+                date=datetime.utcfromtimestamp(ci.committed_date)),
+            authored=Object(
+                name=h.really_unicode(ci.author.name),
+                email=h.really_unicode(ci.author.email),
+                date=datetime.utcfromtimestamp(ci.authored_date)),
+            message=h.really_unicode(ci.message or ''),
+            child_ids=[],
+            parent_ids=[p.hexsha for p in ci.parents])
+
     def refresh_tree_info(self, tree, seen, lazy=True):
-        from allura.model.repository import TreeDoc
         if lazy and tree.binsha in seen:
             return
         seen.add(tree.binsha)
+        doc, subtrees = self._tree_doc(tree)
+        for o in subtrees:
+            self.refresh_tree_info(o, seen, lazy)
+        doc.m.save()
+        return doc
+
+    def _tree_doc(self, tree):
+        '''Return the (unsaved) TreeDoc for a tree, and a list of its subtrees'''
+        from allura.model.repository import TreeDoc
         doc = TreeDoc(dict(
             _id=tree.hexsha,
             tree_ids=[],
             blob_ids=[],
             other_ids=[]))
+        subtrees = []
         for o in tree:
             if o.type == 'submodule':
                 continue
@@ -323,15 +413,14 @@ def refresh_tree_info(self, tree, seen, lazy=True):
                 name=h.really_unicode(o.name),
                 id=o.hexsha)
             if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
+                subtrees.append(o)
                 doc.tree_ids.append(obj)
             elif o.type == 'blob':
                 doc.blob_ids.append(obj)
             else:
                 obj.type = o.type
                 doc.other_ids.append(obj)
-        doc.m.save()
-        return doc
+        return doc, subtrees
 
     def log(self, revs=None, path=None, exclude=None, id_only=True, limit=None, **kw):
         """
@@ -536,6 +625,18 @@ def tarball(self, commit, path=None):
             if os.path.exists(tmpfilename):
                 os.remove(tmpfilename)
 
+    def tarball_stream(self, commit, archive_name, chunk_size=64 * 1024):
+        proc = self._git.git.archive(commit, format='zip', prefix=archive_name + '/', as_process=True)
+        try:
+            for chunk in iter(lambda: proc.stdout.read(chunk_size), b''):
+                yield chunk
+            # raises GitCommandError if git failed, so the zip isn't taken as complete
+            proc.wait()
+        finally:
+            if proc.poll() is None:
+                # the client went away
+                proc.kill()
+
     def is_empty(self):
         return not self.head
 
@@ -622,6 +723,101 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def last_commit_ids(self, commit, paths):
+        '''
+        Return a mapping {path: commit_id} of the _id of the last
+        commit to touch each path, starting from the given commit.
+
+        Instead of a ``git log`` per commit found (see :meth:`_get_last_commit`)
+        for each chunk of paths, this streams a single ``git log`` per chunk of
+        lcd_pathspec_chunk_size paths, each in its own thread, and stops it once
+        every path in the chunk has been found.
+        '''
+        if not paths:
+            return {}
+        timeout = float(tg.config.get('lcd_timeout', 60))
+        start_time = time()
+        paths = sorted(set(paths))  # remove dupes
+        result = {}  # will be appended to from each thread
+        procs = []  # so any git still running at the deadline can be killed
+        chunks = Queue()
+        chunk_size = asint(tg.config.get('lcd_pathspec_chunk_size', 500))
+        num_threads = 0
+        for s in range(0, len(paths), chunk_size):
+            chunks.put(paths[s:s + chunk_size])
+            num_threads += 1
+
+        def get_ids():
+            paths = set(chunks.get())
+            try:
+                for commit_id, files in self._iter_changed_files(commit._id, sorted(paths), procs):
+                    if time() - start_time >= timeout:
+                        log.error('last_commit_ids timeout for %s on %s',
+                                  commit._id, ', '.join(paths))
+                        break
+                    # merge commits don't list any files, so they're skipped
+                    # here just like in _get_last_commit
+                    changed = prefix_paths_union(paths, files)
+                    for path in changed:
+                        result[path] = commit_id
+                    paths -= changed
+                    if not paths:
+                        break
+            except Exception as e:
+                log.exception('Error in SCM thread: %s', e)
+            finally:
+                chunks.task_done()
+        for i in range(num_threads):
+            t = Thread(target=get_ids)
+            t.daemon = True
+            t.start()
+        # reimplement chunks.join() but with a timeout, since a thread blocked
+        # reading git's output never gets to check it
+        # (giving threads a bit of extra cleanup time in case they timeout)
+        chunks.all_tasks_done.acquire()
+        try:
+            endtime = time() + timeout + 0.5
+            while chunks.unfinished_tasks and endtime > time():
+                chunks.all_tasks_done.wait(endtime - time())
+        finally:
+            chunks.all_tasks_done.release()
+        if chunks.unfinished_tasks:
+            log.error('last_commit_ids timeout for %s, stopping git', commit._id)
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+        return dict(result)
+
+    def _iter_changed_files(self, commit_id, paths, procs=None):
+        '''
+        Yield (commit_id, set of changed files) for the commits reachable
+        from commit_id that touch any of the paths (or any commits, if there
+        are no paths), newest first, streamed from one ``git log`` process.
+
+        The process is appended to ``procs``, if given, so that the caller
+        can kill it.
+        '''
+        proc = self._git.git.log(commit_id, '--', *paths,
+                                 format='%x00%H', name_only=True, as_process=True)
+        if procs is not None:
+            procs.append(proc)
+        try:
+            commit_id, files = None, set()
+            for line in proc.stdout:
+                line = six.ensure_text(line).rstrip('\n')
+                if line.startswith('\x00'):
+                    if commit_id:
+                        yield commit_id, files
+                    commit_id, files = line[1:], set()
+                elif line:
+                    files.add(line)
+            if commit_id:
+                yield commit_id, files
+        finally:
+            if proc.poll() is None:
+                # don't let git walk the rest of the history
+                proc.kill()
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
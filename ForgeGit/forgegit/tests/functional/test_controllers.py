@@ -26,9 +26,12 @@
 import shutil
 import tempfile
 import textwrap
+import zipfile
+from io import BytesIO
 
 from datadiff.tools import assert_equal as dd_assert_equal
-from alluratest.tools import assert_equal, assert_in, assert_not_in, assert_not_equal
+from alluratest.tools import assert_equal, assert_in, assert_not_in, assert_not_equal, assert_raises
+import git
 import pkg_resources
 from alluratest.tools import assert_regexp_matches
 from tg import tmpl_context as c
@@ -502,6 +505,44 @@ def test_tarball(self):
         r = self.app.get('/p/test/src-git/ci/master/tarball')
         assert 'Your download will begin shortly' in r
 
+    def test_tarball_stream(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with patch.dict(tg.config, {'scm.repos.tarball.stream': 'true',
+                                        'scm.repos.tarball.cache_dir': cache_dir}):
+                r = self.app.get('/p/test/src-git/ci/master/tarball')
+                assert r.location.endswith('/p/test/src-git/ci/master/snapshot?path='), r.location
+                r = self.app.get('/p/test/src-git/ci/master/snapshot')
+                assert_equal(r.content_type, 'application/zip')
+                assert_equal(r.headers['Content-Disposition'], 'attachment;filename="test-src-git-master.zip"')
+                names = zipfile.ZipFile(BytesIO(r.body)).namelist()
+                assert_in('test-src-git-master/README', names)
+
+                cached = [os.path.join(d, f) for d, _, files in os.walk(cache_dir) for f in files]
+                assert_equal(len(cached), 1)
+                with patch('forgegit.model.git_repo.GitImplementation.tarball_stream') as tarball_stream:
+                    r2 = self.app.get('/p/test/src-git/ci/master/snapshot')
+                assert not tarball_stream.called
+                assert_equal(r2.body, r.body)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_tarball_stream_failed(self):
+        def failed_archive(commit, archive_name):
+            raise git.GitCommandError(['git', 'archive'], 128)
+            yield
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with patch.dict(tg.config, {'scm.repos.tarball.stream': 'true',
+                                        'scm.repos.tarball.cache_dir': cache_dir}), \
+                    patch('forgegit.model.git_repo.GitImplementation.tarball_stream', side_effect=failed_archive):
+                with assert_raises(git.GitCommandError):
+                    self.app.get('/p/test/src-git/ci/master/snapshot')
+            cached = [f for d, _, files in os.walk(cache_dir) for f in files]
+            assert_equal(cached, [])
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_tarball_link_in_subdirs(self):
         '''Go to repo subdir and check 'Download Snapshot' link'''
         self.setup_testgit_index_repo()
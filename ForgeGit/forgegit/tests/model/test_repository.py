@@ -26,6 +26,8 @@
 import unittest
 import pkg_resources
 import datetime
+import threading
+import time
 import email.iterators
 
 import mock
@@ -392,6 +394,44 @@ def test_refresh(self):
         assert commit2_loc != -1
         assert_less(commit1_loc, commit2_loc)
 
+    def test_refresh_commit_info_bulk(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        # setUp's refresh stored these with refresh_commit_info_bulk
+        bulk_commits = {ci._id: ci for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids}))}
+        bulk_trees = {t._id: t for t in M.repository.TreeDoc.m.find()}
+        assert_equal(sorted(bulk_commits), sorted(commit_ids))
+
+        M.repository.CommitDoc.m.remove({})
+        M.repository.TreeDoc.m.remove({})
+        seen = set()
+        for oid in commit_ids:
+            self.repo.refresh_commit_info(oid, seen, lazy=True)
+        commits = {ci._id: ci for ci in M.repository.CommitDoc.m.find()}
+        trees = {t._id: t for t in M.repository.TreeDoc.m.find()}
+        assert_equal(trees, bulk_trees)
+        for oid in commit_ids:
+            for field in ('tree_id', 'committed', 'authored', 'message', 'parent_ids'):
+                assert_equal(commits[oid][field], bulk_commits[oid][field])
+
+        # already stored docs are skipped
+        self.repo._impl.refresh_commit_info_bulk(commit_ids, set(), batch_size=2)
+        assert_equal(M.repository.CommitDoc.m.find().count(), len(commit_ids))
+        assert_equal(M.repository.TreeDoc.m.find().count(), len(trees))
+
+    def test_new_commits(self):
+        impl = self.repo._impl
+        all_ids = impl.new_commits(all_commits=True)
+        assert_equal(impl.new_commits(), [])
+
+        M.repository.CommitDoc.m.remove(dict(_id=impl.head))
+        assert_equal(impl.new_commits(), [impl.head])
+
+        M.repository.CommitDoc.m.remove({})
+        with mock.patch.object(impl, '_find_known_commits', wraps=impl._find_known_commits) as find:
+            assert_equal(impl.new_commits(), all_ids)
+        # far fewer lookups than commits
+        assert_less(find.call_count, len(all_ids))
+
     def test_notification_email(self):
         send_notifications(
             self.repo, ['1e146e67985dcd71c74de79613719bef7bddca4a', ])
@@ -1000,6 +1040,45 @@ def test_last_commit_ids(self):
             'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
         })
 
+    def test_last_commit_ids_dirs(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit = mock.Mock(_id='1e146e67985dcd71c74de79613719bef7bddca4a')
+        self.assertEqual(impl.last_commit_ids(commit, ['README', 'a', 'a/b', 'missing']), {
+            'README': '1e146e67985dcd71c74de79613719bef7bddca4a',
+            'a': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+            'a/b': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+        })
+
+    def test_last_commit_ids_chunked(self):
+        with h.push_config(tg.config, lcd_pathspec_chunk_size=1):
+            self.test_last_commit_ids_dirs()
+
+    def test_last_commit_ids_deadline(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit = mock.Mock(_id='1e146e67985dcd71c74de79613719bef7bddca4a')
+        proc = mock.Mock()
+        proc.poll.return_value = None
+        unblock = threading.Event()
+
+        def stuck_git(commit_id, paths, procs):
+            # like a git log that never writes anything
+            procs.append(proc)
+            unblock.wait(5)
+            return iter([])
+        with h.push_config(tg.config, lcd_timeout=0), \
+                mock.patch.object(impl, '_iter_changed_files', side_effect=stuck_git):
+            start = time.time()
+            self.assertEqual(impl.last_commit_ids(commit, ['README']), {})
+        unblock.set()
+        assert_less(time.time() - start, 2)
+        proc.kill.assert_called_once_with()
+
     def test_last_commit_ids_threaded(self):
         with h.push_config(tg.config, lcd_thread_chunk_size=1):
             self.test_last_commit_ids()
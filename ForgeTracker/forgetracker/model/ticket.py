@@ -36,6 +36,7 @@
 import jinja2
 
 from ming import schema
+from ming.base import Object
 from ming.utils import LazyProperty
 from ming.orm import Mapper, session
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
@@ -72,8 +73,9 @@
 from allura.model.types import MarkdownCache, EVERYONE
 
 from allura.lib import security
-from allura.lib.search import search_artifact, SearchError
+from allura.lib.search import search_artifact, count_artifacts, SearchError
 from allura.lib import utils
+from allura.lib.utils import LRUCache
 from allura.lib import helpers as h
 from allura.lib.plugin import ImportIdConverter
 from allura.lib.security import require_access
@@ -96,6 +98,29 @@ def get_default_for_solr_type(solr_type):
     new_solr='solr.use_new_types')
 
 
+class UserBinCountsCache(LRUCache):
+    '''
+    Ticket counts of each user's $USER bins, see :meth:`Globals.user_bin_counts`.
+    Kept in each process, for up to max_size users & trackers.
+
+    Enabled by setting forgetracker.user_bin_cache_size
+    '''
+    config_key = 'forgetracker.user_bin_cache_size'
+    _instance = None
+
+
+class TicketsWithACL(object):
+    '''Stands in for all the tickets of a tracker with the same ACL, to check access to them at once'''
+
+    def __init__(self, acl, app_config):
+        self.acl = [Object(ace) for ace in acl]
+        self.app_config = app_config
+        self.project = app_config.project
+
+    def parent_security_context(self):
+        return self.app_config
+
+
 class Globals(MappedClass):
 
     class __mongometa__:
@@ -118,6 +143,9 @@ class __mongometa__:
     _bin_counts_data = FieldProperty([dict(summary=str, hits=int)])
     _bin_counts_expire = FieldProperty(datetime)
     _bin_counts_invalidated = FieldProperty(datetime)
+    _bin_counts_updated = FieldProperty(datetime)
+    # ticket counts by milestones, status & ACL, see milestone_counts()
+    _milestone_counts_data = FieldProperty(schema.Anything(if_missing=None))
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
     _milestone_counts_expire = FieldProperty(schema.Deprecated)  # datetime)
@@ -195,20 +223,39 @@ def get_custom_field_solr_type(self, field_name):
 
     def update_bin_counts(self):
         # Refresh bin counts
-        self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
-            if b.terms and '$USER' in b.terms:
-                # skip queries with $USER variable, hits will be inconsistent
-                # for them
-                continue
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False, fq=['-deleted_b:true'])
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+        bins = [b for b in Bin.query.find(dict(app_config_id=self.app_config_id))
+                # queries with $USER variable are counted for each user, see user_bin_counts()
+                if not (b.terms and '$USER' in b.terms)]
+        self._bin_counts_data = [dict(summary=b.summary, hits=hits)
+                                 for b, hits in zip(bins, self._count_bins(bins))]
         cache_expire_config = int(tg_config.get('forgetracker.bin_cache_expire', 60))
         if cache_expire_config:
             self._bin_counts_expire = datetime.utcnow() + timedelta(minutes=cache_expire_config)
+        try:
+            self._milestone_counts_data = self._aggregate_milestone_counts()
+        except Exception:
+            # keep the previous milestone counts, rather than lose the bin counts too
+            log.exception('Error counting milestones for %s', self.app_config_id)
         self._bin_counts_invalidated = None
+        self._bin_counts_updated = datetime.utcnow()
+
+    def _count_bins(self, bins, short_timeout=False):
+        '''Count the tickets matching each bin with one faceted search.  If that fails
+        (e.g. one bin's terms are invalid), each bin is counted with its own search.'''
+        terms = [b.terms or '*:*' for b in bins]
+        try:
+            return count_artifacts(Ticket, terms, short_timeout=short_timeout, fq=['-deleted_b:true'])
+        except SearchError:
+            log.info('Error counting bins together for %s, counting each one', self.app_config_id, exc_info=True)
+        counts = []
+        for q in terms:
+            try:
+                r = search_artifact(Ticket, q, rows=0, short_timeout=short_timeout, fq=['-deleted_b:true'])
+            except SearchError:
+                log.info('Error counting bin %r for %s', q, self.app_config_id, exc_info=True)
+                r = None
+            counts.append(r is not None and r.hits or 0)
+        return counts
 
     def bin_count(self, name):
         # not sure why we expire bin counts even if unchanged
@@ -221,27 +268,118 @@ def bin_count(self, name):
                 return d
         return dict(summary=name, hits=0)
 
+    def user_bin_counts(self, bins, user=None):
+        '''Count the tickets in the bins whose terms use $USER, for the given (or current) user.
+        They're counted together when first asked for, and kept in the :class:`UserBinCountsCache`
+        until the bin counts are next updated or they expire.
+
+        :returns: dict of bin summary to hits
+        '''
+        user = user or c.user
+        bins = [b for b in bins if b.terms and '$USER' in b.terms]
+        if not bins:
+            return {}
+        cache = UserBinCountsCache.from_config()
+        key = (self.app_config_id, user._id, self._bin_counts_updated,
+               tuple((b.summary, b.terms) for b in bins))
+        cached = cache.get(key) if cache else None
+        if cached is not None and cached[0] > datetime.utcnow():
+            return cached[1]
+        with h.push_config(c, user=user):
+            counts = dict(zip([b.summary for b in bins], self._count_bins(bins, short_timeout=True)))
+        if cache:
+            cache_expire_config = int(tg_config.get('forgetracker.bin_cache_expire', 60)) or 60
+            cache.set(key, (datetime.utcnow() + timedelta(minutes=cache_expire_config), counts))
+        return counts
+
     def milestone_count(self, name):
         fld_name, m_name = name.split(':', 1)
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
+        if self._milestone_counts_data is None:
+            self.invalidate_bin_counts()
+            d.update(self._count_milestone(fld_name, m_name))
+        else:
+            d.update(self.milestone_counts().get(name, {}))
+        return d
+
+    def milestone_counts(self):
+        '''Count the tickets, and closed tickets, of every milestone that the
+        current user can read.
+
+        Tickets are counted by milestone, status and ACL with one aggregation,
+        run by :meth:`update_bin_counts` and kept with the bin counts.  Until
+        that has first run for the tracker, it's queued and each milestone is
+        counted separately instead.  Private tickets are counted if the user
+        can read tickets with their ACL, checked once per distinct ACL rather
+        than for each ticket.
+
+        :returns: dict of ``'field_name:milestone'`` to dict(hits=int, closed=int)
+        '''
+        if self._milestone_counts_data is None:
+            self.invalidate_bin_counts()
+            return {'%s:%s' % (fld.name, m.name): self._count_milestone(fld.name, m.name)
+                    for fld in self.milestone_fields
+                    for m in fld.get('milestones') or []}
+        closed_statuses = self.set_of_closed_status_names
+        readable = {}
+        counts = {}
+        for group in self._milestone_counts_data or []:
+            if group['acl']:
+                tickets = TicketsWithACL(group['acl'], self.app_config)
+                key = security.CompiledACL.key_for(tickets.acl)
+                if key not in readable:
+                    readable[key] = bool(security.has_access(tickets, 'read')())
+                if not readable[key]:
+                    continue
+            for fld_name, m_name in six.iteritems(group['milestones']):
+                if not m_name:
+                    continue
+                d = counts.setdefault('%s:%s' % (fld_name, m_name), dict(hits=0, closed=0))
+                d['hits'] += group['hits']
+                if group['status'] in closed_statuses:
+                    d['closed'] += group['hits']
+        return counts
+
+    def _count_milestone(self, fld_name, m_name):
+        ''':returns: dict(hits=int, closed=int) for one milestone, counted with separate queries'''
         mongo_query = {
             'custom_fields.%s' % fld_name: m_name,
             'app_config_id': self.app_config_id,
             'deleted': False
         }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
+        closed_statuses = self.set_of_closed_status_names
+        d = dict(hits=Ticket.query.find(dict(mongo_query, acl=[])).count(),
+                 closed=Ticket.query.find(dict(mongo_query, acl=[], status={'$in': list(closed_statuses)})).count())
         secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
         if secured_tickets.count():
             tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
             d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
+            d['closed'] += sum(1 for t in tickets if t.status in closed_statuses)
         return d
 
+    def _aggregate_milestone_counts(self):
+        fields = [fld.name for fld in self.milestone_fields]
+        if not fields:
+            return []
+        result = Ticket.query.aggregate([
+            {'$match': {'app_config_id': self.app_config_id, 'deleted': False}},
+            {'$group': {
+                '_id': {
+                    'milestones': ['$custom_fields.%s' % name for name in fields],
+                    'status': '$status',
+                    'acl': '$acl',
+                },
+                'hits': {'$sum': 1},
+            }},
+        ], cursor={})
+        return [dict(milestones=dict(zip(fields, r['_id']['milestones'])),
+                     status=r['_id'].get('status'),
+                     acl=r['_id'].get('acl') or [],
+                     hits=r['hits'])
+                for r in result]
+
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
         # To prevent multiple calls to this method from piling on redundant
@@ -668,6 +806,10 @@ def link_text(self):
             return jinja2.Markup('<s>') + text + jinja2.Markup('</s>')
         return text
 
+    def should_update_links(self, old_doc, new_doc):
+        """Links to closed tickets are struck through"""
+        return old_doc.get('status') != new_doc.get('status')
+
     @property
     def activity_name(self):
         return 'ticket #%s' % self.ticket_num
@@ -1209,16 +1351,28 @@ def __json__(self, posts_limit=None, is_export=False):
                     custom_fields=dict(self.custom_fields))
 
     @classmethod
-    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, **kw):
+    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, after=None, **kw):
         """
         Query tickets, filtering for 'read' permission, sorting and paginating the result.
 
+        Pages are found by skipping the tickets before them, unless ``after``
+        is given: then the page starts after that ticket_num, found with the
+        ('app_config_id', 'ticket_num') index however deep it is.  That only
+        works when sorting by ticket_num, and ``next_after`` in the result is
+        the ticket_num to pass to get the next page (None on the last page, or
+        when sorting by something else).
+        Since those pages are meant for walking through a whole tracker, the
+        count of all its tickets is estimated from the last ticket_num rather
+        than counted.
+
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
         q = cls.query.find(
             dict(query, app_config_id=app_config._id, deleted=deleted))
         q = q.sort('ticket_num', pymongo.DESCENDING)
+        direction = pymongo.DESCENDING
+        field = 'ticket_num'
         if sort and ' ' in sort:
             field, direction = sort.split()
             if field.startswith('_'):
@@ -1227,11 +1381,30 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
                 asc=pymongo.ASCENDING,
                 desc=pymongo.DESCENDING)[direction]
             q = q.sort(field, direction)
-        q = q.skip(start)
+        if after is not None:
+            try:
+                after = int(after)
+            except (TypeError, ValueError):
+                # like h.paging_sanitizer, ignore a bad value and use page instead
+                after = None
+        if after is not None and field == 'ticket_num':
+            if not query and not deleted:
+                count = Globals.query.get(app_config_id=app_config._id).last_ticket_num or 0
+            else:
+                count = q.count()
+            op = '$lt' if direction == pymongo.DESCENDING else '$gt'
+            q = cls.query.find(dict(query, app_config_id=app_config._id, deleted=deleted,
+                                    ticket_num={op: after}))
+            q = q.sort('ticket_num', direction)
+        else:
+            q = q.skip(start)
+            count = q.count()
         q = q.limit(limit)
         tickets = []
-        count = q.count()
-        for t in q:
+        next_after = None
+        for i, t in enumerate(q, 1):
+            if i == limit and field == 'ticket_num':
+                next_after = t.ticket_num
             if security.has_access(t, 'read', user, app_config.project.root_project):
                 tickets.append(t)
             else:
@@ -1239,7 +1412,7 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
 
         return dict(
             tickets=tickets,
-            count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
+            count=count, q=json.dumps(query), limit=limit, page=page, sort=sort, next_after=next_after,
             **kw)
 
     @classmethod
@@ -1363,7 +1536,7 @@ def get_mail_footer(self, notification, toaddr):
 
     def soft_delete(self):
         require_access(self, 'delete')
-        Shortlink.query.remove(dict(ref_id=self.index_id()))
+        Shortlink.remove_by_ref_ids([self.index_id()])
         self.deleted = True
         suffix = " {dt.hour}:{dt.minute}:{dt.second} {dt.day}-{dt.month}-{dt.year}".format(
             dt=datetime.utcnow())
@@ -147,6 +147,24 @@ def test_ticket_index(self):
         assert tickets.json['milestones'][0]['name'] == '1.0'
         assert tickets.json['milestones'][1]['name'] == '2.0'
 
+    def test_ticket_index_after(self):
+        self.create_ticket(summary='second ticket')
+        self.create_ticket(summary='third ticket')
+        tickets = self.api_get('/rest/p/test/bugs/?limit=2')
+        assert_equal([t['ticket_num'] for t in tickets.json['tickets']], [3, 2])
+        assert_equal(tickets.json['count'], 3)
+        assert_equal(tickets.json['next_after'], 2)
+        tickets = self.api_get('/rest/p/test/bugs/?limit=2&after=2')
+        assert_equal([t['ticket_num'] for t in tickets.json['tickets']], [1])
+        assert_equal(tickets.json['count'], 3)
+        assert_equal(tickets.json['next_after'], None)
+        # page= still works
+        tickets = self.api_get('/rest/p/test/bugs/?limit=2&page=1')
+        assert_equal([t['ticket_num'] for t in tickets.json['tickets']], [1])
+        # a bad after= is ignored, like a bad page=
+        tickets = self.api_get('/rest/p/test/bugs/?limit=2&page=1&after=abc')
+        assert_equal([t['ticket_num'] for t in tickets.json['tickets']], [1])
+
     def test_ticket_index_noauth(self):
         tickets = self.api_get('/rest/p/test/bugs', user='*anonymous')
         assert 'TicketMonitoringEmail' not in tickets.json[
@@ -110,9 +110,17 @@ def test_milestone_list(self):
         r = self.app.get('/bugs/milestones')
         assert '1.0' in r, r.showbrowser()
 
-    def test_milestone_list_progress(self):
+    # mim doesn't support $group
+    @mock.patch('ming.session.Session.aggregate')
+    def test_milestone_list_progress(self, aggregate):
+        aggregate.side_effect = lambda *a, **kw: iter([
+            dict(_id=dict(milestones=['1.0'], status='open', acl=[]), hits=1),
+            dict(_id=dict(milestones=['1.0'], status='closed', acl=[]), hits=1),
+        ])
         self.new_ticket(summary='foo', _milestone='1.0')
         self.new_ticket(summary='bar', _milestone='1.0', status='closed')
+        # counted by the update_bin_counts task
+        M.MonQTask.run_ready()
         r = self.app.get('/bugs/milestones')
         assert '1 / 2' in r, r.showbrowser()
 
@@ -344,12 +352,25 @@ def test_new_with_milestone(self):
         assert 'Milestone' in ticket_view
         assert '1.0' in ticket_view
 
-    def test_milestone_count(self):
+    # mim doesn't support $group
+    @mock.patch('ming.session.Session.aggregate')
+    def test_milestone_count(self, aggregate):
         self.new_ticket(summary='test new with milestone',
                         **{'_milestone': '1.0'})
         self.new_ticket(
             summary='test new with milestone', **{'_milestone': '1.0',
                                                   'private': True})
+        private_acl = [dict(ace) for ace in tm.Ticket.query.get(ticket_num=2).acl]
+        groups = [
+            dict(_id=dict(milestones=['1.0'], status='open', acl=[]), hits=1),
+            dict(_id=dict(milestones=['1.0'], status='open', acl=private_acl), hits=1),
+        ]
+        aggregate.side_effect = lambda *a, **kw: iter(groups)
+        # counted by the update_bin_counts task, with one aggregation
+        M.MonQTask.run_ready()
+        pipeline = aggregate.call_args[0][1]
+        assert_equal([list(step) for step in pipeline], [['$match'], ['$group']])
+
         r = self.app.get('/bugs/milestone_counts')
         counts = {
             'milestone_counts': [
@@ -365,6 +386,8 @@ def test_milestone_count(self):
         assert_equal(r.text, json.dumps(counts))
 
         self.app.post('/bugs/1/delete')
+        groups.pop(0)
+        M.MonQTask.run_ready()
         r = self.app.get('/bugs/milestone_counts')
         assert_equal(r.text, json.dumps(counts))
 
@@ -389,6 +412,20 @@ def test_bin_counts(self):
                                              {"count": 1, "label": "Open Tickets"}]})
         """
 
+    def test_user_bin_counts(self):
+        self.new_ticket(summary='test new')
+        self.app.post('/admin/bugs/bins/save_bin', {
+            'summary': 'My Tickets',
+            'terms': 'reported_by:$USER',
+            'old_summary': '',
+            'sort': ''})
+        M.MonQTask.run_ready()
+
+        r = self.app.get('/bugs/bin_counts')
+        assert_in({"count": 1, "label": "My Tickets"}, r.json['bin_counts'])
+        r = self.app.get('/bugs/bin_counts', extra_environ=dict(username=str('test-user')))
+        assert_in({"count": 0, "label": "My Tickets"}, r.json['bin_counts'])
+
     def test_milestone_progress(self):
         self.new_ticket(summary='Ticket 1', **{'_milestone': '1.0'})
         self.new_ticket(summary='Ticket 2', **{'_milestone': '1.0',
@@ -3282,9 +3319,32 @@ def sidebar_contains(response, text):
 
 
 class TestStats(TrackerTestController):
-    def test_stats(self):
+    # mim doesn't support aggregate
+    @mock.patch('ming.session.Session.aggregate')
+    def test_stats(self, aggregate):
+        aggregate.side_effect = [iter([]), iter([])]
         r = self.app.get('/bugs/stats/', status=200)
         assert_in('# tickets: 0', r.text)
+        assert_in('# of comments on tickets: 0', r.text)
+
+    @mock.patch('ming.session.Session.aggregate')
+    def test_stats_counts(self, aggregate):
+        aggregate.side_effect = [
+            iter([dict(_id=None, total=5, open=3, closed=2, week_tickets=1, fortnight_tickets=2, month_tickets=4)]),
+            iter([dict(_id=None, comments=9, week_comments=6, fortnight_comments=7, month_comments=8)]),
+        ]
+        r = self.app.get('/bugs/stats/', status=200)
+        text = squish_spaces(r.text)
+        for expected in ['# tickets: 5', '# open tickets: 3', '# closed tickets: 2',
+                         '7 days: 1', '14 days: 2', '30 days: 4',
+                         '# of comments on tickets: 9', '7 days: 6', '14 days: 7', '30 days: 8']:
+            assert_in(expected, text)
+        # one aggregation each for the tickets and the comments
+        assert_equal(aggregate.call_count, 2)
+        tickets_pipeline = aggregate.call_args_list[0][0][1]
+        assert_equal(list(tickets_pipeline[0]['$match']), ['app_config_id'])
+        assert_equal(sorted(tickets_pipeline[1]['$group']),
+                     ['_id', 'closed', 'fortnight_tickets', 'month_tickets', 'open', 'total', 'week_tickets'])
 
 
 class TestNotificationEmailGrouping(TrackerTestController):
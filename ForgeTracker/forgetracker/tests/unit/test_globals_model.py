@@ -26,8 +26,11 @@
 
 import forgetracker
 from forgetracker.model import Globals
+from forgetracker.model.ticket import UserBinCountsCache
 from forgetracker.tests.unit import TrackerTestWithModel
+from allura import model as M
 from allura.lib import helpers as h
+from allura.lib.search import SearchError
 
 
 class TestGlobalsModel(TrackerTestWithModel):
@@ -117,25 +120,131 @@ def test_invalidate_bin_counts(self, mock_dt, mock_task):
         assert_equal(gbl._bin_counts_invalidated, now)
 
     @mock.patch('forgetracker.model.ticket.Bin')
-    @mock.patch('forgetracker.model.ticket.search_artifact')
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
     @mock.patch('forgetracker.model.ticket.datetime')
-    def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
+    def test_update_bin_counts(self, mock_dt, mock_count, mock_bin):
         now = datetime.utcnow().replace(microsecond=0)
         mock_dt.utcnow.return_value = now
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
         mock_bin.query.find.return_value = [
-            mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER'),
+            mock.Mock(summary='baz', terms='qux')]
+        mock_count.return_value = [5, 6]
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
-        mock_search.assert_called_with(
-            forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False, fq=['-deleted_b:true'])
-        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+        mock_count.assert_called_once_with(
+            forgetracker.model.Ticket, ['bar', 'qux'], short_timeout=False, fq=['-deleted_b:true'])
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}, {'summary': 'baz', 'hits': 6}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
+        assert_equal(gbl._bin_counts_updated, now)
+
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
+    def test_count_bins_one_at_a_time_after_error(self, mock_count, mock_search):
+        gbl = Globals()
+        mock_count.side_effect = SearchError('bad query')
+        mock_search.side_effect = [mock.Mock(hits=3), SearchError('bad query')]
+        bins = [mock.Mock(terms='foo'), mock.Mock(terms='bar:(')]
+        assert_equal(gbl._count_bins(bins), [3, 0])
+        assert_equal(mock_search.call_count, 2)
+
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
+    def test_user_bin_counts(self, mock_count):
+        UserBinCountsCache._instance = None
+        gbl = Globals()
+        gbl._bin_counts_updated = datetime.utcnow()
+        bins = [mock.Mock(summary='foo', terms='bar'), mock.Mock(summary='mine', terms='assigned_to:$USER')]
+        mock_count.return_value = [2]
+        assert_equal(gbl.user_bin_counts(bins), {'mine': 2})
+        assert_equal(mock_count.call_args[0][1], ['assigned_to:$USER'])
+        assert_equal(mock_count.call_args[1]['short_timeout'], True)
+
+        with mock.patch.dict('forgetracker.model.ticket.tg_config', **{'forgetracker.user_bin_cache_size': 100}):
+            mock_count.reset_mock()
+            assert_equal(gbl.user_bin_counts(bins), {'mine': 2})
+            assert_equal(gbl.user_bin_counts(bins), {'mine': 2})
+            assert_equal(mock_count.call_count, 1)
+
+            # another user
+            gbl.user_bin_counts(bins, user=M.User.by_username('test-user'))
+            assert_equal(mock_count.call_count, 2)
+
+            # bin counts updated since
+            gbl._bin_counts_updated += timedelta(minutes=1)
+            gbl.user_bin_counts(bins)
+            assert_equal(mock_count.call_count, 3)
+        UserBinCountsCache._instance = None
+
+    def test_milestone_counts(self):
+        gbl = Globals()
+        developer = M.ProjectRole.by_name('Developer')
+        private_acl = [M.ACE.allow(developer._id, 'read'), M.DENY_ALL]
+        gbl._milestone_counts_data = [
+            dict(milestones={'_milestone': '1.0'}, status='open', acl=[], hits=2),
+            dict(milestones={'_milestone': '1.0'}, status='closed', acl=[], hits=1),
+            dict(milestones={'_milestone': '1.0'}, status='closed', acl=private_acl, hits=3),
+            dict(milestones={'_milestone': '2.0'}, status='open', acl=private_acl, hits=4),
+            dict(milestones={'_milestone': None}, status='open', acl=[], hits=5),
+        ]
+        gbl.closed_status_names = 'closed'
+        assert_equal(gbl.milestone_counts(), {
+            '_milestone:1.0': dict(hits=6, closed=4),
+            '_milestone:2.0': dict(hits=4, closed=0),
+        })
+        with h.push_config(c, user=M.User.anonymous()):
+            assert_equal(gbl.milestone_counts(), {'_milestone:1.0': dict(hits=3, closed=1)})
+            assert_equal(gbl.milestone_count('_milestone:2.0'), dict(name='_milestone:2.0', hits=0, closed=0))
+
+    # mim doesn't support $group
+    @mock.patch('ming.session.Session.aggregate')
+    @mock.patch('forgetracker.tasks.update_bin_counts')
+    def test_milestone_counts_not_counted_on_request(self, mock_task, aggregate):
+        gbl = Globals()
+        gbl.custom_fields = [dict(name='_milestone', type='milestone', milestones=[dict(name='1.0')])]
+        # not aggregated yet: queued, and counted one milestone at a time meanwhile
+        with mock.patch.object(Globals, '_count_milestone', return_value=dict(hits=3, closed=1)) as count:
+            assert_equal(gbl.milestone_counts(), {'_milestone:1.0': dict(hits=3, closed=1)})
+            assert_equal(gbl.milestone_count('_milestone:1.0'), dict(name='_milestone:1.0', hits=3, closed=1))
+        assert_equal(count.call_args_list, [mock.call('_milestone', '1.0')] * 2)
+        assert_equal(mock_task.post.call_count, 1)
+        assert_equal(gbl._milestone_counts_data, None)
+        gbl._bin_counts_invalidated = None
+
+        # invalidating keeps the old counts until the task updates them
+        gbl._milestone_counts_data = [dict(milestones={'_milestone': '1.0'}, status='open', acl=[], hits=2)]
+        gbl.invalidate_bin_counts()
+        assert_equal(gbl.milestone_counts(), {'_milestone:1.0': dict(hits=2, closed=0)})
+        assert not aggregate.called
+
+    @mock.patch('ming.session.Session.aggregate')
+    @mock.patch('forgetracker.model.ticket.Bin')
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
+    def test_update_bin_counts_milestones(self, mock_count, mock_bin, aggregate):
+        gbl = Globals()
+        gbl.custom_fields = [dict(name='_milestone', type='milestone', milestones=[])]
+        mock_bin.query.find.return_value = []
+        mock_count.return_value = []
+        aggregate.return_value = iter([dict(_id=dict(milestones=['1.0'], status='open', acl=[]), hits=2)])
+        gbl.update_bin_counts()
+        assert_equal(aggregate.call_count, 1)
+        pipeline = aggregate.call_args[0][1]
+        assert_equal(pipeline[1]['$group']['_id']['milestones'], ['$custom_fields._milestone'])
+        assert_equal(gbl._milestone_counts_data,
+                     [dict(milestones={'_milestone': '1.0'}, status='open', acl=[], hits=2)])
+
+        # a failed aggregation doesn't lose the bin counts or the previous milestone counts
+        aggregate.side_effect = ValueError('unsupported')
+        mock_count.return_value = [1]
+        mock_bin.query.find.return_value = [mock.Mock(summary='foo', terms='bar')]
+        gbl.update_bin_counts()
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 1}])
+        assert_equal(gbl._milestone_counts_data,
+                     [dict(milestones={'_milestone': '1.0'}, status='open', acl=[], hits=2)])
 
     def test_append_new_labels(self):
         gbl = Globals()
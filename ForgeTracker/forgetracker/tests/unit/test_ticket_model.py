@@ -37,7 +37,7 @@
 from forgetracker.model import Ticket, TicketAttachment
 from forgetracker.tests.unit import TrackerTestWithModel
 from forgetracker.import_support import ResettableStream
-from allura.model import Feed, Post, User
+from allura.model import Feed, Post, User, ShortlinkCache
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 
@@ -96,6 +96,17 @@ def test_activity_extras(self):
         assert_in('allura_id', t.activity_extras)
         assert_equal(t.activity_extras['summary'], t.summary)
 
+    def test_closing_updates_links(self):
+        t = Ticket(summary='my ticket', ticket_num=12, status='open')
+        ThreadLocalORMSession.flush_all()
+        generation = ShortlinkCache.get().generation(c.project._id)
+        t.summary = 'renamed ticket'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(ShortlinkCache.get().generation(c.project._id), generation)
+        t.status = 'closed'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(ShortlinkCache.get().generation(c.project._id), generation + 1)
+
     def test_has_activity_access(self):
         t = Ticket(summary='ticket', ticket_num=666)
         assert_true(t.has_activity_access('read', c.user, 'activity'))
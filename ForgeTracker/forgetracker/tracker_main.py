@@ -327,9 +327,8 @@ def sidebar_menu(self):
         milestones = []
         for bin in self.bins:
             label = bin.shorthand_id()
-            cls = '' if bin.terms and '$USER' in bin.terms else 'search_bin'
             search_bins.append(SitemapEntry(
-                h.text.truncate(label, 72), bin.url(), className=cls))
+                h.text.truncate(label, 72), bin.url(), className='search_bin'))
         for fld in c.app.globals.milestone_fields:
             milestones.append(SitemapEntry(h.text.truncate(fld.label, 72)))
             for m in getattr(fld, "milestones", []):
@@ -533,11 +532,11 @@ def bins(self):
     @property
     def milestones(self):
         milestones = []
+        counts = self.globals.milestone_counts()
         for fld in self.globals.milestone_fields:
             if fld.name == '_milestone':
                 for m in fld.milestones:
-                    d = self.globals.milestone_count(
-                        '%s:%s' % (fld.name, m.name))
+                    d = counts.get('%s:%s' % (fld.name, m.name), dict(hits=0, closed=0))
                     milestones.append(dict(
                         name=m.name,
                         due_date=m.get('due_date'),
@@ -656,12 +655,17 @@ def _check_security(self):
     @expose('json:')
     def bin_counts(self, *args, **kw):
         bin_counts = []
-        for bin in c.app.bins:
+        bins = c.app.bins
+        user_counts = c.app.globals.user_bin_counts(bins)
+        for bin in bins:
             bin_id = bin.shorthand_id()
             label = h.text.truncate(bin_id, 72)
             count = 0
             try:
-                count = c.app.globals.bin_count(bin_id)['hits']
+                if bin_id in user_counts:
+                    count = user_counts[bin_id]
+                else:
+                    count = c.app.globals.bin_count(bin_id)['hits']
             except ValueError:
                 log.info('Ticket bin %s search failed for project %s' %
                          (label, c.project.shortname))
@@ -671,12 +675,12 @@ def bin_counts(self, *args, **kw):
     @expose('json:')
     def milestone_counts(self, *args, **kw):
         milestone_counts = []
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             for m in getattr(fld, "milestones", []):
                 if m.complete:
                     continue
-                count = c.app.globals.milestone_count(
-                    '%s:%s' % (fld.name, m.name))['hits']
+                count = counts.get('%s:%s' % (fld.name, m.name), {}).get('hits', 0)
                 name = h.text.truncate(m.name, 72)
                 milestone_counts.append({'name': name, 'count': count})
         return {'milestone_counts': milestone_counts}
@@ -1047,36 +1051,27 @@ def update_tickets(self, **post_data):
             count, 's' if count != 1 else ''), 'ok')
         redirect('edit/' + post_data['__search'])
 
-    def tickets_since(self, when=None):
-        count = 0
-        if when:
-            count = TM.Ticket.query.find(dict(app_config_id=c.app.config._id,
-                                              created_date={'$gte': when})).count()
-        else:
-            count = TM.Ticket.query.find(
-                dict(app_config_id=c.app.config._id)).count()
-        return count
+    def _aggregate_counts(self, query, match, conditions):
+        '''Count the documents matching each of several conditions with one aggregation
 
-    def ticket_comments_since(self, when=None):
-        q = dict(
-            discussion_id=c.app.config.discussion_id,
-            status='ok',
-            deleted=False,
-        )
-        if when is not None:
-            q['timestamp'] = {'$gte': when}
-        return M.Post.query.find(q).count()
+        :param conditions: dict of name to an aggregation expression, or None to count every document
+        :returns: dict of name to count
+        '''
+        group = {'_id': None}
+        for name, condition in six.iteritems(conditions):
+            if condition is None:
+                group[name] = {'$sum': 1}
+            else:
+                group[name] = {'$sum': {'$cond': [condition, 1, 0]}}
+        counts = dict.fromkeys(conditions, 0)
+        for result in query.aggregate([{'$match': match}, {'$group': group}], cursor={}):
+            counts.update((name, result[name]) for name in conditions)
+        return counts
 
     @with_trailing_slash
     @expose('jinja:forgetracker:templates/tracker/stats.html')
     def stats(self, dates=None, **kw):
         globals = c.app.globals
-        total = TM.Ticket.query.find(
-            dict(app_config_id=c.app.config._id, deleted=False)).count()
-        open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                    '$in': list(globals.set_of_open_status_names)})).count()
-        closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted=False, status={
-                                      '$in': list(globals.set_of_closed_status_names)})).count()
         now = datetime.utcnow()
         week = timedelta(weeks=1)
         fortnight = timedelta(weeks=2)
@@ -1084,13 +1079,25 @@ def stats(self, dates=None, **kw):
         week_ago = now - week
         fortnight_ago = now - fortnight
         month_ago = now - month
-        week_tickets = self.tickets_since(week_ago)
-        fortnight_tickets = self.tickets_since(fortnight_ago)
-        month_tickets = self.tickets_since(month_ago)
-        comments = self.ticket_comments_since()
-        week_comments = self.ticket_comments_since(week_ago)
-        fortnight_comments = self.ticket_comments_since(fortnight_ago)
-        month_comments = self.ticket_comments_since(month_ago)
+        not_deleted = {'$eq': ['$deleted', False]}
+        ticket_counts = self._aggregate_counts(TM.Ticket.query, {'app_config_id': c.app.config._id}, dict(
+            total=not_deleted,
+            open={'$and': [not_deleted, {'$in': ['$status', list(globals.set_of_open_status_names)]}]},
+            closed={'$and': [not_deleted, {'$in': ['$status', list(globals.set_of_closed_status_names)]}]},
+            week_tickets={'$gte': ['$created_date', week_ago]},
+            fortnight_tickets={'$gte': ['$created_date', fortnight_ago]},
+            month_tickets={'$gte': ['$created_date', month_ago]},
+        ))
+        comment_counts = self._aggregate_counts(M.Post.query, dict(
+            discussion_id=c.app.config.discussion_id,
+            status='ok',
+            deleted=False,
+        ), dict(
+            comments=None,
+            week_comments={'$gte': ['$timestamp', week_ago]},
+            fortnight_comments={'$gte': ['$timestamp', fortnight_ago]},
+            month_comments={'$gte': ['$timestamp', month_ago]},
+        ))
         c.user_select = ffw.ProjectUserCombo()
         if dates is None:
             today = datetime.utcnow()
@@ -1101,18 +1108,9 @@ def stats(self, dates=None, **kw):
             week_ago=str(week_ago),
             fortnight_ago=str(fortnight_ago),
             month_ago=str(month_ago),
-            week_tickets=week_tickets,
-            fortnight_tickets=fortnight_tickets,
-            month_tickets=month_tickets,
-            comments=comments,
-            week_comments=week_comments,
-            fortnight_comments=fortnight_comments,
-            month_comments=month_comments,
-            total=total,
-            open=open,
-            closed=closed,
             globals=globals,
             dates=dates,
+            **dict(ticket_counts, **comment_counts)
         )
 
     @expose('json:')
@@ -1810,9 +1808,9 @@ def _check_security(self):
         require_access(c.app, 'read')
 
     @expose('json:')
-    def index(self, limit=100, page=0, **kw):
+    def index(self, limit=100, page=0, after=None, **kw):
         results = TM.Ticket.paged_query(c.app.config, c.user, query={},
-                                        limit=int(limit), page=int(page))
+                                        limit=int(limit), page=int(page), after=after)
         results['tickets'] = [dict(ticket_num=t.ticket_num, summary=t.summary)
                               for t in results['tickets']]
         results['tracker_config'] = c.app.config.__json__()
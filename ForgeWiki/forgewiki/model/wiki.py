@@ -271,7 +271,7 @@ def delete(self):
         description = self.text
         Notification.post(
             artifact=self, topic='metadata', text=description, subject=subject)
-        Shortlink.query.remove(dict(ref_id=self.index_id()))
+        Shortlink.remove_by_ref_ids([self.index_id()])
         self.deleted = True
         suffix = " {:%Y-%m-%d %H:%M:%S.%f}".format(datetime.utcnow())
         self.title += suffix
@@ -0,0 +1,94 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time how fast index_tasks.add_artifacts builds solr documents for a project's
+artifacts, compared to loading each artifact with its own query (ref.artifact)
+and calling index() twice, like add_artifacts used to.
+
+Nothing is sent to solr and no references are saved.  Example usage:
+
+paster script development.ini ../scripts/perf/add_artifacts_perf.py -- -p test --limit 1000
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+
+import mock
+from ming.orm import ThreadLocalORMSession
+from tg import tmpl_context as c
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib.search import find_shortlinks
+from allura.tasks import index_tasks
+
+
+def per_ref(ref_ids):
+    for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        artifact = ref.artifact
+        if artifact is None:
+            continue
+        with h.push_config(c, app=artifact.app):
+            s = artifact.solarize()
+            if s is None:
+                continue
+            find_shortlinks(artifact.index().get('text') or '')
+
+
+def bulk(ref_ids):
+    with mock.patch.object(index_tasks, 'check_for_dirty_ming_records'):
+        index_tasks.add_artifacts(ref_ids, solr_hosts=['http://localhost/not-used'])
+
+
+def timed(func, ref_ids, runs):
+    best = None
+    for i in range(runs):
+        ThreadLocalORMSession.close_all()
+        start = time.time()
+        func(ref_ids)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ThreadLocalORMSession.close_all()
+    return best
+
+
+def main(opts):
+    project = M.Project.query.get(shortname=opts.project)
+    ref_ids = [ref._id for ref in M.ArtifactReference.query.find(
+        {'artifact_reference.project_id': project._id}).limit(opts.limit)]
+    print('Indexing %d artifacts from %s, best of %d runs' % (len(ref_ids), project.shortname, opts.runs))
+    # sessions are closed without flushing, so updated references aren't saved
+    with mock.patch('allura.tasks.index_tasks.make_solr_from_config'):
+        for name, func in [('per-ref lookups', per_ref), ('add_artifacts', bulk)]:
+            elapsed = timed(func, ref_ids, opts.runs)
+            print('%20s: %.3fs  %.1f docs/sec' % (name, elapsed, len(ref_ids) / elapsed))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--project', required=True, help='project shortname')
+    parser.add_argument('--limit', type=int, default=1000, help='number of artifacts')
+    parser.add_argument('--runs', type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -0,0 +1,99 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Build a synthetic git repo with one big directory, and time finding the last
+commit of every entry with GitImplementation.last_commit_ids (a streaming git
+log per chunk of paths) against the generic RepositoryImplementation.last_commit_ids (a git
+log per commit found, in a thread per chunk of paths).
+
+Example usage:
+
+python scripts/perf/git_lcd_synthetic.py --files 2000 --commits 500
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from mock import Mock
+
+from allura import model as M
+from forgegit.model.git_repo import GitImplementation
+
+
+def build_repo(path, opts):
+    '''Create a bare repo with opts.commits commits, each changing a few random
+    files out of opts.files, using git fast-import'''
+    subprocess.check_call(['git', 'init', '--bare', '-q', path])
+    names = ['dir/file%05d.txt' % i for i in range(opts.files)]
+    lines = []
+    for i in range(opts.commits):
+        # the first commit adds every file, the rest change a few of them
+        changed = names if i == 0 else random.sample(names, opts.changes)
+        msg = 'commit %d' % i
+        lines.append('commit refs/heads/master')
+        lines.append('committer Perf <perf@example.com> %d +0000' % (1500000000 + i))
+        lines.append('data %d' % len(msg))
+        lines.append(msg)
+        for name in changed:
+            data = '%s %d\n' % (name, i)
+            lines.append('M 644 inline %s' % name)
+            lines.append('data %d' % len(data))
+            lines.append(data)
+    stream = ('\n'.join(lines) + '\n').encode('utf-8')
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    proc.communicate(stream)
+    return names
+
+
+def main(opts):
+    path = tempfile.mkdtemp(suffix='.git')
+    try:
+        names = build_repo(path, opts)
+        impl = GitImplementation(Mock(full_fs_path=path))
+        commit = Mock(_id=impl.head)
+        print('%d files, %d commits' % (opts.files, opts.commits))
+        results = []
+        for name, func in [('per-chunk git logs', M.RepositoryImplementation.last_commit_ids),
+                           ('single git log', GitImplementation.last_commit_ids)]:
+            start = time.time()
+            results.append(func(impl, commit, names))
+            print('%20s: %.3fs' % (name, time.time() - start))
+        first, second = results
+        if first != second:
+            print('Results differ for %d paths' % len(set(first.items()) ^ set(second.items())))
+    finally:
+        shutil.rmtree(path)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000, help='number of files in the directory')
+    parser.add_argument('--commits', type=int, default=500)
+    parser.add_argument('--changes', type=int, default=5, help='files changed per commit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
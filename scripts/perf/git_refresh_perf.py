@@ -0,0 +1,80 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time storing the commit and tree info of a whole git repo, like a new clone's
+refresh does, with one refresh_commit_info call per commit versus
+refresh_commit_info_bulk.
+
+The stored commit and tree docs are removed after each run, so use a repo that
+isn't in Allura already.  Example usage:
+
+paster script development.ini ../scripts/perf/git_refresh_perf.py -- /path/to/repo.git
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+
+from gitdb.util import bin_to_hex
+from mock import Mock
+
+from allura import model as M
+from forgegit.model.git_repo import GitImplementation
+
+
+def per_commit(impl, commit_ids, seen):
+    for oid in commit_ids:
+        impl.refresh_commit_info(oid, seen, True)
+
+
+def bulk(impl, commit_ids, seen):
+    impl.refresh_commit_info_bulk(commit_ids, seen)
+
+
+def main(opts):
+    impl = GitImplementation(Mock(full_fs_path=opts.repo))
+    commit_ids = list(impl.all_commit_ids())
+    if opts.limit:
+        commit_ids = commit_ids[:opts.limit]
+    if M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids[:100]})).count():
+        raise SystemExit('%s has already been refreshed, these docs would be removed' % opts.repo)
+    print('Refreshing %d commits from %s' % (len(commit_ids), opts.repo))
+    for name, func in [('per commit', per_commit), ('bulk', bulk)]:
+        seen = set()
+        start = time.time()
+        func(impl, commit_ids, seen)
+        elapsed = time.time() - start
+        print('%12s: %.1fs  %.1f commits/sec  %d trees' % (name, elapsed, len(commit_ids) / elapsed, len(seen)))
+        tree_ids = [bin_to_hex(binsha).decode('ascii') for binsha in seen]
+        for i in range(0, len(tree_ids), 1000):
+            M.repository.TreeDoc.m.remove(dict(_id={'$in': tree_ids[i:i + 1000]}))
+        for i in range(0, len(commit_ids), 1000):
+            M.repository.CommitDoc.m.remove(dict(_id={'$in': commit_ids[i:i + 1000]}))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('repo', help='path to a git repo')
+    parser.add_argument('--limit', type=int, default=None, help='only refresh this many commits')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
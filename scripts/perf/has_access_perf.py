@@ -0,0 +1,118 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time has_access calls over a list of private tickets, like a tracker listing
+page does, against a reference implementation that walks each ACL for every
+role (how has_access worked before ACLs were compiled).  Runs in the test
+environment (mim), like call_count.py.
+
+Example usage:
+
+python scripts/perf/has_access_perf.py --tickets 100 --calls 1000
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+
+from tg import tmpl_context as c
+from ming.odm import ThreadLocalODMSession
+
+from allura import model as M
+from allura.lib.security import Credentials, has_access
+from allura.tests import TestController
+from allura.tests import decorators as td
+from forgetracker import model as TM
+
+
+def linear_has_access(obj, permission, user, project, roles=None):
+    cred = Credentials.get()
+    if roles is None:
+        roles = cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids
+    if user != M.User.anonymous():
+        for r in cred.user_roles(user_id=user._id, project_id=project._id):
+            if M.ACL.contains(M.ACE.deny(r['_id'], permission), obj.acl):
+                return False
+    chainable_roles = []
+    for rid in roles:
+        for ace in obj.acl:
+            if M.ACE.match(ace, rid, permission):
+                if ace.access == M.ACE.ALLOW:
+                    return True
+                break
+        else:
+            chainable_roles.append(rid)
+    parent = obj.parent_security_context()
+    if parent and chainable_roles:
+        return linear_has_access(parent, permission, user, project, roles=chainable_roles)
+    elif not isinstance(obj, M.Neighborhood):
+        nbhd_project = project.neighborhood.neighborhood_project
+        result = linear_has_access(project.neighborhood, 'admin', user, nbhd_project)
+        if not (result or isinstance(obj, M.Project)):
+            result = linear_has_access(project, 'admin', user, project)
+        return result
+    return False
+
+
+@td.with_tracker
+def create_tickets(count):
+    reporters = [M.User.by_username('test-user-%d' % i) for i in range(10)]
+    for i in range(count):
+        ticket = TM.Ticket.new(form_fields=dict(summary='Private ticket %d' % i))
+        ticket.reported_by_id = reporters[i % len(reporters)]._id
+        ticket.private = True
+    ThreadLocalODMSession.flush_all()
+    return TM.Ticket.query.find(dict(app_config_id=c.app.config._id)).all()
+
+
+def run(name, func, tickets, user, opts):
+    Credentials.get().clear()
+    start = time.time()
+    results = [func(tickets[i % len(tickets)], user) for i in range(opts.calls)]
+    print('%20s: %.3fs' % (name, time.time() - start))
+    return results
+
+
+def main(opts):
+    test = TestController()
+    test.setUp()
+    try:
+        tickets = create_tickets(opts.tickets)
+        project = tickets[0].project
+        for username in ['*anonymous', 'test-user-1', 'test-admin']:
+            user = M.User.by_username(username)
+            print('%s, %d calls over %d tickets' % (username, opts.calls, len(tickets)))
+            expected = run('linear', lambda t, u: linear_has_access(t, 'read', u, project), tickets, user, opts)
+            actual = run('compiled', lambda t, u: bool(has_access(t, 'read', u)()), tickets, user, opts)
+            if actual != expected:
+                print('Results differ for %d calls' % sum(a != e for a, e in zip(actual, expected)))
+    finally:
+        test.tearDown()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickets', type=int, default=100)
+    parser.add_argument('--calls', type=int, default=1000, help='number of has_access calls')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -0,0 +1,103 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time Mailbox.deliver to a tool with many subscribers, against a reference
+implementation that updates each mailbox separately (how deliver worked before
+it used one update for all of them).  Runs in the test environment (mim), like
+call_count.py, so the numbers are only comparable with each other.
+
+Example usage:
+
+python scripts/perf/mailbox_deliver_perf.py --subscribers 10000 --notifications 10
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from tg import tmpl_context as c
+from ming.odm import ThreadLocalODMSession, session, mapper
+
+from allura import model as M
+from allura.tests import TestController
+from allura.tests import decorators as td
+
+
+def deliver_each(nid, artifact_index_ids, topic):
+    artifact_index_ids.append(None)
+    d = {
+        'project_id': c.project._id,
+        'app_config_id': c.app.config._id,
+        'artifact_index_id': {'$in': artifact_index_ids},
+        'topic': {'$in': [None, topic]}
+    }
+    for mbox in M.Mailbox.query.find(d).all():
+        mbox.query.update({'$push': dict(queue=nid),
+                           '$set': dict(last_modified=datetime.utcnow(), queue_empty=False)})
+        session(mbox).expunge(mbox)
+
+
+@td.with_wiki
+def create_mailboxes(count):
+    for i in range(count):
+        M.Mailbox(user_id=ObjectId(), project_id=c.project._id, app_config_id=c.app.config._id,
+                  type='direct')
+        if i % 1000 == 0:
+            ThreadLocalODMSession.flush_all()
+            ThreadLocalODMSession.close_all()
+    ThreadLocalODMSession.flush_all()
+    ThreadLocalODMSession.close_all()
+
+
+@td.with_wiki
+def run(name, func, opts):
+    start = time.time()
+    for i in range(opts.notifications):
+        func('%s-%d' % (name, i), [], 'metadata')
+    print('%20s: %.3fs' % (name, time.time() - start))
+
+
+def main(opts):
+    test = TestController()
+    test.setUp()
+    try:
+        create_mailboxes(opts.subscribers)
+        print('%d notifications to %d subscribers' % (opts.notifications, opts.subscribers))
+        run('each', deliver_each, opts)
+        run('deliver', M.Mailbox.deliver, opts)
+        mailboxes = mapper(M.Mailbox).collection.m.collection.find({}, {'queue': 1})
+        queue_lengths = set(len(mbox['queue']) for mbox in mailboxes)
+        if queue_lengths != {2 * opts.notifications}:
+            print('Unexpected queue lengths: %s' % sorted(queue_lengths))
+    finally:
+        test.tearDown()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--notifications', type=int, default=10, help='number of notifications to deliver')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
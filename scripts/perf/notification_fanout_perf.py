@@ -0,0 +1,100 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time sending a notification to many subscribers with
+Notification.send_direct_to, against sending it to each of them with
+send_direct, and count the sendmail tasks each one posts.  Runs in the test
+environment (mim), like call_count.py, so the numbers are only comparable with
+each other.
+
+Example usage:
+
+python scripts/perf/notification_fanout_perf.py --subscribers 1000
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import time
+
+from tg import tmpl_context as c
+from ming.odm import ThreadLocalODMSession
+
+from allura import model as M
+from allura.lib.security import Credentials
+from allura.tests import TestController
+from allura.tests import decorators as td
+from forgewiki import model as WM
+
+
+@td.with_wiki
+def create_users(count):
+    for i in range(count):
+        M.User(username='fanout-user-%d' % i, display_name='Fanout User %d' % i,
+               email_addresses=['fanout-user-%d@example.com' % i])
+        if i % 1000 == 0:
+            ThreadLocalODMSession.flush_all()
+    ThreadLocalODMSession.flush_all()
+    ThreadLocalODMSession.close_all()
+    return [u._id for u in M.User.query.find({'username': {'$regex': '^fanout-user-'}})]
+
+
+@td.with_wiki
+def run(name, func, user_ids):
+    page = WM.Page.query.get(app_config_id=c.app.config._id)
+    n = M.Notification.post(page, 'metadata', text='Fan out')
+    ThreadLocalODMSession.flush_all()
+    M.MonQTask.query.remove({'task_name': 'allura.tasks.mail_tasks.sendmail'})
+    Credentials.get().clear()
+    start = time.time()
+    func(n, user_ids)
+    elapsed = time.time() - start
+    tasks = M.MonQTask.query.find({'task_name': 'allura.tasks.mail_tasks.sendmail'}).count()
+    print('%20s: %.3fs, %d sendmail tasks' % (name, elapsed, tasks))
+
+
+def send_each(n, user_ids):
+    for user_id in user_ids:
+        n.send_direct(user_id)
+
+
+def send_together(n, user_ids):
+    n.send_direct_to(user_ids)
+
+
+def main(opts):
+    test = TestController()
+    test.setUp()
+    try:
+        user_ids = create_users(opts.subscribers)
+        print('1 notification to %d subscribers' % len(user_ids))
+        run('send_direct', send_each, user_ids)
+        run('send_direct_to', send_together, user_ids)
+    finally:
+        test.tearDown()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=1000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
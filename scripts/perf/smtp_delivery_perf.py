@@ -0,0 +1,106 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Time sending mail through an OutboundMailQueue, against sending each message
+on one connection like SMTPClient does without smtp_senders.  Mail is sent to
+a local SMTP sink (alluratest.smtp_debug.CollectingServer, an asyncio
+MailServer that keeps what it receives) unless --port is given, e.g. for the
+outmail docker container.
+
+Example usage:
+
+python scripts/perf/smtp_delivery_perf.py --messages 1000 --senders 4 --same 10
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import smtplib
+import time
+
+from allura.lib.mail_util import OutboundMailQueue
+from alluratest.smtp_debug import CollectingServer
+
+
+def messages(opts):
+    for i in range(opts.messages):
+        # every --same messages have the same content, like a notification sent to several users
+        content = 'Subject: Message %d\n\nPerformance test' % (i // opts.same)
+        yield 'perf@localhost', ['user-%d@localhost' % i], content
+
+
+def send_each(connect, opts):
+    client = connect()
+    for return_path, addrs, content in messages(opts):
+        client.sendmail(return_path, addrs, content)
+    client.quit()
+
+
+def send_queued(connect, opts):
+    q = OutboundMailQueue(connect, senders=opts.senders, stats_interval=0)
+    for return_path, addrs, content in messages(opts):
+        q.put(return_path, addrs, content)
+    q.flush()
+    return dict(q.stats.snapshot(), unsent=len(q.take_failed()))
+
+
+def run(name, func, connect, opts, sink=None):
+    start = time.time()
+    if sink:
+        del sink.messages[:]
+    result = func(connect, opts)
+    print('%20s: %.3fs' % (name, time.time() - start))
+    if result:
+        print('%20s  %s' % ('', result))
+    if sink:
+        print('%20s  %d messages, %d recipients received' % (
+            '', len(sink.messages), sum(len(rcpttos) for mailfrom, rcpttos, data in sink.messages)))
+
+
+def main(opts):
+    sink = None
+    port = opts.port
+    if not port:
+        sink = CollectingServer().start()
+        port = sink.port
+
+    def connect():
+        return smtplib.SMTP(opts.host, port)
+
+    try:
+        print('%d messages, %d with the same content' % (opts.messages, opts.same))
+        run('each', send_each, connect, opts, sink)
+        run('queued', send_queued, connect, opts, sink)
+    finally:
+        if sink:
+            sink.stop()
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--same', type=int, default=1, help='number of messages in a row with the same content')
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=0, help='SMTP server to send to, instead of a local sink')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
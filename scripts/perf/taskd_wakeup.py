@@ -0,0 +1,121 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare task pickup latency and idle mongo load of taskd's regular polling loop
+against monq.notify wakeups.
+
+Starts N worker threads that wait for tasks the same way taskd does, posts tasks
+at random intervals, and reports how long each task sat in the queue before a
+worker claimed it, and how many find_and_modify calls the idle workers made.
+
+Needs a real mongodb (notifications don't work with mim).  Example usage:
+
+paster script development.ini ../scripts/perf/taskd_wakeup.py -- --workers 8 --tasks 50
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import random
+import threading
+import time
+from datetime import datetime
+
+import mock
+from ming.orm import ThreadLocalORMSession
+from tg import config
+
+from allura import model as M
+
+
+def noop():
+    pass
+
+
+def worker(opts, listener, stop, latencies, counts):
+    def waitfunc():
+        if stop.is_set():
+            raise StopIteration
+        if listener:
+            listener.wait(opts.poll_interval)
+        else:
+            time.sleep(opts.poll_interval)
+        counts.append(1)  # get() will find_and_modify again
+
+    while not stop.is_set():
+        counts.append(1)
+        task = M.MonQTask.get(process='taskd_wakeup', waitfunc=waitfunc, only=[opts.task_name])
+        if task:
+            latencies.append((datetime.utcnow() - task.time_queue).total_seconds())
+            task.state = 'complete'
+            ThreadLocalORMSession.flush_all()
+
+
+def run(opts, notify):
+    M.MonQTask.query.remove(dict(task_name=opts.task_name))
+    stop = threading.Event()
+    latencies = []
+    counts = []
+
+    with mock.patch.dict(config, {'monq.notify': str(notify)}):
+        threads = []
+        for i in range(opts.workers):
+            listener = M.MonQTaskListener(only=[opts.task_name]) if notify else None
+            t = threading.Thread(target=worker, args=(opts, listener, stop, latencies, counts))
+            t.start()
+            threads.append(t)
+        del counts[:]  # only count claims made after all workers are up
+        begin = time.time()
+        for i in range(opts.tasks):
+            time.sleep(random.uniform(0, opts.max_gap))
+            M.MonQTask.post(noop)
+        while len(latencies) < opts.tasks:
+            time.sleep(0.01)
+        elapsed = time.time() - begin
+        stop.set()
+        for t in threads:
+            t.join()
+
+    latencies.sort()
+    print('%-8s workers=%d tasks=%d' % ('notify' if notify else 'poll', opts.workers, opts.tasks))
+    print('    pickup latency: mean %.3fs  median %.3fs  max %.3fs' % (
+        sum(latencies) / len(latencies), latencies[len(latencies) // 2], latencies[-1]))
+    print('    find_and_modify calls: %d (%.1f/s)' % (len(counts), len(counts) / elapsed))
+
+
+def main(opts):
+    opts.task_name = '%s.%s' % (noop.__module__, noop.__name__)
+    run(opts, notify=False)
+    run(opts, notify=True)
+    M.MonQTask.query.remove(dict(task_name=opts.task_name))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--poll-interval', type=float, default=10,
+                        help='like monq.poll_interval')
+    parser.add_argument('--max-gap', type=float, default=2,
+                        help='max seconds between posting tasks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())